@@ -1,22 +1,29 @@
 import logging
 import os
+import pickle
 import signal
 import random
 import datetime
+import threading
 import time
 from abc import ABC, abstractmethod
-from typing import List, Iterator, Optional
+from itertools import islice
+from typing import Any, Callable, Dict, List, Iterator, Optional, Tuple
 
-from common.components.invoker import Invoker
-from common.packets.client_control_packet import ClientControlPacket, RateLimitChangeRequest
+from common.components.token_bucket import TokenBucket
+from common.packets.client_control_packet import ClientControlPacket, RateLimitChangeRequest, ResumeResponse
 from packet_factory import PacketFactory
+from packet_sizer import PacketSizer
+from send_pipeline import SendPipeline
 from common.packets.dur_avg_out import DurAvgOut
+from common.packets.basic_packet import BasicPacket
 from common.packets.client_response_packets import GenericResponsePacket
 from common.packets.eof import Eof
+from common.packets.provisional_results import ProvisionalResults
 from common.packets.station_dist_mean import StationDistMean
 from common.packets.trips_count_by_year_joined import TripsCountByYearJoined
 from common.middleware.rabbit_middleware import Rabbit
-from common.components.readers import WeatherInfo, StationInfo, TripInfo, ClientIdResponsePacket
+from common.components.readers import WeatherInfo, StationInfo, TripInfo, ClientIdResponsePacket, ClientGatewayPacket
 from common.router import Router
 from common.utils import log_msg, success, bold, append_signal
 
@@ -31,8 +38,19 @@ RESULTS_QUEUE_PREFIX = os.environ.get("RESULTS_QUEUE_PREFIX", "results_")
 EOF_TYPES = ["dist_mean", "trip_count", "dur_avg"]
 
 INITIAL_SEND_RATE = int(os.environ.get("INITIAL_SEND_RATE", 10))
-INVOKER_WAIT_TIME = int(os.environ.get("INVOKER_WAIT_TIME", 3))
+# Packets sent at once after the upload waited, on top of the send rate. With a byte rate, as many
+# bytes as that many packets of the average size the gateway sees
+SEND_BURST = int(os.environ.get("SEND_BURST", 2))
+# Packets read and encoded ahead of the one being sent, by each upload lane
+SEND_BUFFER_CHUNKS = int(os.environ.get("SEND_BUFFER_CHUNKS", 8))
+# Cities uploaded at the same time, each lane over a connection of its own
+UPLOAD_CONCURRENCY = int(os.environ.get("UPLOAD_CONCURRENCY", 1))
+LANES_CHECK_INTERVAL = 0.1
 CONTROL_TIMEOUT = float(os.environ.get("CONTROL_TIMEOUT", 0.1))
+# Seconds a restarted client waits for the gateway to answer before starting a new session
+RESUME_TIMEOUT = float(os.environ.get("RESUME_TIMEOUT", 10))
+# Files of a city in the order they are sent, positions count chunks of one of them
+UPLOAD_FILES = 3
 LOG_RATE_CHANCE = 0.3
 
 
@@ -49,12 +67,26 @@ class BasicClient(ABC):
         self._all_cities = config["cities"]
         self._eofs = {}
         self._send_rate = INITIAL_SEND_RATE
-        self._invoker = Invoker(INVOKER_WAIT_TIME, self.__check_control_queue)
+        self._bucket = TokenBucket(INITIAL_SEND_RATE, SEND_BURST)
+        # Set once the gateway sends a byte rate, it replaces the rate in packets
+        self._byte_bucket: Optional[TokenBucket] = None
+        self._sizer = PacketSizer()
+        self._sending = False
+        self._stop_upload = threading.Event()
+        self._cities_left = 0
+        self._cities_left_lock = threading.Lock()
+        # [city]: (file, chunks of the file) the upload of the city starts from, UPLOAD_FILES once it was sent
+        self._positions: Dict[str, Tuple[int, int]] = {}
+        self._session_path = None
+        if config.get("session_directory") is not None:
+            self._session_path = os.path.join(config["session_directory"], f'{config["client_id"]}.session')
 
         self._rabbit = Rabbit(RABBIT_HOST)
         self.__set_up_signal_handler()
 
-        PacketFactory.set_ids(self.__request_session_id())
+        if not self.__resume_session():
+            PacketFactory.set_ids(self.__request_session_id())
+            self.__save_session()
 
     def handle_signal(self, _signum, _frame):
         self.canceled = True
@@ -84,6 +116,93 @@ class BasicClient(ABC):
                 return None
         return self.session_id
 
+    def __load_session(self) -> Optional[dict]:
+        if self._session_path is None or not os.path.exists(self._session_path):
+            return None
+        with open(self._session_path, "rb") as f:
+            return pickle.load(f)
+
+    def __save_session(self):
+        """
+        Saves what a restarted client needs to resume the session: its ids, and the results it already
+        consumed, which are no longer in the results queue.
+        """
+        if self._session_path is None or self.session_id is None:
+            return
+        session = {
+            "client_id": self.client_id,
+            "session_id": self.session_id,
+            "gateway": self.gateway,
+            "eofs": self._eofs,
+            "results": self.get_results_state(),
+        }
+        os.makedirs(os.path.dirname(self._session_path), exist_ok=True)
+        tmp_path = f"{self._session_path}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(session, f)
+        os.rename(tmp_path, self._session_path)
+
+    def __forget_session(self):
+        if self._session_path is not None and os.path.exists(self._session_path):
+            os.remove(self._session_path)
+
+    def __resume_session(self) -> bool:
+        session = self.__load_session()
+        if session is None:
+            return False
+
+        # Packets left in the gateway queue by the previous run are handled before the request
+        session_id = session["session_id"]
+        request_id = str(time.time_ns())
+        control_queue = CONTROL_QUEUE_PREFIX + session_id
+        self._rabbit.produce(session["gateway"], PacketFactory.build_resume_request(session_id, request_id))
+
+        response = None
+
+        def on_control_packet(message: bytes) -> bool:
+            nonlocal response
+            control_packet = ClientControlPacket.decode(message)
+            if control_packet.data == "SessionExpired":
+                response = control_packet.data
+            elif isinstance(control_packet.data, ResumeResponse):
+                if control_packet.data.request_id == request_id:
+                    response = control_packet.data
+            else:
+                self.__handle_control_message(message)
+            return True
+
+        deadline = time.monotonic() + RESUME_TIMEOUT
+        while response is None and time.monotonic() < deadline and not self.canceled:
+            self._rabbit.consume_one(control_queue, on_control_packet, timeout=CONTROL_TIMEOUT)
+
+        if not isinstance(response, ResumeResponse):
+            logging.info(f"action: resume | result: fail | session_id: {session_id} | response: {response}")
+            # Expired sessions have their queues deleted, waiting may have declared it again
+            self._rabbit.delete_queue(control_queue)
+            self.__forget_session()
+            return False
+
+        self.client_id = session["client_id"]
+        self.session_id = session_id
+        self.gateway = session["gateway"]
+        self._eofs = session["eofs"]
+        self.set_results_state(session["results"])
+        PacketFactory.set_ids(session_id)
+        for city, position in response.positions.items():
+            PacketFactory.set_seq_number(city, position.packets)
+            self._positions[city] = (position.file, position.chunks)
+        success(f"Resumed Session Id: {session_id} | positions: {self._positions}")
+        return True
+
+    def get_results_state(self) -> Any:
+        """
+        Results received so far, saved with the session so a resumed client still has them.
+        """
+        return None
+
+    def set_results_state(self, state: Any):
+        pass
+
     @staticmethod
     @abstractmethod
     def get_weather(city: str) -> Iterator[List[WeatherInfo]]:
@@ -99,6 +218,22 @@ class BasicClient(ABC):
     def get_trips(city: str) -> Iterator[List[TripInfo]]:
         pass
 
+    def get_weather_payloads(self, city: str, first_chunk: int = 0) -> Iterator[bytes]:
+        """
+        Encoded chunks of weather from `first_chunk` on, clients that keep them already encoded or can
+        seek to a chunk may override it.
+        """
+        for weather_info_list in islice(self.get_weather(city), first_chunk, None):
+            yield ClientGatewayPacket(weather_info_list).encode()
+
+    def get_stations_payloads(self, city: str, first_chunk: int = 0) -> Iterator[bytes]:
+        for station_info_list in islice(self.get_stations(city), first_chunk, None):
+            yield ClientGatewayPacket(station_info_list).encode()
+
+    def get_trips_payloads(self, city: str, first_chunk: int = 0) -> Iterator[bytes]:
+        for trip_info_list in islice(self.get_trips(city), first_chunk, None):
+            yield ClientGatewayPacket(trip_info_list).encode()
+
     @abstractmethod
     def handle_dur_avg_out_packet(self, city_name: str, packet: DurAvgOut):
         pass
@@ -111,74 +246,134 @@ class BasicClient(ABC):
     def handle_station_dist_mean_packet(self, city_name: str, packet: StationDistMean):
         pass
 
-    def __send_weather_data(self, queue: str, city: str):
-        for weather_info_list in self.get_weather(city):
-            if self.canceled:
-                return
-            packet = PacketFactory.build_weather_packet(city, weather_info_list)
-            self._rabbit.produce(queue, packet)
-            self._invoker.check()
-            time.sleep(1 / self._send_rate)
-
-    def __send_stations_data(self, queue: str, city: str):
-        for station_info_list in self.get_stations(city):
-            if self.canceled:
-                return
-            packet = PacketFactory.build_station_packet(city, station_info_list)
-            self._rabbit.produce(queue, packet)
-            self._invoker.check()
-            time.sleep(1 / self._send_rate)
-
-    def __send_trips_data(self, queue: str, city: str, last: bool = False):
-        for trip_info_list in self.get_trips(city):
-            if self.canceled:
-                return
-            self._rabbit.produce(queue, PacketFactory.build_trip_packet(city, trip_info_list))
-            self._invoker.check()
-            time.sleep(1 / self._send_rate)
-
-        self.finished = last
-        self._rabbit.produce(queue, PacketFactory.build_trip_eof(city))
-
-    def __send_data_from_city(self, city: str, last: bool = False):
-        logging.info(f"action: client_send_data | result: in_progress | city: {city}")
-        queue_name = self.gateway
-
-        if self.canceled:
-            return
+    @abstractmethod
+    def handle_provisional_results(self, city_name: str, results_type: str, sender_id: str, packets: list):
+        """
+        Replaces the previous provisional results the sender sent for the city and type.
+        """
+        pass
 
+    def __packets(self, cities: List[str]) -> Iterator[Tuple[str, int, bytes]]:
+        """
+        Every packet of the cities in order, with its city and file, UPLOAD_FILES for the EOF of the city.
+        Runs in the worker of a send pipeline, the only place where packets of those cities are built.
+        """
+        files: List[Callable[[str, int], Iterator[bytes]]] = [
+            self.get_weather_payloads, self.get_stations_payloads, self.get_trips_payloads
+        ]
+        for city in cities:
+            start_file, start_chunk = self._positions.get(city, (0, 0))
+            logging.info(f"action: client_send_data | result: in_progress | city: {city} | "
+                         f"file: {start_file} | chunk: {start_chunk}")
+            for file in range(start_file, UPLOAD_FILES):
+                first_chunk = start_chunk if file == start_file else 0
+                # Chunks are grouped until the packet reaches the size the sizer asks for now
+                payloads, size = [], 0
+                for chunk, payload in enumerate(files[file](city, first_chunk), start=first_chunk + 1):
+                    payloads.append(payload)
+                    size += len(payload)
+                    if size >= self._sizer.target(file):
+                        yield city, file, PacketFactory.build_chunk_packet(city, payloads, (file, chunk))
+                        payloads, size = [], 0
+                if len(payloads) > 0:
+                    yield city, file, PacketFactory.build_chunk_packet(city, payloads, (file, chunk))
+            yield city, UPLOAD_FILES, PacketFactory.build_trip_eof(city, (UPLOAD_FILES, 0))
+
+    def __upload_stopped(self) -> bool:
+        return self.canceled or self._stop_upload.is_set()
+
+    def __wait_to_send(self, rabbit: Rabbit, packet: bytes):
+        # Lanes share the buckets, so the client keeps to the rate the gateway gave it as a whole
+        if self._byte_bucket is not None:
+            wait_time = self._byte_bucket.reserve(len(packet))
+        else:
+            wait_time = self._bucket.reserve()
+        deadline = time.monotonic() + wait_time
+        while not self.__upload_stopped() and time.monotonic() < deadline:
+            rabbit.process_events(deadline - time.monotonic())
+
+    def __upload(self, cities: List[str], rabbit: Rabbit, errors: List[Exception]):
+        """
+        Sends the cities one after the other over a connection of its own, run by each upload lane.
+        """
+        pipeline = SendPipeline(self.__packets(cities), SEND_BUFFER_CHUNKS, rabbit.process_events)
+        city = None
         try:
-            self.__send_weather_data(queue_name, city)
-            self.__send_stations_data(queue_name, city)
-            self.__send_trips_data(queue_name, city, last)
-            logging.info(f"sent_data | city: {city}")
+            for city, file, packet in pipeline:
+                is_eof = file == UPLOAD_FILES
+                self.__wait_to_send(rabbit, packet)
+                if self.__upload_stopped():
+                    return
+                if is_eof:
+                    with self._cities_left_lock:
+                        self._cities_left -= 1
+                        self.finished = self._cities_left == 0
+                # Publishes wait for the confirm of the broker
+                sent_at = time.monotonic()
+                rabbit.produce(self.gateway, packet)
+                self._sizer.on_sent(file, time.monotonic() - sent_at)
+                if is_eof:
+                    logging.info(f"sent_data | city: {city}")
         except Exception as e:
-            logging.error(f"send_data | city: {city} | error: {e}")
-            if self.canceled:
-                return
-            raise e
+            if not self.__upload_stopped():
+                logging.error(f"send_data | city: {city} | error: {e}")
+                errors.append(e)
+        finally:
+            pipeline.close()
+            rabbit.close()
 
     def __send_cities_data(self):
         if self.canceled:
             return
-        for city in self._all_cities:
-            last = city == self._all_cities[-1]
-            self.__send_data_from_city(city, last)
-
-    def __handle_dist_mean(self, city_name: str, data: List[bytes]):
-        for item in data:
-            station_dist_mean = StationDistMean.decode(item)
-            self.handle_station_dist_mean_packet(city_name, station_dist_mean)
-
-    def __handle_dur_avg(self, city_name: str, data: List[bytes]):
-        for item in data:
-            dur_avg_out = DurAvgOut.decode(item)
-            self.handle_dur_avg_out_packet(city_name, dur_avg_out)
-
-    def __handle_trip_count(self, city_name: str, data: List[bytes]):
-        for item in data:
-            trips_count = TripsCountByYearJoined.decode(item)
-            self.handle_trip_count_by_year_joined_packet(city_name, trips_count)
+        self._sending = True
+        self._rabbit.consume(CONTROL_QUEUE_PREFIX + str(self.session_id), self.__handle_control_message, create=False)
+        self._rabbit.consume(RESULTS_QUEUE_PREFIX + str(self.session_id), self.__handle_message, create=False)
+
+        # Cities whose EOF the gateway accepted before a restart are not sent again
+        cities = [city for city in self._all_cities if self._positions.get(city, (0, 0))[0] < UPLOAD_FILES]
+        # Each lane uploads its cities in order, the flows of different lanes go at the same time
+        lanes_amount = min(max(1, UPLOAD_CONCURRENCY), len(cities))
+        self._cities_left = len(cities)
+        self.finished = self._cities_left == 0
+        errors = []
+        # Connections are opened here, their signal handlers can only be set up from the main thread
+        lanes = [
+            threading.Thread(target=self.__upload, args=(cities[i::lanes_amount], Rabbit(RABBIT_HOST), errors))
+            for i in range(lanes_amount)
+        ]
+        for lane in lanes:
+            lane.start()
+
+        # The main connection only consumes, control messages and results are handled as they arrive
+        try:
+            while any(lane.is_alive() for lane in lanes) and not self.canceled:
+                self._rabbit.process_events(LANES_CHECK_INTERVAL)
+        finally:
+            self._stop_upload.set()
+            for lane in lanes:
+                lane.join()
+            self._sending = False
+
+        if len(errors) > 0 and not self.canceled:
+            raise errors[0]
+
+    def __handle_results(self, city_name: str, results: List[BasicPacket]):
+        for result in results:
+            if isinstance(result, StationDistMean):
+                self.handle_station_dist_mean_packet(city_name, result)
+            elif isinstance(result, DurAvgOut):
+                self.handle_dur_avg_out_packet(city_name, result)
+            elif isinstance(result, TripsCountByYearJoined):
+                self.handle_trip_count_by_year_joined_packet(city_name, result)
+            else:
+                logging.warning(f"Unexpected result type: {type(result)}")
+
+    def __handle_provisional(self, packet: GenericResponsePacket, results: List[BasicPacket]) -> bool:
+        provisional = [result for result in results if isinstance(result, ProvisionalResults)]
+        for snapshot in provisional:
+            packets = [BasicPacket.decode(item) for item in snapshot.results]
+            self.handle_provisional_results(packet.city_name, packet.type, packet.sender_id, packets)
+        return len(provisional) > 0
 
     def __handle_eof(self, eof_type: str, city_name: str):
         self._eofs.setdefault(eof_type, set())
@@ -202,32 +397,28 @@ class BasicClient(ABC):
 
         if isinstance(packet.data, Eof):
             self.__handle_eof(packet.type, city_name)
-        elif packet.type == "dist_mean":
-            self.__handle_dist_mean(city_name, packet.data)
-        elif packet.type == "dur_avg":
-            self.__handle_dur_avg(city_name, packet.data)
-        elif packet.type == "trip_count":
-            self.__handle_trip_count(city_name, packet.data)
         else:
-            logging.warning(f"Unexpected message type: {packet.type}")
-
-        if self.__all_eofs_received():
+            results = [BasicPacket.decode(item) for item in packet.data]
+            if self.__handle_provisional(packet, results):
+                # Only shown while the upload goes on, a resumed client does not need them
+                return True
+            self.__handle_results(city_name, results)
+
+        self.__save_session()
+        if self.__all_eofs_received() and not self._sending:
             self._rabbit.stop()
 
         return True
 
-    def __check_control_queue(self):
-        queue = CONTROL_QUEUE_PREFIX + str(self.session_id)
-        self._rabbit.consume_one(queue, self.__handle_control_message, timeout=CONTROL_TIMEOUT, create=False)
-
     def __handle_control_message(self, message: bytes) -> bool:
         client_control_packet = ClientControlPacket.decode(message)
         if isinstance(client_control_packet.data, RateLimitChangeRequest):
-            self._send_rate = client_control_packet.data.new_rate
-            if random.random() < LOG_RATE_CHANCE:
-                log_msg(f"Rate limit changed to {self._send_rate}")
+            self.__change_rate(client_control_packet.data)
+        elif isinstance(client_control_packet.data, ResumeResponse):
+            logging.info("action: resume | result: ignored | reason: not waiting for it")
         elif client_control_packet.data == "SessionExpired":
             if not self.finished:
+                self.__forget_session()
                 self._rabbit.close()
                 logging.critical("Session expired " + str(self.session_id))
                 raise ConnectionAbortedError("SessionExpired")
@@ -236,16 +427,31 @@ class BasicClient(ABC):
 
         return True
 
+    def __change_rate(self, request: RateLimitChangeRequest):
+        self._send_rate = request.new_rate
+        self._bucket.set_rate(self._send_rate)
+
+        # Requests from gateways that only pace packets have no byte rate
+        new_byte_rate = request.new_byte_rate
+        if new_byte_rate is not None:
+            capacity = SEND_BURST * new_byte_rate / self._send_rate
+            if self._byte_bucket is None:
+                self._byte_bucket = TokenBucket(new_byte_rate, capacity)
+            else:
+                self._byte_bucket.set_rate(new_byte_rate, capacity)
+
+        if request.queue_depth is not None:
+            self._sizer.on_queue_depth(request.queue_depth)
+
+        if random.random() < LOG_RATE_CHANCE:
+            log_msg(f"Rate limit changed to {self._send_rate} packets/s | {new_byte_rate} bytes/s")
+
     def __get_responses(self):
-        if self.canceled:
+        if self.canceled or self.__all_eofs_received():
             return
 
-        results_queue = RESULTS_QUEUE_PREFIX + str(self.session_id)
-        self._rabbit.consume(results_queue, self.__handle_message, create=False)
+        # The results queue is consumed since the upload started
         logging.info(f"action: client_get_responses | result: in_progress | session_id: {self.session_id}")
-
-        # control_queue not needed, since we are no longer sending packets
-
         self._rabbit.start()
 
     def run(self):
@@ -254,6 +460,8 @@ class BasicClient(ABC):
         
         if not self.__all_eofs_received():
             logging.error("Not all EOFs received")
+        else:
+            self.__forget_session()
 
     def close(self):
         self.canceled = True
@@ -6,36 +6,72 @@ from typing import List, Iterator
 
 from basic_client import BasicClient
 from compare_results import compare_results
+from dataset_cache import DatasetCache
 from common.packets.dur_avg_out import DurAvgOut
 from common.packets.station_dist_mean import StationDistMean
 from common.packets.trips_count_by_year_joined import TripsCountByYearJoined
-from common.components.readers import TripInfo, StationInfo, WeatherInfo, WeatherReader, StationReader, TripReader
+from common.components.readers import TripInfo, StationInfo, WeatherInfo, WeatherReader, StationReader, TripReader, \
+    CsvReader, ClientGatewayPacket
 from common.utils import initialize_log, json_serialize, log_duplicate, success, log_msg
 
 CLIENT_ID = os.environ["CLIENT_ID"]
 CITIES = os.environ["CITIES"].split(",")
 DATA_FOLDER_PATH = os.environ["DATA_FOLDER_PATH"]
 BASELINE= os.environ.get("BASELINE","baseline.json")
+# Keeps the encoded chunks of each CSV there, repeated runs over the same files skip parsing
+DATASET_CACHE_DIRECTORY = os.environ.get("DATASET_CACHE_DIRECTORY")
+# Keeps the session there, a restarted client resumes its upload from the last chunk the gateway accepted
+SESSION_DIRECTORY = os.environ.get("SESSION_DIRECTORY")
 
 
 class Client(BasicClient):
     def __init__(self, config: dict):
+        # Set before the session is requested, a resumed one brings back its results
+        self.results = {}
         super().__init__(config)
         self._data_folder_path = config["data_folder_path"]
-        self.results = {}
+        self._cache = None
+        if config.get("dataset_cache_directory") is not None:
+            self._cache = DatasetCache(config["dataset_cache_directory"])
+        # Offsets of the chunks of each CSV, so a resumed upload seeks to its chunk instead of reading up to it
+        self._index_directory = None
+        if config.get("session_directory") is not None:
+            self._index_directory = os.path.join(config["session_directory"], "index")
+        # [city][type][sender_id]: latest provisional results of the sender, never dumped
+        self.provisional = {}
 
     def get_weather(self, city: str) -> Iterator[List[WeatherInfo]]:
-        reader = WeatherReader(self._data_folder_path, city)
+        reader = WeatherReader(self._data_folder_path, city, self._index_directory)
         yield from reader.next_data()
 
     def get_stations(self, city: str) -> Iterator[List[StationInfo]]:
-        reader = StationReader(self._data_folder_path, city)
+        reader = StationReader(self._data_folder_path, city, self._index_directory)
         yield from reader.next_data()
 
     def get_trips(self, city: str) -> Iterator[List[TripInfo]]:
-        reader = TripReader(self._data_folder_path, city)
+        reader = TripReader(self._data_folder_path, city, self._index_directory)
         yield from reader.next_data()
 
+    def __payloads(self, reader: CsvReader, first_chunk: int) -> Iterator[bytes]:
+        if self._cache is None:
+            return (ClientGatewayPacket(chunk).encode() for chunk in reader.next_data(first_chunk))
+        return self._cache.payloads(reader.path, reader.next_data, first_chunk)
+
+    def get_weather_payloads(self, city: str, first_chunk: int = 0) -> Iterator[bytes]:
+        return self.__payloads(WeatherReader(self._data_folder_path, city, self._index_directory), first_chunk)
+
+    def get_stations_payloads(self, city: str, first_chunk: int = 0) -> Iterator[bytes]:
+        return self.__payloads(StationReader(self._data_folder_path, city, self._index_directory), first_chunk)
+
+    def get_trips_payloads(self, city: str, first_chunk: int = 0) -> Iterator[bytes]:
+        return self.__payloads(TripReader(self._data_folder_path, city, self._index_directory), first_chunk)
+
+    def get_results_state(self) -> dict:
+        return self.results
+
+    def set_results_state(self, state: dict):
+        self.results = state
+
     def save_results(self, city, type, key, results):
         self.results.setdefault(city, {})
         self.results[city].setdefault(type, {})
@@ -53,6 +89,11 @@ class Client(BasicClient):
             f.write(data)
         return self.results 
 
+    def handle_provisional_results(self, city_name: str, results_type: str, sender_id: str, packets: list):
+        self.provisional.setdefault(city_name, {}).setdefault(results_type, {})[sender_id] = packets
+        amount = sum(len(sender_packets) for sender_packets in self.provisional[city_name][results_type].values())
+        log_msg(f"receive provisional_results | city: {city_name} | type: {results_type} | amount: {amount}")
+
     def handle_dur_avg_out_packet(self, city_name: str, packet: DurAvgOut):
         self.save_results(
             city_name, "duration_average_prectot>=30mm", packet.start_date,
@@ -88,6 +129,8 @@ def main():
         "data_folder_path": DATA_FOLDER_PATH,
         "client_id": CLIENT_ID,
         "cities": CITIES,
+        "dataset_cache_directory": DATASET_CACHE_DIRECTORY,
+        "session_directory": SESSION_DIRECTORY,
     })
     time.sleep(5)
     
@@ -0,0 +1,87 @@
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import tempfile
+from typing import Callable, Iterator, List
+
+from common.components.readers import CHUNK_SIZE, ClientGatewayPacket
+
+# Bump when the layout of the cache or of the packets changes, older entries are then ignored
+CACHE_VERSION = 1
+MAGIC = b"TP2CHUNKS"
+LENGTH = struct.Struct("<I")
+
+
+class DatasetCache:
+    """
+    Encoded chunks of the CSVs the client sends, so repeated runs over the same files skip parsing.
+
+    An entry is keyed by the path, size and modification time of its CSV, and holds every chunk
+    encoded as it goes to the gateway, each one prefixed by its length. Entries are read through a
+    memory map, and written to a temporary file that is renamed into place only once the whole CSV
+    was read, so a run canceled midway never leaves a partial entry behind.
+    """
+
+    def __init__(self, directory: str):
+        self._directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def __entry_path(self, csv_path: str) -> str:
+        stat = os.stat(csv_path)
+        key = f"{os.path.abspath(csv_path)}|{stat.st_size}|{stat.st_mtime_ns}|{CHUNK_SIZE}|{CACHE_VERSION}"
+        return os.path.join(self._directory, hashlib.sha1(key.encode()).hexdigest())
+
+    def payloads(self, csv_path: str, read_chunks: Callable[[int], Iterator[List]],
+                 first_chunk: int = 0) -> Iterator[bytes]:
+        """
+        Yields the encoded chunks of the CSV from `first_chunk` on, from the cache if it has them or
+        parsing it otherwise. `read_chunks` reads the CSV from the chunk it is given.
+        """
+        entry_path = self.__entry_path(csv_path)
+        if os.path.exists(entry_path):
+            logging.info(f"action: dataset_cache | result: hit | csv: {csv_path}")
+            yield from self.__read(entry_path, first_chunk)
+            return
+
+        logging.info(f"action: dataset_cache | result: miss | csv: {csv_path}")
+        if first_chunk > 0:
+            # An entry needs the whole CSV, a resumed upload only reads what it has left
+            for chunk in read_chunks(first_chunk):
+                yield ClientGatewayPacket(chunk).encode()
+            return
+        yield from self.__write(entry_path, read_chunks(0))
+
+    @staticmethod
+    def __read(entry_path: str, first_chunk: int) -> Iterator[bytes]:
+        with open(entry_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as entry:
+            offset = len(MAGIC)
+            chunk = 0
+            while offset < len(entry):
+                (length,) = LENGTH.unpack_from(entry, offset)
+                offset += LENGTH.size
+                # Skipped chunks are only jumped over by their length
+                if chunk >= first_chunk:
+                    yield entry[offset:offset + length]
+                offset += length
+                chunk += 1
+
+    @staticmethod
+    def __write(entry_path: str, chunks: Iterator[List]) -> Iterator[bytes]:
+        # Several clients may read the same CSV at once, each one writes its own temporary file.
+        # Their PIDs can not tell them apart, every client container runs as PID 1
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(entry_path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(MAGIC)
+                for chunk in chunks:
+                    payload = ClientGatewayPacket(chunk).encode()
+                    f.write(LENGTH.pack(len(payload)))
+                    f.write(payload)
+                    yield payload
+        except BaseException:
+            # Also reached when the sender stops reading, the CSV was not read to the end
+            os.remove(tmp_path)
+            raise
+        os.rename(tmp_path, entry_path)
@@ -1,8 +1,7 @@
-from typing import List
+from typing import List, Optional, Tuple
 
-from common.packets.client_packet import ClientDataPacket, ClientPacket
+from common.packets.client_packet import ClientDataPacket, ClientPacket, ResumeRequest
 from common.packets.eof import Eof
-from common.components.readers import WeatherInfo, StationInfo, TripInfo, ClientGatewayPacket
 from common.utils import min_hash, trace, log_msg
 
 DIST_MEAN_REQUEST = b'dist_mean'
@@ -14,21 +13,31 @@ MAX_SEQ_NUMBER = 2 ** 10
 
 class PacketFactory:
     client_id = None
-    seq_number = 0
-    times_maxed_seq = 0
+    # [city]: last sequence number, each city is a flow of its own and may be built in its own thread
+    seq_numbers = {}
+    times_maxed_seq = {}
 
     @staticmethod
     def set_ids(client_id: str):
         PacketFactory.client_id = client_id
 
     @staticmethod
-    def next_seq_number():
-        PacketFactory.seq_number += 1
-        if MAX_SEQ_NUMBER and PacketFactory.seq_number > MAX_SEQ_NUMBER:
-            PacketFactory.seq_number = 0
-            PacketFactory.times_maxed_seq += 1
-            log_msg("Generated %d packets [%d]", MAX_SEQ_NUMBER, PacketFactory.times_maxed_seq)
-        return PacketFactory.seq_number
+    def set_seq_number(city_name: str, packets: int):
+        """
+        Continues the sequence of a city after the packets the gateway already accepted.
+        """
+        PacketFactory.seq_numbers[city_name] = packets % (MAX_SEQ_NUMBER + 1)
+
+    @staticmethod
+    def next_seq_number(city_name: str):
+        seq_number = PacketFactory.seq_numbers.get(city_name, 0) + 1
+        if MAX_SEQ_NUMBER and seq_number > MAX_SEQ_NUMBER:
+            seq_number = 0
+            PacketFactory.times_maxed_seq[city_name] = PacketFactory.times_maxed_seq.get(city_name, 0) + 1
+            log_msg("Generated %d packets of %s [%d]", MAX_SEQ_NUMBER, city_name,
+                    PacketFactory.times_maxed_seq[city_name])
+        PacketFactory.seq_numbers[city_name] = seq_number
+        return seq_number
 
     @staticmethod
     def build_id_request_packet() -> bytes:
@@ -37,42 +46,34 @@ class PacketFactory:
         ).encode()
 
     @staticmethod
-    def build_weather_packet(city_name: str, weather_info: List[WeatherInfo]) -> bytes:
-        data_packet = ClientDataPacket(
-            client_id=PacketFactory.client_id,
-            city_name=city_name,
-            seq_number=PacketFactory.next_seq_number(),
-            data=[ClientGatewayPacket(weather_info).encode()]
-        )
-        return ClientPacket(data=data_packet).encode()
-
-    @staticmethod
-    def build_station_packet(city_name: str, station_info: List[StationInfo]) -> bytes:
-        data_packet = ClientDataPacket(
-            client_id=PacketFactory.client_id,
-            city_name=city_name,
-            seq_number=PacketFactory.next_seq_number(),
-            data=[ClientGatewayPacket(station_info).encode()]
-        )
-        return ClientPacket(data=data_packet).encode()
+    def build_resume_request(session_id: str, request_id: str) -> bytes:
+        return ClientPacket(
+            data=ResumeRequest(session_id, request_id)
+        ).encode()
 
     @staticmethod
-    def build_trip_packet(city_name: str, trip_info: List[TripInfo]) -> bytes:
+    def build_chunk_packet(city_name: str, payloads: List[bytes],
+                           position: Optional[Tuple[int, int]] = None) -> bytes:
+        """
+        Wraps encoded ClientGatewayPackets, which do not depend on the session and may come from a cache.
+        """
         data_packet = ClientDataPacket(
             client_id=PacketFactory.client_id,
             city_name=city_name,
-            seq_number=PacketFactory.next_seq_number(),
-            data=[ClientGatewayPacket(trip_info).encode()]
+            seq_number=PacketFactory.next_seq_number(city_name),
+            data=payloads,
+            position=position
         )
-        trace(f"Built trip packet {city_name}-{data_packet.seq_number}: {min_hash(data_packet.data)}")
+        trace(f"Built chunk packet {city_name}-{data_packet.seq_number}: {min_hash(data_packet.data)}")
         return ClientPacket(data=data_packet).encode()
 
     @staticmethod
-    def build_trip_eof(city: str) -> bytes:
+    def build_trip_eof(city: str, position: Optional[Tuple[int, int]] = None) -> bytes:
         data_packet = ClientDataPacket(
             client_id=PacketFactory.client_id,
             city_name=city,
-            seq_number=PacketFactory.next_seq_number(),
-            data=Eof(False)
+            seq_number=PacketFactory.next_seq_number(city),
+            data=Eof(False),
+            position=position
         )
         return ClientPacket(data=data_packet).encode()
@@ -0,0 +1,60 @@
+import logging
+import os
+import threading
+from typing import Dict, Tuple
+
+# Seconds the broker may take to confirm a packet before packets of its file get smaller
+CONFIRM_LATENCY_TARGET = float(os.environ.get("CONFIRM_LATENCY_TARGET", 0.2))
+# Messages in the input queue of the gateway past which every packet gets smaller
+QUEUE_DEPTH_TARGET = int(os.environ.get("QUEUE_DEPTH_TARGET", 100))
+
+# [file]: (min, max) bytes of a packet. Weather and stations are small files sent once, trips are
+# most of the upload and their packets become the WAL records and broker frames of the gateway
+PACKET_BYTES_BOUNDS: Dict[int, Tuple[int, int]] = {
+    0: (16 * 1024, 256 * 1024),
+    1: (16 * 1024, 256 * 1024),
+    2: (64 * 1024, 2 * 1024 * 1024),
+}
+
+
+class PacketSizer:
+    """
+    Bytes the packets of each file should have, adapted with an AIMD loop: they grow by their minimum
+    while the broker confirms them fast, and halve when a confirm is slow or the queue of the gateway
+    gets deep. Shared by the upload lanes, which report each packet they send.
+    """
+
+    def __init__(self, bounds: Dict[int, Tuple[int, int]] = None):
+        self._bounds = bounds or PACKET_BYTES_BOUNDS
+        self._targets = {file: low for file, (low, _high) in self._bounds.items()}
+        self._lock = threading.Lock()
+
+    def target(self, file: int) -> int:
+        return self._targets[file]
+
+    def __shrink(self, file: int, reason: str):
+        low, _high = self._bounds[file]
+        target = max(low, self._targets[file] // 2)
+        if target != self._targets[file]:
+            logging.info(f"action: packet_size | file: {file} | bytes: {target} | reason: {reason}")
+        self._targets[file] = target
+
+    def __grow(self, file: int):
+        low, high = self._bounds[file]
+        self._targets[file] = min(high, self._targets[file] + low)
+
+    def on_sent(self, file: int, confirm_latency: float):
+        if file not in self._bounds:
+            return
+        with self._lock:
+            if confirm_latency > CONFIRM_LATENCY_TARGET:
+                self.__shrink(file, "confirm_latency")
+            else:
+                self.__grow(file)
+
+    def on_queue_depth(self, depth: int):
+        if depth <= QUEUE_DEPTH_TARGET:
+            return
+        with self._lock:
+            for file in self._bounds:
+                self.__shrink(file, "queue_depth")
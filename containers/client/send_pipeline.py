@@ -0,0 +1,74 @@
+import queue
+import threading
+from typing import Callable, Generic, Iterator, TypeVar
+
+T = TypeVar("T")
+
+PUT_TIMEOUT = 0.5
+GET_TIMEOUT = 0.1
+
+
+class _Failure:
+    def __init__(self, error: Exception):
+        self.error = error
+
+
+_END = object()
+
+
+class SendPipeline(Generic[T]):
+    """
+    Reads and encodes what the client sends in a worker thread, keeping up to `buffer_size` items
+    ready so that publishing never waits for the CSVs.
+
+    Items come out in the order the worker produced them. An error in the worker is raised by the
+    iteration, and closing the pipeline stops the worker at its next item.
+    """
+
+    def __init__(self, items: Iterator[T], buffer_size: int, on_idle: Callable[[], None]):
+        self._queue = queue.Queue(maxsize=buffer_size)
+        self._closed = threading.Event()
+        self._on_idle = on_idle
+        self._worker = threading.Thread(target=self.__run, args=(items,), daemon=True)
+        self._worker.start()
+
+    def __run(self, items: Iterator[T]):
+        try:
+            for item in items:
+                if not self.__put(item):
+                    return
+        except Exception as e:
+            self.__put(_Failure(e))
+            return
+        finally:
+            # Lets the readers left midway clean up from this thread
+            close = getattr(items, "close", None)
+            if close is not None:
+                close()
+        self.__put(_END)
+
+    def __put(self, item) -> bool:
+        while not self._closed.is_set():
+            try:
+                self._queue.put(item, timeout=PUT_TIMEOUT)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def __iter__(self) -> Iterator[T]:
+        while True:
+            try:
+                item = self._queue.get(timeout=GET_TIMEOUT)
+            except queue.Empty:
+                # The worker fell behind, the caller may do something else meanwhile
+                self._on_idle()
+                continue
+            if item is _END:
+                return
+            if isinstance(item, _Failure):
+                raise item.error
+            yield item
+
+    def close(self):
+        self._closed.set()
@@ -0,0 +1,80 @@
+from typing import Any, Callable, Dict, List, Union
+
+AggregateState = List[Union[int, float]]
+
+
+class MeanAggregate:
+    """
+    Running mean kept as a count and a compensated (Kahan-Babuska) sum.
+
+    Aggregates can be merged in any order and grouping, so a stage may pre-aggregate
+    and ship partials instead of raw values without changing the final result.
+    """
+
+    __slots__ = ("count", "sum", "compensation")
+
+    def __init__(self, count: int = 0, total: float = 0.0, compensation: float = 0.0):
+        self.count = count
+        self.sum = total
+        self.compensation = compensation
+
+    def __add_to_sum(self, value: float):
+        new_sum = self.sum + value
+        # Recover the low order bits lost in the addition
+        if abs(self.sum) >= abs(value):
+            self.compensation += (self.sum - new_sum) + value
+        else:
+            self.compensation += (value - new_sum) + self.sum
+        self.sum = new_sum
+
+    def add(self, value: float):
+        self.__add_to_sum(value)
+        self.count += 1
+
+    def merge(self, other: "MeanAggregate"):
+        self.__add_to_sum(other.sum)
+        self.compensation += other.compensation
+        self.count += other.count
+
+    def total(self) -> float:
+        return self.sum + self.compensation
+
+    def mean(self) -> float:
+        if self.count == 0:
+            return 0.0
+        return self.total() / self.count
+
+    def to_state(self) -> AggregateState:
+        return [self.count, self.sum, self.compensation]
+
+    @staticmethod
+    def from_state(state: AggregateState) -> "MeanAggregate":
+        return MeanAggregate(*state)
+
+
+# Estimated memory of an aggregate in a buffer: its key, its slots and the slot in the flow dict
+MEAN_ENTRY_BYTES = 200
+
+
+def merge_aggregates(aggregate: MeanAggregate, other: MeanAggregate):
+    aggregate.merge(other)
+
+
+# [flow_id][key]: aggregate
+AggregatesBuffer = Dict[str, Dict[Any, MeanAggregate]]
+
+
+def buffer_to_state(buffer: AggregatesBuffer) -> Dict[str, Dict[str, AggregateState]]:
+    return {
+        flow_id: {key: aggregate.to_state() for key, aggregate in flow_buffer.items()}
+        for flow_id, flow_buffer in buffer.items()
+    }
+
+
+def buffer_from_state(state: Dict[str, Dict[str, AggregateState]],
+                      key_type: Callable[[str], Any] = str) -> AggregatesBuffer:
+    # JSON turns every key into a string, key_type restores it
+    return {
+        flow_id: {key_type(key): MeanAggregate.from_state(aggregate) for key, aggregate in flow_buffer.items()}
+        for flow_id, flow_buffer in state.items()
+    }
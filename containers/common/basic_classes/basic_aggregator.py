@@ -5,19 +5,31 @@ import json
 from abc import ABC
 from typing import Dict, List, Union
 
+from common.components import key_load
+from common.components.fusion import Fusion
 from common.components.heartbeater.heartbeater import HeartBeater
 from common.components.last_received import MultiLastReceivedManager
+from common.components.membership import MEMBERSHIP
 from common.components.message_sender import MessageSender, OutgoingMessages
+from common.components.side_table_image import SharedSideTables
 from common.components.state_saver import Recoverable, StateSaver
+from common.components.watermarks import WatermarkTracker
 from common.router import MultiRouter
 from common.packets.eof import Eof
 from common.packets.generic_packet import GenericPacket, GenericPacketBuilder
+from common.packets.watermark import Watermark
 from common.middleware.rabbit_middleware import Rabbit
 
 SIDE_TABLE_ROUTING_KEY = os.environ["SIDE_TABLE_ROUTING_KEY"]
 CONTAINER_ID = os.environ["CONTAINER_ID"]
 INPUT_QUEUE = os.environ["INPUT_QUEUE"]
 PREV_AMOUNT = int(os.environ["PREV_AMOUNT"])
+# Stage sending the EOFs, its amount follows the membership epoch of the flow
+PREV = os.environ.get("PREV")
+# Replicas of the deployment, replicas added later only take flows of newer membership epochs
+AMOUNT = os.environ.get("AMOUNT")
+if AMOUNT is not None:
+    AMOUNT = int(AMOUNT)
 EOF_ROUTING_KEY = os.environ["EOF_ROUTING_KEY"]
 
 RABBIT_HOST = os.environ.get("RABBIT_HOST", "rabbitmq")
@@ -28,16 +40,22 @@ class BasicAggregator(Recoverable, ABC):
     def __init__(self, router: MultiRouter, container_id: str = CONTAINER_ID,
                  side_table_routing_key: str = SIDE_TABLE_ROUTING_KEY):
         self._starting_up = True
+        self._shared_side_tables = SharedSideTables.from_env(container_id)
         self.__setup_middleware(side_table_routing_key)
 
         self._basic_agg_container_id = container_id
         self._last_received = MultiLastReceivedManager()
         self._message_sender = MessageSender(self._rabbit)
+        self._fusion = Fusion()
         self._eofs_received: Dict[str, int] = {}
+        self._watermarks = WatermarkTracker()
         self.heartbeater = HeartBeater()
 
         self.router = router
         self.state_saver = StateSaver(self)
+        if self._shared_side_tables is not None:
+            self._shared_side_tables.collect_garbage()
+        MEMBERSHIP.mark_ready(container_id)
         self._starting_up = False
 
     def __setup_middleware(self, side_table_routing_key: str):
@@ -50,7 +68,10 @@ class BasicAggregator(Recoverable, ABC):
 
         self._rabbit.route(input_queue, "publish", side_table_routing_key)
 
-    def __handle_chunk(self, flow_id: str, chunk: List[bytes]) -> OutgoingMessages:
+    def handle_chunk(self, flow_id: str, chunk: List[bytes]) -> OutgoingMessages:
+        """
+        Handles every message of a chunk. Aggregators that can process a whole chunk at once may override it.
+        """
         outgoing_messages = {}
         for message in chunk:
             responses = self.handle_message(flow_id, message)
@@ -61,15 +82,23 @@ class BasicAggregator(Recoverable, ABC):
 
     def __on_stream_message_without_duplicates(self, decoded: GenericPacket) -> bool:
         flow_id = decoded.get_flow_id()
+        MEMBERSHIP.enter(decoded.epoch)
 
         if isinstance(decoded.data, Eof):
             outgoing_messages = self.handle_eof_message(flow_id, decoded.data)
+        elif isinstance(decoded.data, Watermark):
+            outgoing_messages = self.handle_watermark_message(flow_id, decoded.sender_id, decoded.data)
         elif isinstance(decoded.data, list):
-            outgoing_messages = self.__handle_chunk(flow_id, decoded.data)
+            outgoing_messages = self.handle_chunk(flow_id, decoded.data)
         else:
             raise Exception(f"Unknown message type: {type(decoded.data)}")
+        outgoing_messages = self._fusion.apply(flow_id, outgoing_messages)
+        if not MEMBERSHIP.is_member(self._basic_agg_container_id, EOF_ROUTING_KEY, AMOUNT):
+            # Flows older than this replica are finished by the others, it must not send their EOFs
+            outgoing_messages = OutgoingMessages({})
 
-        builder = GenericPacketBuilder(self._basic_agg_container_id, decoded.client_id, decoded.city_name)
+        builder = GenericPacketBuilder(self._basic_agg_container_id, decoded.client_id, decoded.city_name,
+                                       decoded.epoch)
         self._message_sender.send(builder, outgoing_messages, skip_send=self._starting_up)
 
         return True
@@ -92,14 +121,22 @@ class BasicAggregator(Recoverable, ABC):
         self._eofs_received.setdefault(eof_key, 0)
         self._eofs_received[eof_key] += 1
 
-        logging.debug(f"Received EOF for flow {eof_key} ({self._eofs_received[eof_key]}/{PREV_AMOUNT})")
-        if self._eofs_received[eof_key] < PREV_AMOUNT:
+        prev_amount = MEMBERSHIP.amount(PREV, PREV_AMOUNT)
+        logging.debug(f"Received EOF for flow {eof_key} ({self._eofs_received[eof_key]}/{prev_amount})")
+        if self._eofs_received[eof_key] < prev_amount:
             return {}
 
         self._eofs_received.pop(eof_key)
+        self._watermarks.pop(flow_id)
 
         return self.handle_eof(flow_id, message)
 
+    def handle_watermark_message(self, flow_id: str, sender_id: str, message: Watermark) -> Dict[str, Watermark]:
+        day = self._watermarks.update(flow_id, sender_id, message.day, MEMBERSHIP.amount(PREV, PREV_AMOUNT))
+        if day is None:
+            return {}
+        return self.handle_watermark(flow_id, Watermark(day))
+
     @abc.abstractmethod
     def handle_message(self, flow_id: str, message: bytes) -> Dict[str, List[bytes]]:
         pass
@@ -112,23 +149,37 @@ class BasicAggregator(Recoverable, ABC):
 
         return output
 
+    def handle_watermark(self, flow_id, message: Watermark) -> Dict[str, Watermark]:
+        """
+        Called when the watermark of the flow moves, aggregators join trips as they come so they just forward it.
+        """
+        return {queue: message for queue in self.router.publish()}
+
     @abc.abstractmethod
     def get_state(self) -> dict:
         return {
             "message_sender": self._message_sender.get_state(),
             "last_received": self._last_received.get_state(),
             "eofs_received": self._eofs_received,
+            "watermarks": self._watermarks.get_state(),
+            "key_load": key_load.get_state(),
         }
 
     @abc.abstractmethod
     def set_state(self, state: dict):
         self._message_sender.set_state(state["message_sender"])
         self._eofs_received = state["eofs_received"]
+        self._watermarks.set_state(state.get("watermarks", {}))
         self._last_received.set_state(state["last_received"])
+        key_load.set_state(state.get("key_load", {}))
 
     def replay(self, msg: bytes) -> None:
         self.__on_stream_message_callback(msg)
 
+    def on_checkpoint(self) -> None:
+        if self._shared_side_tables is not None:
+            self._shared_side_tables.on_checkpoint()
+
     def start(self):
         self.heartbeater.start()
         self._rabbit.start()
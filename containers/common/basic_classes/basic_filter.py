@@ -2,31 +2,43 @@ import abc
 import logging
 import os
 from abc import ABC
-from typing import List, Dict, Union
+from typing import List, Dict, Optional, Union
 
+from common.components import key_load, spill
+from common.components.fusion import Fusion
 from common.components.heartbeater.heartbeater import HeartBeater
+from common.components.membership import MEMBERSHIP
 from common.components.message_sender import MessageSender, OutgoingMessages
 from common.components.state_saver import Recoverable, StateSaver
 from common.packets.eof import Eof
 from common.packets.generic_packet import GenericPacket, GenericPacketBuilder
+from common.packets.watermark import Watermark
 from common.middleware.rabbit_middleware import Rabbit
 
 RABBIT_HOST = os.environ.get("RABBIT_HOST", "rabbitmq")
 INPUT_QUEUE = os.environ["INPUT_QUEUE"]
 EOF_ROUTING_KEY = os.environ["EOF_ROUTING_KEY"]
+COMBINE = os.environ.get("COMBINE", "false").lower() == "true"
+# Replicas of the deployment, replicas added later only take flows of newer membership epochs
+AMOUNT = os.environ.get("AMOUNT")
+if AMOUNT is not None:
+    AMOUNT = int(AMOUNT)
 
 
 class BasicFilter(Recoverable, ABC):
-    def __init__(self, container_id: str):
+    def __init__(self, container_id: str, combine: bool = COMBINE):
         self._starting_up = True
+        self._combine = combine
         logging.info(
             f"action: init | result: in_progress | filter: {self.__class__.__name__} | container_id: {container_id}")
         self.__setup_middleware()
 
         self.basic_filter_container_id = container_id
         self._message_sender = MessageSender(self._rabbit)
+        self._fusion = Fusion()
         self.heartbeater = HeartBeater()
         self.state_saver = StateSaver(self)
+        MEMBERSHIP.mark_ready(container_id)
         self._starting_up = False
 
     def __setup_middleware(self):
@@ -36,7 +48,10 @@ class BasicFilter(Recoverable, ABC):
         eof_routing_key = EOF_ROUTING_KEY
         self._rabbit.route(self._input_queue, "publish", eof_routing_key)
 
-    def __handle_chunk(self, flow_id, chunk: List[bytes]) -> OutgoingMessages:
+    def handle_chunk(self, flow_id, chunk: List[bytes]) -> OutgoingMessages:
+        """
+        Handles every message of a chunk. Filters that can process a whole chunk at once may override it.
+        """
         outgoing_messages = {}
         for message in chunk:
             responses = self.handle_message(flow_id, message)
@@ -45,6 +60,20 @@ class BasicFilter(Recoverable, ABC):
                 outgoing_messages[queue] += messages
         return OutgoingMessages(outgoing_messages)
 
+    def combine_chunk(self, flow_id, chunk: List[bytes]) -> Optional[OutgoingMessages]:
+        """
+        Pre-aggregates a chunk into partial results per key, used instead of handle_chunk when
+        combining is enabled. Filters without a combiner return None.
+        """
+        return None
+
+    def __handle_chunk(self, flow_id, chunk: List[bytes]) -> OutgoingMessages:
+        if self._combine:
+            outgoing_messages = self.combine_chunk(flow_id, chunk)
+            if outgoing_messages is not None:
+                return outgoing_messages
+        return self.handle_chunk(flow_id, chunk)
+
     def on_message_callback(self, msg: Union[bytes, GenericPacket]) -> bool:
         if isinstance(msg, bytes):
             decoded = GenericPacket.decode(msg)
@@ -54,15 +83,24 @@ class BasicFilter(Recoverable, ABC):
             encoded = msg.encode()
 
         flow_id = decoded.get_flow_id()
+        MEMBERSHIP.enter(decoded.epoch)
 
         if isinstance(decoded.data, Eof):
             outgoing_messages = self.handle_eof_message(flow_id, decoded.data)
+        elif isinstance(decoded.data, Watermark):
+            outgoing_messages = self.handle_watermark_message(flow_id, decoded.sender_id, decoded.data)
         elif isinstance(decoded.data, list):
             outgoing_messages = self.__handle_chunk(flow_id, decoded.data)
         else:
             raise ValueError(f"Unknown packet type: {type(decoded.data)}")
-
-        builder = GenericPacketBuilder(self.basic_filter_container_id, decoded.client_id, decoded.city_name)
+        outgoing_messages = self._fusion.apply(flow_id, outgoing_messages)
+        spill.check()
+        if not MEMBERSHIP.is_member(self.basic_filter_container_id, EOF_ROUTING_KEY, AMOUNT):
+            # Flows older than this replica are finished by the others, it must not send their EOFs
+            outgoing_messages = OutgoingMessages({})
+
+        builder = GenericPacketBuilder(self.basic_filter_container_id, decoded.client_id, decoded.city_name,
+                                       decoded.epoch)
         self._message_sender.send(builder, outgoing_messages, skip_send=self._starting_up)
 
         if not self._starting_up:
@@ -78,17 +116,26 @@ class BasicFilter(Recoverable, ABC):
     def handle_eof_message(self, flow_id: str, message: Eof) -> OutgoingMessages:
         pass
 
+    @abc.abstractmethod
+    def handle_watermark_message(self, flow_id: str, sender_id: str, message: Watermark) -> OutgoingMessages:
+        pass
+
     def set_state(self, state: dict) -> None:
         self._message_sender.set_state(state["message_sender"])
+        key_load.set_state(state.get("key_load", {}))
 
     def get_state(self) -> dict:
         return {
-            "message_sender": self._message_sender.get_state()
+            "message_sender": self._message_sender.get_state(),
+            "key_load": key_load.get_state(),
         }
 
     def replay(self, msg: bytes) -> None:
         self.on_message_callback(msg)
 
+    def on_checkpoint(self) -> None:
+        spill.on_checkpoint()
+
     def start(self):
         self.heartbeater.start()
         self._rabbit.start()
@@ -0,0 +1,61 @@
+import abc
+import os
+from abc import ABC
+from typing import Dict, List, Optional
+
+from common.components.message_sender import OutgoingMessages
+from common.packets.eof import Eof
+from common.packets.watermark import Watermark
+from common.router import Router
+
+
+def router_from_env(prefix: str = "") -> Router:
+    next_amount = os.environ.get(f"{prefix}NEXT_AMOUNT")
+    if next_amount is not None:
+        next_amount = int(next_amount)
+    hot_key_split = int(os.environ.get(f"{prefix}HOT_KEY_SPLIT", "1"))
+    return Router(os.environ[f"{prefix}NEXT"], next_amount, hot_key_split)
+
+
+class BasicOperator(ABC):
+    """
+    Stateless step of the pipeline. It runs either in its own container, wrapped in an
+    OperatorFilter, or fused in-process into the container of the previous step.
+    """
+
+    def __init__(self, router: Router):
+        self.router = router
+
+    @classmethod
+    def from_env(cls, prefix: str = "") -> "BasicOperator":
+        """
+        Builds the operator from its deployment configuration. Fused operators read it
+        with their step name as prefix (e.g. PREC_FILTER_NEXT).
+        """
+        return cls(router_from_env(prefix))
+
+    def handle_chunk(self, flow_id, chunk: List[bytes]) -> OutgoingMessages:
+        outgoing_messages = {}
+        for message in chunk:
+            responses = self.handle_message(flow_id, message)
+            for (queue, messages) in responses.items():
+                outgoing_messages.setdefault(queue, [])
+                outgoing_messages[queue] += messages
+        return OutgoingMessages(outgoing_messages)
+
+    def combine_chunk(self, flow_id, chunk: List[bytes]) -> Optional[OutgoingMessages]:
+        return None
+
+    @abc.abstractmethod
+    def handle_message(self, flow_id, message: bytes) -> Dict[str, List[bytes]]:
+        pass
+
+    def handle_eof(self, flow_id: str, message: Eof) -> OutgoingMessages:
+        return OutgoingMessages({
+            self.router.publish(): message
+        })
+
+    def handle_watermark(self, flow_id: str, message: Watermark) -> OutgoingMessages:
+        return OutgoingMessages({
+            self.router.publish(): message
+        })
@@ -5,19 +5,25 @@ from abc import ABC
 from typing import Dict, List, Union
 
 from common.components.last_received import MultiLastReceivedManager
+from common.components.membership import MEMBERSHIP
 from common.components.message_sender import OutgoingMessages
+from common.components.watermarks import WatermarkTracker
 from common.router import Router
 from common.basic_classes.basic_filter import BasicFilter
 from common.packets.eof import Eof
 from common.packets.generic_packet import GenericPacket
+from common.packets.watermark import Watermark
 
 CONTAINER_ID = os.environ["CONTAINER_ID"]
 RABBIT_HOST = os.environ.get("RABBIT_HOST", "rabbitmq")
 PREV_AMOUNT = int(os.environ["PREV_AMOUNT"])
+# Stage sending the EOFs, its amount follows the membership epoch of the flow
+PREV = os.environ.get("PREV")
 NEXT = os.environ["NEXT"]
 NEXT_AMOUNT = os.environ.get("NEXT_AMOUNT")
 if NEXT_AMOUNT is not None:
     NEXT_AMOUNT = int(NEXT_AMOUNT)
+HOT_KEY_SPLIT = int(os.environ.get("HOT_KEY_SPLIT", "1"))
 MAX_SEQ_NUMBER = 2 ** 10  # 2 packet ids would be enough, but we use more for traceability
 
 
@@ -25,20 +31,23 @@ class BasicStatefulFilter(BasicFilter, ABC):
     def __init__(self, container_id: str = CONTAINER_ID):
         self._last_received = MultiLastReceivedManager()
         self._eofs_received: Dict[str, int] = {}
+        self._watermarks = WatermarkTracker()
 
-        self.router = Router(NEXT, NEXT_AMOUNT)
+        self.router = Router(NEXT, NEXT_AMOUNT, HOT_KEY_SPLIT)
         super().__init__(container_id)
 
     def get_state(self) -> dict:
         return {
             "last_received": self._last_received.get_state(),
             "eofs_received": self._eofs_received,
+            "watermarks": self._watermarks.get_state(),
             "parent_state": super().get_state()
         }
 
     def set_state(self, state: dict):
         self._last_received.set_state(state["last_received"])
         self._eofs_received = state["eofs_received"]
+        self._watermarks.set_state(state.get("watermarks", {}))
         super().set_state(state["parent_state"])
 
     def on_message_callback(self, msg: bytes) -> bool:
@@ -62,12 +71,28 @@ class BasicStatefulFilter(BasicFilter, ABC):
         eof_key = f"{flow_id}-{message.timestamp}"
         self._eofs_received.setdefault(eof_key, 0)
         self._eofs_received[eof_key] += 1
+        prev_amount = MEMBERSHIP.amount(PREV, PREV_AMOUNT)
 
-        if self._eofs_received[eof_key] < PREV_AMOUNT:
-            logging.debug(f"Received EOF for flow {eof_key} ({self._eofs_received[eof_key]}/{PREV_AMOUNT})")
+        if self._eofs_received[eof_key] < prev_amount:
+            logging.debug(f"Received EOF for flow {eof_key} ({self._eofs_received[eof_key]}/{prev_amount})")
             return {}
-        logging.info(f"Received EOF for flow {eof_key} ({self._eofs_received[eof_key]}/{PREV_AMOUNT})")
+        logging.info(f"Received EOF for flow {eof_key} ({self._eofs_received[eof_key]}/{prev_amount})")
 
         self._eofs_received.pop(eof_key)
+        self._watermarks.pop(flow_id)
 
         return self.handle_eof(flow_id, message)
+
+    def handle_watermark(self, flow_id: str, message: Watermark) -> OutgoingMessages:
+        """
+        Called when the watermark of the flow moves. Filters holding data by day may emit what can no longer change.
+        """
+        return OutgoingMessages({
+            self.router.publish(): message
+        })
+
+    def handle_watermark_message(self, flow_id: str, sender_id: str, message: Watermark) -> OutgoingMessages:
+        day = self._watermarks.update(flow_id, sender_id, message.day, MEMBERSHIP.amount(PREV, PREV_AMOUNT))
+        if day is None:
+            return OutgoingMessages({})
+        return self.handle_watermark(flow_id, Watermark(day))
@@ -0,0 +1,32 @@
+from typing import Dict, List, Optional
+
+from common.basic_classes.basic_operator import BasicOperator
+from common.basic_classes.basic_stateful_filter import BasicStatefulFilter
+from common.components.message_sender import OutgoingMessages
+from common.packets.eof import Eof
+from common.packets.watermark import Watermark
+
+
+class OperatorFilter(BasicStatefulFilter):
+    """
+    Runs a stateless operator in its own container.
+    """
+
+    def __init__(self, operator: BasicOperator):
+        self._operator = operator
+        super().__init__()
+
+    def handle_chunk(self, flow_id, chunk: List[bytes]) -> OutgoingMessages:
+        return self._operator.handle_chunk(flow_id, chunk)
+
+    def combine_chunk(self, flow_id, chunk: List[bytes]) -> Optional[OutgoingMessages]:
+        return self._operator.combine_chunk(flow_id, chunk)
+
+    def handle_message(self, flow_id, message: bytes) -> Dict[str, List[bytes]]:
+        return self._operator.handle_message(flow_id, message)
+
+    def handle_eof(self, flow_id: str, message: Eof) -> OutgoingMessages:
+        return self._operator.handle_eof(flow_id, message)
+
+    def handle_watermark(self, flow_id: str, message: Watermark) -> OutgoingMessages:
+        return self._operator.handle_watermark(flow_id, message)
@@ -0,0 +1,86 @@
+import importlib
+import logging
+import os
+from typing import Dict, Optional, Union, List
+
+from common.basic_classes.basic_operator import BasicOperator
+from common.components.message_sender import OutgoingMessages
+from common.packets.eof import Eof
+from common.packets.watermark import Watermark
+
+FUSED = os.environ.get("FUSED", "")
+
+
+class Fusion:
+    """
+    Runs the stateless steps fused into this container in-process.
+
+    Whatever the container would send to a fused step is handed to its operator instead, so
+    messages only cross the broker once they are routed to a step that keeps state. The output
+    still goes through the container's MessageSender, so receivers deduplicate it and count its
+    EOFs as coming from this container.
+    """
+
+    def __init__(self, fused: str = FUSED):
+        self._operators: Dict[str, BasicOperator] = {}
+        self._combine: Dict[str, bool] = {}
+        # [queue or routing key]: fused step, or None if it is not fused
+        self._steps: Dict[str, Optional[str]] = {}
+
+        for step in [step for step in fused.split(",") if step]:
+            prefix = f"{step.upper()}_"
+            module = importlib.import_module(f"common.operators.{step}")
+            self._operators[step] = module.OPERATOR.from_env(prefix)
+            self._combine[step] = os.environ.get(f"{prefix}COMBINE", "false").lower() == "true"
+            logging.info(f"action: fuse_step | result: success | step: {step}")
+
+    def __find_step(self, queue: str) -> Optional[str]:
+        if queue not in self._steps:
+            if queue.startswith("publish_"):
+                name = queue[len("publish_"):]
+            else:
+                name = queue.rsplit("_", 1)[0]
+            self._steps[queue] = name if name in self._operators else None
+        return self._steps[queue]
+
+    def __run_step(self, step: str, flow_id: str, messages_or_eof: Union[List[bytes], Eof]) -> OutgoingMessages:
+        operator = self._operators[step]
+        if isinstance(messages_or_eof, Eof):
+            return operator.handle_eof(flow_id, messages_or_eof)
+        if isinstance(messages_or_eof, Watermark):
+            return operator.handle_watermark(flow_id, messages_or_eof)
+
+        outgoing_messages = None
+        if self._combine[step]:
+            outgoing_messages = operator.combine_chunk(flow_id, messages_or_eof)
+        if outgoing_messages is None:
+            outgoing_messages = operator.handle_chunk(flow_id, messages_or_eof)
+        return outgoing_messages
+
+    def apply(self, flow_id: str, outgoing_messages: OutgoingMessages) -> OutgoingMessages:
+        """
+        Replaces the messages for fused steps with the output of their operators.
+        """
+        if len(self._operators) == 0:
+            return outgoing_messages
+
+        output = {}
+        for (queue, messages_or_eof) in outgoing_messages.items():
+            step = self.__find_step(queue)
+            if step is None:
+                self.__add(output, queue, messages_or_eof)
+                continue
+
+            # A fused step may send to another fused step
+            step_output = self.apply(flow_id, self.__run_step(step, flow_id, messages_or_eof))
+            for (step_queue, step_messages_or_eof) in step_output.items():
+                self.__add(output, step_queue, step_messages_or_eof)
+
+        return OutgoingMessages(output)
+
+    @staticmethod
+    def __add(output: dict, queue: str, messages_or_eof: Union[List[bytes], Eof]):
+        if isinstance(messages_or_eof, (Eof, Watermark)) or queue not in output:
+            output[queue] = messages_or_eof
+        else:
+            output[queue] = output[queue] + messages_or_eof
@@ -0,0 +1,121 @@
+import logging
+import os
+from typing import Any, Dict, Optional
+
+HOT_KEY_WINDOW = int(os.environ.get("HOT_KEY_WINDOW", "10000"))
+# A key is hot when it takes at least this fraction of the messages a replica should get
+HOT_KEY_LOAD = float(os.environ.get("HOT_KEY_LOAD", "0.5"))
+SKEW_REPORT = os.environ.get("SKEW_REPORT", "false").lower() == "true"
+SKEW_REPORT_TOP_KEYS = 3
+# Stages that merge the partial results of a key, the only ones hot keys may be split into
+MERGING_STAGES = {"trips_counter", "trip_count_provider", "dist_mean_calculator", "dist_mean_provider"}
+
+# [edge]: tracker, shared by every router of the process that sends through the edge
+_trackers: Dict[str, "KeyLoadTracker"] = {}
+
+
+class KeyLoadTracker:
+    """
+    Counts the messages routed through an edge per key, over tumbling windows of `window` messages.
+    Keys that were hot in the last window are spread over `split` consecutive replicas in round robin,
+    so the next stage must be able to merge the partial results of a key.
+
+    Routing depends on this state, so it is saved with the state of the container: a replayed
+    message has to go to the same replica it went the first time.
+    """
+
+    def __init__(self, edge: str, amount: int, split: int,
+                 window: int = HOT_KEY_WINDOW, hot_load: float = HOT_KEY_LOAD):
+        self._edge = edge
+        self._amount = amount
+        self._split = split
+        self._window = window
+        self._hot_count = max(1, int(hot_load * window / amount))
+        self._routed = 0
+        self._counts: Dict[Any, int] = {}
+        self._replica_loads = [0] * amount
+        # [hot key]: offset of the replica its next message goes to
+        self._hot: Dict[Any, int] = {}
+
+    def route(self, key: Any, queue_num: int, amount: int) -> int:
+        """
+        Returns the replica a message goes to, given the replica its key hashes to among `amount`.
+        """
+        offset = self._hot.get(key)
+        if offset is not None:
+            self._hot[key] = (offset + 1) % min(self._split, amount)
+            queue_num = (queue_num + offset) % amount
+
+        self._counts[key] = self._counts.get(key, 0) + 1
+        if queue_num >= len(self._replica_loads):
+            # The membership of the flow has more replicas than the deployment
+            self._replica_loads.extend([0] * (queue_num + 1 - len(self._replica_loads)))
+        self._replica_loads[queue_num] += 1
+        self._routed += 1
+        if self._routed >= self._window:
+            self.__close_window()
+        return queue_num
+
+    def __close_window(self):
+        if SKEW_REPORT:
+            self.__report()
+
+        if self._split > 1:
+            hot_keys = [key for key, count in self._counts.items() if count >= self._hot_count]
+            if set(hot_keys) != set(self._hot.keys()):
+                logging.info(f"action: hot_keys | edge: {self._edge} | keys: {hot_keys}")
+            self._hot = {key: self._hot.get(key, 0) for key in hot_keys}
+
+        self._routed = 0
+        self._counts = {}
+        self._replica_loads = [0] * self._amount
+
+    def __report(self):
+        mean_load = self._routed / len(self._replica_loads)
+        top_keys = sorted(self._counts.items(), key=lambda item: item[1], reverse=True)[:SKEW_REPORT_TOP_KEYS]
+        top_keys = ", ".join(f"{key} ({count / self._routed:.1%})" for key, count in top_keys)
+        logging.info(f"action: key_skew | edge: {self._edge} | messages: {self._routed} | "
+                     f"keys: {len(self._counts)} | replica_loads: {self._replica_loads} | "
+                     f"imbalance: {max(self._replica_loads) / mean_load:.2f} | top_keys: {top_keys} | "
+                     f"hot_keys: {len(self._hot)}")
+
+    def get_state(self) -> dict:
+        # Keys may be ints, so dicts are saved as pairs to survive JSON
+        return {
+            "routed": self._routed,
+            "counts": list(self._counts.items()),
+            "replica_loads": self._replica_loads,
+            "hot": list(self._hot.items()),
+        }
+
+    def set_state(self, state: dict):
+        self._routed = state["routed"]
+        self._counts = {key: count for key, count in state["counts"]}
+        self._replica_loads = state["replica_loads"]
+        self._hot = {key: offset for key, offset in state["hot"]}
+
+
+def tracker_for_edge(edge: str, amount: Optional[int], split: int) -> Optional[KeyLoadTracker]:
+    """
+    Returns the tracker of the edge, or None if nothing has to be tracked on it.
+    """
+    if split > 1 and edge not in MERGING_STAGES:
+        raise ValueError(f"Hot keys can not be split into {edge}, it does not merge partial results")
+    if amount is None or amount <= 1 or (split <= 1 and not SKEW_REPORT):
+        return None
+    tracker = _trackers.get(edge)
+    if tracker is None:
+        tracker = _trackers[edge] = KeyLoadTracker(edge, amount, split)
+    return tracker
+
+
+def get_state() -> Dict[str, dict]:
+    return {edge: tracker.get_state() for edge, tracker in _trackers.items()}
+
+
+def set_state(state: Dict[str, dict]):
+    for edge, tracker_state in state.items():
+        # Edges no longer tracked are ignored
+        if edge in _trackers:
+            _trackers[edge].set_state(tracker_state)
+
@@ -1,40 +1,95 @@
-from typing import Optional, List, Dict, Union
+from typing import List, Dict
 
 from common.packets.generic_packet import GenericPacket
 from common.utils import min_hash, log_duplicate, trace
 
+DEDUP_WINDOW_SIZE = 2 ** 10
+
+
+class SequenceWindow:
+    """
+    Remembers which of the last `size` sequence numbers of a stream were received.
+    Bit i of the bitmap is set if `highest - i` was received.
+    """
+
+    def __init__(self, size: int = DEDUP_WINDOW_SIZE):
+        self._size = size
+        self._mask = (1 << size) - 1
+        self._highest = 0
+        self._bitmap = 0
+
+    def add(self, seq_number: int) -> bool:
+        """
+        Marks the sequence number as received.
+        Returns False if it was already received (or is too old to tell).
+        """
+        if seq_number > self._highest:
+            self._bitmap = ((self._bitmap << (seq_number - self._highest)) | 1) & self._mask
+            self._highest = seq_number
+            return True
+
+        offset = self._highest - seq_number
+        if offset >= self._size:
+            return False
+
+        bit = 1 << offset
+        if self._bitmap & bit:
+            return False
+        self._bitmap |= bit
+        return True
+
+    def get_state(self) -> List[int]:
+        return [self._highest, self._bitmap]
+
+    def set_state(self, state: List[int]):
+        self._highest, self._bitmap = state
+
 
 class MultiLastReceivedManager:
-    def __init__(self):
-        self._last_received: Dict[str, List[Optional[str]]] = {}
+    def __init__(self, window_size: int = DEDUP_WINDOW_SIZE):
+        self._window_size = window_size
+        # [sender_id]: [direct stream window, publish stream window]
+        self._windows: Dict[str, List[SequenceWindow]] = {}
+
+    def mark_received(self, sender_id: str, seq_number: int) -> bool:
+        """
+        Records the sequence number as received from the sender.
+        Returns False if it had already been received.
+        """
+        windows = self._windows.get(sender_id)
+        if windows is None:
+            windows = [SequenceWindow(self._window_size), SequenceWindow(self._window_size)]
+            self._windows[sender_id] = windows
+
+        # Published messages use negative sequence numbers, so each sender has two independent streams
+        if seq_number < 0:
+            return windows[1].add(-seq_number)
+        return windows[0].add(seq_number)
 
     def update(self, packet: GenericPacket) -> bool:
         sender_id = packet.sender_id
+        seq_number = packet.seq_number
+
+        if not self.mark_received(sender_id, seq_number):
+            log_duplicate("Received duplicate %s %s-%s-%d-%s - ignoring",
+                          "EOF" if packet.is_eof() else "chunk", sender_id,
+                          packet.get_flow_id(), seq_number, min_hash(packet.data))
+            return False
 
-        current_id = packet.get_id()
-        self._last_received.setdefault(sender_id, [None, None])
-        last_chunk_id, last_eof_id = self._last_received[sender_id]
-
-        if packet.is_eof():
-            if current_id == last_eof_id:
-                log_duplicate(
-                    f"Received duplicate EOF {sender_id}-{current_id}-{min_hash(packet.data)} - ignoring")
-                return False
-            self._last_received[sender_id][1] = current_id
-        elif packet.is_chunk():
-            if current_id == last_chunk_id:
-                log_duplicate(
-                    f"Received duplicate chunk {sender_id}-{current_id}-{min_hash(packet.data)} - ignoring")
-                return False
-            self._last_received[sender_id][0] = current_id
-
-        trace(
-            f"Received {sender_id}-{current_id}-{min_hash(packet.data)}")
+        trace("Received %s-%d-%s", sender_id, seq_number, min_hash(packet.data))
 
         return True
 
     def get_state(self) -> dict:
-        return self._last_received
+        return {
+            sender_id: [window.get_state() for window in windows]
+            for sender_id, windows in self._windows.items()
+        }
 
     def set_state(self, state: dict):
-        self._last_received = state
+        self._windows = {}
+        for sender_id, windows_state in state.items():
+            windows = [SequenceWindow(self._window_size), SequenceWindow(self._window_size)]
+            for window, window_state in zip(windows, windows_state):
+                window.set_state(window_state)
+            self._windows[sender_id] = windows
@@ -0,0 +1,88 @@
+import json
+import logging
+import os
+from typing import Dict, Optional
+
+from common.utils import fsync_directory
+
+MEMBERSHIP_DIRECTORY = os.environ.get("MEMBERSHIP_DIRECTORY")
+EPOCH_FILE_PREFIX = "epoch_"
+READY_DIRECTORY = "ready"
+
+
+class Membership:
+    """
+    Versioned replica counts of the elastic stages, read from a directory shared by every container.
+
+    Epoch 0 is the deployment itself (NEXT_AMOUNT, PREV_AMOUNT...). Each scale out writes the next
+    `epoch_<n>.json` with the amounts of every stage that changed so far, and files are never modified,
+    so any container can look up any epoch at any time and always get the same answer.
+
+    The gateway pins every flow to the latest epoch when it starts and the epoch travels with its packets,
+    so the whole flow is routed with the same replica counts and its keyed state never moves.
+    """
+
+    def __init__(self, directory: Optional[str]):
+        self._directory = directory
+        # [epoch]: [stage]: amount
+        self._epochs: Dict[int, Dict[str, int]] = {0: {}}
+        self._latest = 0
+        self._epoch = 0
+
+    def __epoch_path(self, epoch: int) -> str:
+        return os.path.join(self._directory, f"{EPOCH_FILE_PREFIX}{epoch}.json")
+
+    def __load(self, epoch: int) -> Dict[str, int]:
+        amounts = self._epochs.get(epoch)
+        if amounts is None:
+            with open(self.__epoch_path(epoch), "r") as f:
+                amounts = self._epochs[epoch] = json.load(f)["amounts"]
+            logging.info(f"action: load_membership | epoch: {epoch} | amounts: {amounts}")
+        return amounts
+
+    def latest(self) -> int:
+        """
+        Returns the newest epoch written so far.
+        """
+        if self._directory is None:
+            return 0
+        while os.path.exists(self.__epoch_path(self._latest + 1)):
+            self._latest += 1
+            self.__load(self._latest)
+        return self._latest
+
+    def enter(self, epoch: int):
+        """
+        Sets the epoch of the flow being handled, routing and EOF counts follow it.
+        """
+        self._epoch = epoch
+
+    def amount(self, stage: Optional[str], default: Optional[int]) -> Optional[int]:
+        if self._epoch == 0 or default is None:
+            return default
+        return self.__load(self._epoch).get(stage, default)
+
+    def is_member(self, container_id: str, stage: str, default: Optional[int]) -> bool:
+        """
+        Replicas added after a flow started do not take part in it, they drop its EOFs instead of forwarding them.
+        """
+        amount = self.amount(stage, default)
+        replica = container_id.rsplit("_", 1)[-1]
+        if amount is None or not replica.isdigit():
+            return True
+        return int(replica) < amount
+
+    def mark_ready(self, container_id: str):
+        """
+        Tells the scaler the container is consuming, so flows of the next epoch can be routed to it.
+        """
+        if self._directory is None:
+            return
+        ready_directory = os.path.join(self._directory, READY_DIRECTORY)
+        os.makedirs(ready_directory, exist_ok=True)
+        with open(os.path.join(ready_directory, container_id), "w"):
+            pass
+        fsync_directory(ready_directory)
+
+
+MEMBERSHIP = Membership(MEMBERSHIP_DIRECTORY)
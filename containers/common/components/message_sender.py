@@ -4,13 +4,12 @@ from typing import Dict, Union, List
 
 from common.packets.eof import Eof
 from common.packets.generic_packet import GenericPacketBuilder
+from common.packets.watermark import Watermark
 from common.middleware.rabbit_middleware import Rabbit
-from common.utils import min_hash, log_msg
-
-MAX_SEQ_NUMBER = 2 ** 9
+from common.utils import min_hash
 
 MessageData = typing.NewType("MessageData", bytes)
-MessageContent = typing.NewType("MessageContent", Union[List[MessageData], Eof])
+MessageContent = typing.NewType("MessageContent", Union[List[MessageData], Eof, Watermark])
 QueueOrRoutingKey = typing.NewType("QueueOrRoutingKey", str)
 OutgoingMessages = typing.NewType("OutgoingMessages", Dict[QueueOrRoutingKey, MessageContent])
 
@@ -20,41 +19,30 @@ class MessageSender:
         self._last_seq_number: Dict[str, int] = {}
         self._rabbit = middleware
 
-        self._times_maxed_seq = 0
-
     def __get_next_seq_number(self, queue: str) -> int:
-        self._last_seq_number.setdefault(queue, 0)
-        self._last_seq_number[queue] += 1
-
-        if self._last_seq_number[queue] > MAX_SEQ_NUMBER:
-            self._last_seq_number[queue] = 1
-            self._times_maxed_seq += 1
-            log_msg("Generated %d packets [%d]", MAX_SEQ_NUMBER, self._times_maxed_seq)
-
-        return self._last_seq_number[queue]
+        # Sequence numbers never wrap, receivers deduplicate over a sliding window
+        seq_number = self._last_seq_number.get(queue, 0) + 1
+        self._last_seq_number[queue] = seq_number
+        return seq_number
 
     def __get_next_publish_seq_number(self, queue: str) -> int:
-        self._last_seq_number.setdefault(queue, -1)
-        self._last_seq_number[queue] -= 1
-
-        if self._last_seq_number[queue] < -MAX_SEQ_NUMBER:
-            self._last_seq_number[queue] = -1
-            self._times_maxed_seq += 1
-            log_msg("Generated %d packets [%d]", MAX_SEQ_NUMBER, self._times_maxed_seq)
-
-        return self._last_seq_number[queue]
+        # Published messages count downwards, so they never collide with direct ones
+        seq_number = self._last_seq_number.get(queue, 0) - 1
+        self._last_seq_number[queue] = seq_number
+        return seq_number
 
     def send(self, builder: GenericPacketBuilder, outgoing_messages: OutgoingMessages,
              skip_send=False):
         for (queue, messages_or_eof) in outgoing_messages.items():
-            if isinstance(messages_or_eof, Eof) or len(messages_or_eof) > 0:
+            if isinstance(messages_or_eof, (Eof, Watermark)) or len(messages_or_eof) > 0:
                 if queue.startswith("publish_"):
-                    queue = queue[len("publish_"):]
+                    # The counter keeps the prefix, a routing key may share its name with a direct queue
                     encoded = builder.build(self.__get_next_publish_seq_number(queue), messages_or_eof).encode()
+                    routing_key = queue[len("publish_"):]
                     if not skip_send:
                         logging.debug(
-                            f"Sending {builder.get_id()}-{min_hash(messages_or_eof)} to {queue}")
-                        self._rabbit.send_to_route("publish", queue, encoded)
+                            f"Sending {builder.get_id()}-{min_hash(messages_or_eof)} to {routing_key}")
+                        self._rabbit.send_to_route("publish", routing_key, encoded)
                 else:
                     encoded = builder.build(self.__get_next_seq_number(queue), messages_or_eof).encode()
                     if not skip_send:
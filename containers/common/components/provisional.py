@@ -0,0 +1,37 @@
+import os
+from typing import Dict
+
+# Emits provisional results every this many messages of a flow, 0 disables them
+PROVISIONAL_EVERY = int(os.environ.get("PROVISIONAL_EVERY", "0"))
+
+
+class ProvisionalTrigger:
+    """
+    Counts the messages handled for each flow and fires once every `every` of them.
+
+    It counts messages instead of measuring time so that a replayed message fires exactly as it did
+    the first time, and the sequence numbers of what follows stay the same.
+    """
+
+    def __init__(self, every: int = PROVISIONAL_EVERY):
+        self._every = every
+        self._counts: Dict[str, int] = {}
+
+    def tick(self, flow_id: str) -> bool:
+        if self._every <= 0:
+            return False
+        count = self._counts.get(flow_id, 0) + 1
+        if count < self._every:
+            self._counts[flow_id] = count
+            return False
+        self._counts[flow_id] = 0
+        return True
+
+    def pop(self, flow_id: str):
+        self._counts.pop(flow_id, None)
+
+    def get_state(self) -> Dict[str, int]:
+        return self._counts
+
+    def set_state(self, state: Dict[str, int]):
+        self._counts = state
@@ -1,53 +1,60 @@
-import uuid
+import hashlib
+import logging
+import os
+import tempfile
+from array import array
 from dataclasses import dataclass
-from typing import Iterator, Union, List
+from itertools import islice
+from typing import Callable, Iterator, Union, List, TypeVar, Optional
 
 from common.packets.basic_packet import BasicPacket
 
-CHUNK_SIZE = 4096
+# Lines of a chunk, the unit the client reads, caches and resumes from. Packets group several of them
+CHUNK_SIZE = 1024
+
+
+T = TypeVar("T")
+
+# Position of the columns the queries read, any other column is skipped without being parsed
+WEATHER_DATE, WEATHER_PRECTOT = 0, 1
+# Weather rows have 20 columns, some files add a trailing one. Counted on the commas, not parsed
+WEATHER_COLUMNS = (20, 21)
+TRIP_START_DATETIME, TRIP_START_STATION_CODE, TRIP_END_STATION_CODE, TRIP_DURATION_SEC, TRIP_YEARID = 0, 1, 3, 4, 6
+STATION_CODE, STATION_NAME, STATION_LATITUDE, STATION_LONGITUDE, STATION_YEARID = 0, 1, 2, 3, 4
 
 
 @dataclass
 class WeatherInfo(BasicPacket):
-    packet_id: str
     city_name: str
     date: str
     prectot: float
-    qv2m: float
-    rh2m: float
-    ps: float
-    t2m_range: float
-    ts: float
-    t2mdew: float
-    t2mwet: float
-    t2m_max: float
-    t2m_min: float
-    t2m: float
-    ws50m_range: float
-    ws10m_range: float
-    ws50m_min: float
-    ws10m_min: float
-    ws50m_max: float
-    ws10m_max: float
-    ws50m: float
-    ws10m: float
+
+    @staticmethod
+    def __check_shape(csv_line: str):
+        if csv_line.count(",") + 1 not in WEATHER_COLUMNS:
+            raise ValueError(f"Weather rows must have {' or '.join(map(str, WEATHER_COLUMNS))} columns: {csv_line!r}")
 
     @staticmethod
     def from_csv(city_name: str, csv_line: str) -> "WeatherInfo":
-        packet_id = uuid.uuid4()
-        line_data = csv_line.strip().split(",")
-        date = line_data[0]
-        if len(line_data) == 21:
-            line_data = [float(data) for data in line_data[1:-1]]
-        else:
-            line_data = [float(data) for data in line_data[1:]]
+        csv_line = csv_line.strip()
+        WeatherInfo.__check_shape(csv_line)
+        # Only the leading columns are split, the rest of the line is never looked at
+        line_data = csv_line.split(",", WEATHER_PRECTOT + 1)
+        date = line_data[WEATHER_DATE]
+        prectot = float(line_data[WEATHER_PRECTOT])
 
-        return WeatherInfo(str(packet_id), city_name, date, *line_data)
+        return WeatherInfo(city_name, date, prectot)
+
+    @staticmethod
+    def from_csv_block(city_name: str, csv_lines: List[str]) -> List["WeatherInfo"]:
+        for line in csv_lines:
+            WeatherInfo.__check_shape(line)
+        rows = [line.split(",", WEATHER_PRECTOT + 1) for line in csv_lines]
+        return [WeatherInfo(city_name, row[WEATHER_DATE], float(row[WEATHER_PRECTOT])) for row in rows]
 
 
 @dataclass
 class StationInfo(BasicPacket):
-    packet_id: str
     city_name: str
     code: int
     name: str
@@ -57,7 +64,6 @@ class StationInfo(BasicPacket):
 
     @staticmethod
     def from_csv(city_name: str, csv_line: str) -> "StationInfo":
-        packet_id = uuid.uuid4()
         line_data = csv_line.strip().split(",")
         code = int(line_data[0])
         name = line_data[1]
@@ -65,7 +71,6 @@ class StationInfo(BasicPacket):
         longitude = float(line_data[3]) if line_data[3] != "" else None
         yearid = int(line_data[4])
         return StationInfo(
-            str(packet_id),
             city_name,
             code,
             name,
@@ -74,42 +79,59 @@ class StationInfo(BasicPacket):
             yearid
         )
 
+    @staticmethod
+    def from_csv_block(city_name: str, csv_lines: List[str]) -> List["StationInfo"]:
+        rows = [line.split(",", STATION_YEARID + 1) for line in csv_lines]
+        return [
+            StationInfo(
+                city_name,
+                int(row[STATION_CODE]),
+                row[STATION_NAME],
+                float(row[STATION_LATITUDE]) if row[STATION_LATITUDE] != "" else None,
+                float(row[STATION_LONGITUDE]) if row[STATION_LONGITUDE] != "" else None,
+                int(row[STATION_YEARID])
+            )
+            for row in rows
+        ]
+
 
 @dataclass
 class TripInfo(BasicPacket):
-    trip_id: str
     city_name: str
     start_datetime: str
     start_station_code: int
-    end_datetime: str
     end_station_code: int
     duration_sec: float
-    is_member: bool
     yearid: int
 
     @staticmethod
     def from_csv(city_name: str, csv_line: str) -> "TripInfo":
-        trip_id = uuid.uuid4()
         line_data = csv_line.strip().split(",")
-        start_datetime = line_data[0]
-        start_station_code = int(line_data[1])
-        end_datetime = line_data[2]
-        end_station_code = int(line_data[3])
-        duration_sec = float(line_data[4])
-        is_member = bool(line_data[5])
-        yearid = int(line_data[6])
         return TripInfo(
-            str(trip_id),
             city_name,
-            start_datetime,
-            start_station_code,
-            end_datetime,
-            end_station_code,
-            duration_sec,
-            is_member,
-            yearid
+            line_data[TRIP_START_DATETIME],
+            int(line_data[TRIP_START_STATION_CODE]),
+            int(line_data[TRIP_END_STATION_CODE]),
+            float(line_data[TRIP_DURATION_SEC]),
+            int(line_data[TRIP_YEARID])
         )
 
+    @staticmethod
+    def from_csv_block(city_name: str, csv_lines: List[str]) -> List["TripInfo"]:
+        # Only the columns up to the yearid are split, the rest of the line is never looked at
+        rows = [line.split(",", TRIP_YEARID + 1) for line in csv_lines]
+        return [
+            TripInfo(
+                city_name,
+                row[TRIP_START_DATETIME],
+                int(row[TRIP_START_STATION_CODE]),
+                int(row[TRIP_END_STATION_CODE]),
+                float(row[TRIP_DURATION_SEC]),
+                int(row[TRIP_YEARID])
+            )
+            for row in rows
+        ]
+
 
 @dataclass
 class ClientIdResponsePacket(BasicPacket):
@@ -122,76 +144,128 @@ class ClientGatewayPacket(BasicPacket):
     data: Union[List[WeatherInfo], List[StationInfo], List[TripInfo]]
 
 
-class WeatherReader:
-    def __init__(self, data_folder_path: str, city: str):
-        self._data_folder_path = data_folder_path
-        self._city = city
+class CsvReader:
+    """
+    Reads a CSV of a city in blocks of CHUNK_SIZE lines. Each block is parsed in a single pass with
+    no per-line error handling, and only a block with a malformed line is parsed again line by line
+    to skip it.
 
-    def __weather_path(self) -> str:
-        return f"{self._data_folder_path}/{self._city}/weather.csv"
+    With an index directory, a read from the start of the file saves the byte offset of the block of
+    each chunk, so a later read can start from any chunk by seeking to it.
+    """
 
-    def next_data(self) -> Iterator[List[WeatherInfo]]:
-        with open(self.__weather_path()) as f:
-            _ = f.readline()
-            weather_info_list = []
-            for line in f:
-                try:
-                    weather_info = WeatherInfo.from_csv(self._city, line)
-                except ValueError as e:
-                    continue
-                weather_info_list.append(weather_info)
-                if len(weather_info_list) == CHUNK_SIZE:
-                    yield weather_info_list
-                    weather_info_list = []
-            if len(weather_info_list) > 0:
-                yield weather_info_list
-
-
-class StationReader:
-    def __init__(self, data_folder_path: str, city: str):
-        self._data_folder_path = data_folder_path
+    def __init__(self, data_folder_path: str, city: str, file_name: str,
+                 parse_block: Callable[[str, List[str]], List[T]], parse_line: Callable[[str, str], T],
+                 index_directory: Optional[str] = None):
+        self._path = f"{data_folder_path}/{city}/{file_name}"
         self._city = city
+        self._parse_block = parse_block
+        self._parse_line = parse_line
+        self._index_directory = index_directory
 
-    def __station_path(self) -> str:
-        return f"{self._data_folder_path}/{self._city}/stations.csv"
+    @property
+    def path(self) -> str:
+        return self._path
 
-    def next_data(self) -> Iterator[List[StationInfo]]:
-        with open(self.__station_path()) as f:
-            _ = f.readline()
-            station_info_list = []
-            for line in f:
-                try:
-                    station_info = StationInfo.from_csv(self._city, line)
-                except ValueError as e:
-                    continue
-                station_info_list.append(station_info)
-                if len(station_info_list) == CHUNK_SIZE:
-                    yield station_info_list
-                    station_info_list = []
-            if len(station_info_list) > 0:
-                yield station_info_list
-
-
-class TripReader:
-    def __init__(self, data_folder_path: str, city: str):
-        self._data_folder_path = data_folder_path
-        self._city = city
+    def __parse_lines(self, lines: List[str]) -> List[T]:
+        parsed = []
+        for line in lines:
+            try:
+                parsed.append(self._parse_line(self._city, line))
+            except (ValueError, IndexError):
+                continue
+        return parsed
+
+    def __index_path(self) -> str:
+        stat = os.stat(self._path)
+        key = f"{os.path.abspath(self._path)}|{stat.st_size}|{stat.st_mtime_ns}|{CHUNK_SIZE}"
+        return os.path.join(self._index_directory, hashlib.sha1(key.encode()).hexdigest() + ".idx")
+
+    def __save_index(self, offsets: array):
+        os.makedirs(self._index_directory, exist_ok=True)
+        # Clients reading the same CSV write its index at once, and all of them run as PID 1
+        fd, tmp_path = tempfile.mkstemp(dir=self._index_directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            offsets.tofile(f)
+        os.rename(tmp_path, self.__index_path())
 
-    def __station_path(self) -> str:
-        return f"{self._data_folder_path}/{self._city}/trips.csv"
+    def __load_index(self) -> Optional[array]:
+        index_path = self.__index_path()
+        if not os.path.exists(index_path):
+            return None
+        with open(index_path, "rb") as f:
+            content = f.read()
+        offsets = array("Q")
+        if len(content) % offsets.itemsize != 0:
+            return None
+        offsets.frombytes(content)
+        if any(offsets[i] >= offsets[i + 1] for i in range(len(offsets) - 1)):
+            return None
+        return offsets
 
-    def next_data(self) -> Iterator[List[TripInfo]]:
-        with open(self.__station_path()) as f:
-            _ = f.readline()
-            trip_info_list = []
-            for line in f:
+    def __chunk_offsets(self) -> array:
+        offsets = self.__load_index()
+        if offsets is None:
+            # Built by reading the whole file once, still far cheaper than sending it again
+            logging.info(f"action: build_index | csv: {self._path}")
+            offsets = array("Q")
+            for _ in self.__read(offsets=offsets):
+                pass
+        return offsets
+
+    def __read(self, offset: Optional[int] = None, offsets: Optional[array] = None) -> Iterator[List[T]]:
+        # Read as bytes so the offset of each block is known, lines are decoded one by one as text mode would
+        from_start = offset is None
+        if offsets is None:
+            offsets = array("Q")
+        with open(self._path, "rb") as f:
+            if from_start:
+                offset = len(f.readline())
+            else:
+                f.seek(offset)
+            while True:
+                block = list(islice(f, CHUNK_SIZE))
+                if len(block) == 0:
+                    break
+                lines = [line.decode() for line in block]
                 try:
-                    trip_info = TripInfo.from_csv(self._city, line)
-                except ValueError as e:
-                    continue
-                trip_info_list.append(trip_info)
-                if len(trip_info_list) == CHUNK_SIZE:
-                    yield trip_info_list
-                    trip_info_list = []
-            if len(trip_info_list) > 0:
-                yield trip_info_list
+                    parsed = self._parse_block(self._city, lines)
+                except (ValueError, IndexError):
+                    parsed = self.__parse_lines(lines)
+                if len(parsed) > 0:
+                    offsets.append(offset)
+                    yield parsed
+                offset += sum(map(len, block))
+
+        if from_start and self._index_directory is not None:
+            self.__save_index(offsets)
+
+    def next_data(self, first_chunk: int = 0) -> Iterator[List[T]]:
+        """
+        Chunks of the file, skipping the first `first_chunk` of them.
+        """
+        if first_chunk == 0 or self._index_directory is None:
+            yield from islice(self.__read(), first_chunk, None)
+            return
+
+        offsets = self.__chunk_offsets()
+        if first_chunk < len(offsets):
+            yield from self.__read(offsets[first_chunk])
+
+
+class WeatherReader(CsvReader):
+    def __init__(self, data_folder_path: str, city: str, index_directory: Optional[str] = None):
+        super().__init__(data_folder_path, city, "weather.csv", WeatherInfo.from_csv_block, WeatherInfo.from_csv,
+                         index_directory)
+
+
+class StationReader(CsvReader):
+    def __init__(self, data_folder_path: str, city: str, index_directory: Optional[str] = None):
+        super().__init__(data_folder_path, city, "stations.csv", StationInfo.from_csv_block, StationInfo.from_csv,
+                         index_directory)
+
+
+class TripReader(CsvReader):
+    def __init__(self, data_folder_path: str, city: str, index_directory: Optional[str] = None):
+        super().__init__(data_folder_path, city, "trips.csv", TripInfo.from_csv_block, TripInfo.from_csv,
+                         index_directory)
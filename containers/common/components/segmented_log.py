@@ -0,0 +1,254 @@
+import logging
+import os
+import queue
+import re
+import threading
+from typing import Callable, List, Tuple
+
+from common.utils import fsync_directory
+
+ENVIRONMENT = os.environ.get("ENVIRONMENT", "dev")
+SEGMENT_SIZE = int(os.environ.get("WAL_SEGMENT_SIZE", 16 * 1024 * 1024))
+PREALLOCATE = os.environ.get("WAL_PREALLOCATE", "true").lower() == "true"
+SPARE_SEGMENTS = int(os.environ.get("WAL_SPARE_SEGMENTS", 2))
+COLUMN_PARTITION_SIZE = 1024
+SEGMENT_INDEX_DIGITS = 8
+
+LogPosition = Tuple[int, int]  # (segment, offset)
+
+
+class SegmentedLog:
+    """
+    Append-only write ahead log split in fixed size segments.
+
+    Segments are preallocated so appends only need an fdatasync, and are rotated once
+    they are full. Segments older than the last durable snapshot are released and
+    recycled (or deleted) by a background thread, so the hot path never creates or
+    removes files.
+    """
+
+    def __init__(self, directory: str, name: str, segment_size: int = SEGMENT_SIZE,
+                 preallocate: bool = PREALLOCATE, spare_segments: int = SPARE_SEGMENTS):
+        self._directory = directory
+        self._name = name
+        self._segment_size = segment_size
+        self._preallocate = preallocate
+        self._spare_segments = spare_segments
+
+        self._segment_pattern = re.compile(rf"^{re.escape(name)}\.(\d{{{SEGMENT_INDEX_DIGITS}}})$")
+        self._spare_pattern = re.compile(rf"^{re.escape(name)}\.spare\.(\d+)$")
+
+        self._segments: List[int] = []
+        self._segment = 0
+        self._offset = 0
+        self._fd = None
+
+        self._spares_lock = threading.Lock()
+        self._spares: List[str] = []
+        self._next_spare_id = 0
+        self._released = queue.Queue()
+
+        os.makedirs(self._directory, exist_ok=True)
+        self.__scan_directory()
+
+        self._cleaner = threading.Thread(target=self.__clean_released_segments, daemon=True)
+        self._cleaner.start()
+
+    def __segment_path(self, segment: int) -> str:
+        return os.path.join(self._directory, f"{self._name}.{segment:0{SEGMENT_INDEX_DIGITS}d}")
+
+    def __spare_path(self, spare_id: int) -> str:
+        return os.path.join(self._directory, f"{self._name}.spare.{spare_id}")
+
+    def __scan_directory(self):
+        spare_ids = []
+        for file_name in os.listdir(self._directory):
+            segment_match = self._segment_pattern.match(file_name)
+            if segment_match:
+                self._segments.append(int(segment_match.group(1)))
+                continue
+            spare_match = self._spare_pattern.match(file_name)
+            if spare_match:
+                spare_ids.append(int(spare_match.group(1)))
+
+        self._segments.sort()
+        self._spares = [self.__spare_path(spare_id) for spare_id in sorted(spare_ids)]
+        self._next_spare_id = max(spare_ids, default=-1) + 1
+
+    def __sync(self, fd: int):
+        if ENVIRONMENT != "dev":
+            os.fdatasync(fd)
+
+    def __allocate(self, fd: int):
+        if not self._preallocate:
+            return
+        try:
+            os.posix_fallocate(fd, 0, self._segment_size)
+        except OSError as e:
+            logging.warning(f"action: wal_preallocate | result: fail | error: {e}")
+            self._preallocate = False
+
+    def __open_segment(self, segment: int):
+        if self._fd is not None:
+            os.close(self._fd)
+
+        path = self.__segment_path(segment)
+        if segment not in self._segments:
+            with self._spares_lock:
+                spare = self._spares.pop(0) if self._spares else None
+            if spare is not None:
+                os.rename(spare, path)
+                self._fd = os.open(path, os.O_RDWR)
+            else:
+                self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+                self.__allocate(self._fd)
+            self._segments.append(segment)
+            if ENVIRONMENT != "dev":
+                fsync_directory(self._directory)
+        else:
+            self._fd = os.open(path, os.O_RDWR)
+
+        self._segment = segment
+
+    def __rotate(self):
+        logging.debug(f"action: wal_rotate | segment: {self._segment + 1}")
+        self.__open_segment(self._segment + 1)
+        self._offset = 0
+
+    @staticmethod
+    def __encode_record(msg: bytes) -> bytes:
+        columns = [msg[i:i + COLUMN_PARTITION_SIZE].hex() for i in range(0, len(msg), COLUMN_PARTITION_SIZE)]
+        return f"{len(msg)},{','.join(columns)}\n".encode()
+
+    @staticmethod
+    def __decode_record(line: bytes) -> bytes:
+        msg_size, *columns = line.decode().split(",")
+        if len(columns) == 0:
+            raise ValueError("missing payload")
+        msg = bytes.fromhex("".join(columns))
+        if int(msg_size) != len(msg):
+            raise ValueError(f"expected {msg_size} bytes, found {len(msg)}")
+        return msg
+
+    def __read_segment(self, segment: int, offset: int) -> Tuple[bytes, int]:
+        with open(self.__segment_path(segment), "rb") as f:
+            f.seek(offset)
+            content = f.read()
+        # Preallocated space reads as zeros, real data never contains them
+        data_end = content.find(b"\0")
+        if data_end != -1:
+            content = content[:data_end]
+        return content, offset + len(content)
+
+    def __replay_segment(self, segment: int, offset: int, callback: Callable[[bytes], None]) -> Tuple[int, int]:
+        content, data_end = self.__read_segment(segment, offset)
+        valid_end = offset
+        error_lines = []
+
+        lines = content.split(b"\n")
+        # The last element is either empty or a record whose write was cut short
+        for i, line in enumerate(lines[:-1]):
+            try:
+                msg = self.__decode_record(line)
+            except ValueError as e:
+                logging.warning(f"Failed to parse line {i} of segment {segment} - {e}")
+                error_lines.append(i)
+            else:
+                callback(msg)
+            valid_end += len(line) + 1
+
+        if len(lines[-1]) > 0:
+            error_lines.append(len(lines) - 1)
+
+        if len(error_lines) > 0:
+            logging.warning(f"Found {len(error_lines)}/{len(lines)} invalid lines in segment {segment} - {error_lines}")
+
+        return valid_end, data_end
+
+    def replay(self, start: LogPosition, callback: Callable[[bytes], None]):
+        """
+        Replays every record written after `start` and leaves the log ready to append
+        right after the last valid record.
+        """
+        start_segment, start_offset = start
+        self.release(start)
+
+        to_replay = [segment for segment in self._segments if segment >= start_segment]
+        valid_end, data_end = start_offset, start_offset
+        for segment in to_replay:
+            offset = start_offset if segment == start_segment else 0
+            valid_end, data_end = self.__replay_segment(segment, offset, callback)
+
+        if len(to_replay) == 0:
+            # Never write to an offset the snapshot already covers
+            self.__open_segment(start_segment if start_offset == 0 else start_segment + 1)
+            self._offset = 0
+            return
+
+        self.__open_segment(to_replay[-1])
+        self._offset = valid_end
+        if data_end > valid_end:
+            logging.info(f"Discarding {data_end - valid_end} bytes of a truncated record in segment {self._segment}")
+            os.pwrite(self._fd, b"\0" * (data_end - valid_end), valid_end)
+            self.__sync(self._fd)
+
+        logging.info(f"Replayed {len(to_replay)} log segments")
+
+    def append(self, msg: bytes):
+        record = self.__encode_record(msg)
+        if self._fd is None:
+            self.__open_segment(self._segment)
+        elif self._offset > 0 and self._offset + len(record) > self._segment_size:
+            self.__rotate()
+
+        os.pwrite(self._fd, record, self._offset)
+        self.__sync(self._fd)
+        self._offset += len(record)
+
+    def position(self) -> LogPosition:
+        return self._segment, self._offset
+
+    def release(self, position: LogPosition):
+        """
+        Marks every segment before `position` as no longer needed for recovery.
+        It must only be called once a snapshot covering `position` is durable.
+        """
+        segment = position[0]
+        while len(self._segments) > 0 and self._segments[0] < segment:
+            self._released.put(self.__segment_path(self._segments.pop(0)))
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __recycle(self, path: str) -> bool:
+        with self._spares_lock:
+            if len(self._spares) >= self._spare_segments:
+                return False
+            spare_path = self.__spare_path(self._next_spare_id)
+            self._next_spare_id += 1
+
+        fd = os.open(path, os.O_RDWR)
+        try:
+            # Old records must never be mistaken for new ones, so the file is zeroed
+            os.ftruncate(fd, 0)
+            self.__allocate(fd)
+            self.__sync(fd)
+        finally:
+            os.close(fd)
+
+        os.rename(path, spare_path)
+        with self._spares_lock:
+            self._spares.append(spare_path)
+        return True
+
+    def __clean_released_segments(self):
+        while True:
+            path = self._released.get()
+            try:
+                if not self.__recycle(path):
+                    os.remove(path)
+                logging.debug(f"action: wal_release_segment | result: success | segment: {path}")
+            except OSError as e:
+                logging.warning(f"action: wal_release_segment | result: fail | segment: {path} | error: {e}")
@@ -0,0 +1,186 @@
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+from array import array
+from typing import Dict, List, Optional, Set
+
+from common.utils import fsync_directory
+
+ENVIRONMENT = os.environ.get("ENVIRONMENT", "dev")
+SHARED_SIDE_TABLES_DIRECTORY = os.environ.get("SHARED_SIDE_TABLES_DIRECTORY")
+HEADER_SIZE = struct.Struct("<Q")
+ALIGNMENT = 8
+
+
+def _padding(size: int) -> int:
+    return -size % ALIGNMENT
+
+
+def encode_image(columns: Dict[str, array], meta: dict) -> bytes:
+    """
+    Image layout: header size, JSON header (meta and where each column is) and the
+    raw bytes of every column, each one aligned to 8 bytes.
+    """
+    offset = 0
+    layout = {}
+    for name, values in columns.items():
+        layout[name] = [values.typecode, offset, len(values)]
+        size = len(values) * values.itemsize
+        offset += size + _padding(size)
+
+    header = json.dumps({"meta": meta, "columns": layout}).encode()
+    header += b" " * _padding(HEADER_SIZE.size + len(header))
+
+    parts = [HEADER_SIZE.pack(len(header)), header]
+    for values in columns.values():
+        data = values.tobytes()
+        parts.append(data)
+        parts.append(b"\0" * _padding(len(data)))
+    return b"".join(parts)
+
+
+class SideTableImage:
+    """
+    Read-only side table mapped from a file, so every replica attached to it shares the same pages.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._views: List[memoryview] = []
+
+        (header_size,) = HEADER_SIZE.unpack_from(self._mmap, 0)
+        header = json.loads(self._mmap[HEADER_SIZE.size:HEADER_SIZE.size + header_size])
+        self.meta = header["meta"]
+        self._columns = header["columns"]
+        self._data_offset = HEADER_SIZE.size + header_size
+
+    def column(self, name: str) -> memoryview:
+        typecode, offset, length = self._columns[name]
+        start = self._data_offset + offset
+        size = length * array(typecode).itemsize
+        view = memoryview(self._mmap)[start:start + size].cast(typecode)
+        self._views.append(view)
+        return view
+
+    def close(self):
+        # The mapping can only be closed once no view points to it
+        for view in self._views:
+            view.release()
+        self._views = []
+        self._mmap.close()
+
+
+class SharedSideTables:
+    """
+    Side table images shared by the replicas of a host through a common directory.
+
+    Replicas receive the same side table rows in the same order, so they build identical
+    images. Images are named after their content: the first replica writes it and the rest
+    attach to it. Each replica holds a hard link to the images it uses, so the file lives
+    until the last one releases it.
+
+    Only the sealed state is shared: until then every replica ingests and logs the rows on its own.
+    """
+
+    def __init__(self, directory: str, container_id: str):
+        self._directory = directory
+        self._container_id = container_id
+        self._suffix = f".{container_id}"
+        self._attached: Set[str] = set()
+        self._pending_release: List[str] = []
+        os.makedirs(self._directory, exist_ok=True)
+
+    @staticmethod
+    def from_env(container_id: str) -> Optional["SharedSideTables"]:
+        if not SHARED_SIDE_TABLES_DIRECTORY:
+            return None
+        return SharedSideTables(SHARED_SIDE_TABLES_DIRECTORY, container_id)
+
+    def __write(self, path: str, content: bytes):
+        tmp_path = f"{path}{self._suffix}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(content)
+            f.flush()
+            if ENVIRONMENT != "dev":
+                os.fsync(f.fileno())
+        try:
+            os.link(tmp_path, path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp_path)
+
+    def publish(self, flow_id: str, kind: str, columns: Dict[str, array], meta: dict) -> SideTableImage:
+        content = encode_image(columns, meta)
+        digest = hashlib.sha1(content).hexdigest()[:16]
+        file_name = f"{flow_id}.{kind}.{digest}".replace(os.sep, "_")
+        path = os.path.join(self._directory, file_name)
+        own_path = f"{path}{self._suffix}"
+
+        while not os.path.exists(own_path):
+            if not os.path.exists(path):
+                self.__write(path, content)
+            try:
+                os.link(path, own_path)
+            except FileNotFoundError:
+                # Another replica released the image in between, write it again
+                continue
+            except FileExistsError:
+                pass
+        if ENVIRONMENT != "dev":
+            fsync_directory(self._directory)
+
+        logging.debug(f"action: publish_side_table | result: success | image: {own_path}")
+        return self.attach(own_path)
+
+    def attach(self, path: str) -> SideTableImage:
+        if path in self._pending_release:
+            self._pending_release.remove(path)
+        self._attached.add(path)
+        return SideTableImage(path)
+
+    def release(self, image: SideTableImage):
+        """
+        Detaches from the image. The file is removed after the next checkpoint, which no
+        longer references it.
+        """
+        image.close()
+        self._attached.discard(image.path)
+        self._pending_release.append(image.path)
+
+    def __remove(self, own_path: str):
+        try:
+            os.remove(own_path)
+        except FileNotFoundError:
+            pass
+
+        path = own_path[:-len(self._suffix)]
+        try:
+            if os.stat(path).st_nlink == 1:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def on_checkpoint(self):
+        for path in self._pending_release:
+            self.__remove(path)
+        self._pending_release = []
+
+    def collect_garbage(self):
+        """
+        Removes the images this replica left behind, e.g. released before a crash. Images released
+        during the replay are left to the next checkpoint, the last one may still reference them.
+        """
+        for file_name in os.listdir(self._directory):
+            path = os.path.join(self._directory, file_name)
+            if file_name.endswith(self._suffix) and path not in self._attached \
+                    and path not in self._pending_release:
+                logging.info(f"action: remove_side_table | image: {path}")
+                self.__remove(path)
+            elif file_name.endswith(f"{self._suffix}.tmp"):
+                os.remove(path)
@@ -0,0 +1,236 @@
+import heapq
+import json
+import logging
+import os
+from operator import itemgetter
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+
+from common.utils import fsync_directory
+
+ENVIRONMENT = os.environ.get("ENVIRONMENT", "dev")
+# Memory every spill buffer of the node may take together, 0 disables spilling
+MEMORY_BUDGET_MB = float(os.environ.get("MEMORY_BUDGET_MB", "0"))
+SPILL_DIRECTORY = os.environ.get("SPILL_DIRECTORY", "/volumes/spill")
+
+# Buffers of the process, spilled against the same budget
+_buffers: List["SpillBuffer"] = []
+# Logical clock of the last access to each flow, it only moves with the messages handled
+_clock = 0
+
+
+class SpillBuffer:
+    """
+    Mergeable values of each flow, keyed by any sortable key.
+
+    Memory is estimated from the amount of entries, so the same messages always spill the same flows
+    and a replay after a crash writes the same runs. When the node goes over its budget, the flows that
+    were accessed least recently are written to disk as runs sorted by key and dropped from memory.
+    Their entries start again from scratch, and at EOF the runs and what is in memory are merged back.
+    """
+
+    def __init__(self, name: str, new_value: Callable[[], Any], merge: Callable[[Any, Any], None],
+                 to_state: Callable[[Any], Any], from_state: Callable[[Any], Any], entry_bytes: int,
+                 directory: str = SPILL_DIRECTORY):
+        self._name = name
+        self._new_value = new_value
+        self._merge = merge
+        self._to_state = to_state
+        self._from_state = from_state
+        self._entry_bytes = entry_bytes
+        self._directory = os.path.join(directory, name)
+
+        # [flow_id][key]: value
+        self._memory: Dict[str, Dict[Any, Any]] = {}
+        # [flow_id]: paths of its runs, oldest first
+        self._runs: Dict[str, List[str]] = {}
+        # [flow_id]: clock of its last access
+        self._last_access: Dict[str, int] = {}
+        # [flow_id]: most entries it had in memory
+        self._peak_entries: Dict[str, int] = {}
+        self._entries = 0
+        self._next_run = 0
+        # Runs of finished flows, removed once a checkpoint no longer references them
+        self._removable: List[str] = []
+        _buffers.append(self)
+
+    def entry(self, flow_id: str, key: Any) -> Any:
+        """
+        Returns the value of the key in memory, creating it if needed.
+        """
+        global _clock
+        _clock += 1
+        self._last_access[flow_id] = _clock
+
+        flow_memory = self._memory.setdefault(flow_id, {})
+        value = flow_memory.get(key)
+        if value is None:
+            value = flow_memory[key] = self._new_value()
+            self._entries += 1
+            if len(flow_memory) > self._peak_entries.get(flow_id, 0):
+                self._peak_entries[flow_id] = len(flow_memory)
+        return value
+
+    def remove(self, flow_id: str, key: Any) -> Any:
+        value = self._memory[flow_id].pop(key)
+        self._entries -= 1
+        return value
+
+    def keys(self, flow_id: str) -> List[Any]:
+        """
+        Keys of the flow in memory, unspill the flow first to get all of them.
+        """
+        return list(self._memory.get(flow_id, {}).keys())
+
+    def items(self, flow_id: str) -> Iterator[Tuple[Any, Any]]:
+        """
+        Every entry of the flow sorted by key, with its runs merged. Values are copies.
+        """
+        sources = [self.__read_run(path) for path in self._runs.get(flow_id, [])]
+        sources.append(sorted(self._memory.get(flow_id, {}).items(), key=itemgetter(0)))
+
+        key, value = None, None
+        for (next_key, next_value) in heapq.merge(*sources, key=itemgetter(0)):
+            if value is not None and next_key != key:
+                yield key, value
+                value = None
+            if value is None:
+                key, value = next_key, self._new_value()
+            self._merge(value, next_value)
+        if value is not None:
+            yield key, value
+
+    def pop(self, flow_id: str) -> Iterator[Tuple[Any, Any]]:
+        """
+        Every entry of the flow sorted by key, the flow is forgotten.
+        """
+        if flow_id not in self._memory and flow_id not in self._runs:
+            return iter([])
+        items = list(self.items(flow_id))
+        runs = len(self._runs.get(flow_id, []))
+        peak_entries = self._peak_entries.get(flow_id, 0)
+        self.discard(flow_id)
+        logging.info(f"action: flow_memory | buffer: {self._name} | flow_id: {flow_id} | "
+                     f"peak_bytes: {peak_entries * self._entry_bytes} | runs: {runs}")
+        return iter(items)
+
+    def discard(self, flow_id: str):
+        """
+        Forgets the flow without reading its runs, they are removed after the next checkpoint.
+        """
+        self._removable += self._runs.pop(flow_id, [])
+        self._entries -= len(self._memory.pop(flow_id, {}))
+        self._last_access.pop(flow_id, None)
+        self._peak_entries.pop(flow_id, None)
+
+    def unspill(self, flow_id: str):
+        """
+        Brings the runs of the flow back to memory.
+        """
+        runs = self._runs.get(flow_id)
+        if runs is None:
+            return
+        merged = list(self.items(flow_id))
+        self._entries -= len(self._memory.get(flow_id, {}))
+        self._memory[flow_id] = dict(merged)
+        self._entries += len(merged)
+        self._removable += self._runs.pop(flow_id)
+
+    def memory_bytes(self) -> int:
+        return self._entries * self._entry_bytes
+
+    def flow_memory_bytes(self) -> Dict[str, int]:
+        return {flow_id: len(flow_memory) * self._entry_bytes for flow_id, flow_memory in self._memory.items()}
+
+    def least_recent_flow(self) -> Tuple[int, str]:
+        flows = [(self._last_access.get(flow_id, 0), flow_id)
+                 for flow_id, flow_memory in self._memory.items() if len(flow_memory) > 0]
+        return min(flows, default=(None, None))
+
+    def spill(self, flow_id: str):
+        flow_memory = self._memory.pop(flow_id)
+        os.makedirs(self._directory, exist_ok=True)
+        path = os.path.join(self._directory, f"{flow_id}.{self._next_run}.run")
+        self._next_run += 1
+
+        with open(path, "w") as f:
+            for key, value in sorted(flow_memory.items(), key=itemgetter(0)):
+                f.write(json.dumps([key, self._to_state(value)]))
+                f.write("\n")
+            f.flush()
+            if ENVIRONMENT != "dev":
+                os.fsync(f.fileno())
+        if ENVIRONMENT != "dev":
+            fsync_directory(self._directory)
+
+        self._runs.setdefault(flow_id, []).append(path)
+        self._entries -= len(flow_memory)
+        logging.info(f"action: spill | buffer: {self._name} | flow_id: {flow_id} | "
+                     f"bytes: {len(flow_memory) * self._entry_bytes} | runs: {len(self._runs[flow_id])}")
+
+    def __read_run(self, path: str) -> Iterator[Tuple[Any, Any]]:
+        with open(path, "r") as f:
+            for line in f:
+                key, state = json.loads(line)
+                yield key, self._from_state(state)
+
+    def on_checkpoint(self):
+        for path in self._removable:
+            if os.path.exists(path):
+                os.remove(path)
+        self._removable = []
+
+    def get_state(self) -> dict:
+        # Keys may be ints, so entries are saved as pairs to survive JSON
+        return {
+            "memory": {
+                flow_id: [[key, self._to_state(value)] for key, value in flow_memory.items()]
+                for flow_id, flow_memory in self._memory.items()
+            },
+            "runs": self._runs,
+            "last_access": self._last_access,
+            "peak_entries": self._peak_entries,
+            "next_run": self._next_run,
+        }
+
+    def set_state(self, state: dict):
+        global _clock
+        self._memory = {
+            flow_id: {key: self._from_state(value) for key, value in flow_memory}
+            for flow_id, flow_memory in state["memory"].items()
+        }
+        self._runs = state["runs"]
+        self._last_access = state["last_access"]
+        self._peak_entries = state["peak_entries"]
+        self._next_run = state["next_run"]
+        self._entries = sum(len(flow_memory) for flow_memory in self._memory.values())
+        _clock = max([_clock] + list(self._last_access.values()))
+
+
+def check(budget_mb: float = MEMORY_BUDGET_MB):
+    """
+    Spills the least recently accessed flows until the buffers of the node fit in the budget.
+    Called after every message, never while a value taken from a buffer is still being updated.
+    """
+    if budget_mb <= 0:
+        return
+    budget = budget_mb * 1024 * 1024
+    spilled = False
+    while sum(buffer.memory_bytes() for buffer in _buffers) > budget:
+        last_access, flow_id, buffer = min(
+            ((*buffer.least_recent_flow(), buffer) for buffer in _buffers if buffer.memory_bytes() > 0),
+            key=lambda candidate: candidate[0]
+        )
+        buffer.spill(flow_id)
+        spilled = True
+
+    if spilled:
+        flows = {}
+        for buffer in _buffers:
+            for flow_id, flow_bytes in buffer.flow_memory_bytes().items():
+                flows[flow_id] = flows.get(flow_id, 0) + flow_bytes
+        logging.info(f"action: memory_usage | bytes: {sum(flows.values())} | budget: {int(budget)} | flows: {flows}")
+
+
+def on_checkpoint():
+    for buffer in _buffers:
+        buffer.on_checkpoint()
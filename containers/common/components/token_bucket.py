@@ -0,0 +1,42 @@
+import threading
+import time
+from typing import Optional
+
+
+class TokenBucket:
+    """
+    Lets through `rate` tokens per second on average, and up to `capacity` at once after being idle.
+    Safe to share between threads.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = capacity
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def set_rate(self, rate: float, capacity: Optional[float] = None):
+        with self._lock:
+            self.__refill()
+            self._rate = rate
+            if capacity is not None:
+                self._capacity = capacity
+                self._tokens = min(self._tokens, capacity)
+
+    def __refill(self):
+        now = time.monotonic()
+        self._tokens = min(self._capacity, self._tokens + (now - self._last_refill) * self._rate)
+        self._last_refill = now
+
+    def reserve(self, tokens: float = 1) -> float:
+        """
+        Takes `tokens` right away, and returns the seconds to wait before using them.
+        Taking and waiting apart lets several threads share the bucket without going over the rate.
+        """
+        with self._lock:
+            self.__refill()
+            # More tokens than the capacity are let through once the bucket is full
+            wait_time = max(0.0, (min(tokens, self._capacity) - self._tokens) / self._rate)
+            self._tokens -= tokens
+            return wait_time
@@ -0,0 +1,79 @@
+import os
+from typing import Dict, Optional
+
+# Days a trip may arrive late at the gateway, trips later than that are marked as late. Negative disables watermarks
+WATERMARK_DELAY_DAYS = int(os.environ.get("WATERMARK_DELAY_DAYS", "-1"))
+
+
+class EventTimeClock:
+    """
+    Watermarks of the flows entering the pipeline, one day behind the newest trip by the allowed delay.
+    """
+
+    def __init__(self, delay_days: int = WATERMARK_DELAY_DAYS):
+        self._delay_days = delay_days
+        # [flow_id]: [newest start day, watermark sent]
+        self._flows: Dict[str, list] = {}
+
+    def enabled(self) -> bool:
+        return self._delay_days >= 0
+
+    def is_late(self, flow_id: str, day: int) -> bool:
+        flow = self._flows.get(flow_id)
+        return flow is not None and day < flow[1]
+
+    def advance(self, flow_id: str, day: int) -> Optional[int]:
+        """
+        Records the start day of a trip, returns the new watermark of the flow if it moves.
+        """
+        flow = self._flows.setdefault(flow_id, [day, day - self._delay_days])
+        if day > flow[0]:
+            flow[0] = day
+        watermark = flow[0] - self._delay_days
+        if watermark <= flow[1]:
+            return None
+        flow[1] = watermark
+        return watermark
+
+    def pop(self, flow_id: str):
+        self._flows.pop(flow_id, None)
+
+    def get_state(self) -> Dict[str, list]:
+        return self._flows
+
+    def set_state(self, state: Dict[str, list]):
+        self._flows = state
+
+
+class WatermarkTracker:
+    """
+    Combines the watermarks every replica of the previous stage sends for a flow. The watermark of
+    the flow is the lowest of them, and it only moves once every replica sent one.
+    """
+
+    def __init__(self):
+        # [flow_id]: {"senders": {sender_id: day}, "day": last combined watermark}
+        self._flows: Dict[str, dict] = {}
+
+    def update(self, flow_id: str, sender_id: str, day: int, senders_amount: int) -> Optional[int]:
+        """
+        Returns the new watermark of the flow if it moves.
+        """
+        flow = self._flows.setdefault(flow_id, {"senders": {}, "day": None})
+        flow["senders"][sender_id] = day
+        if len(flow["senders"]) < senders_amount:
+            return None
+        watermark = min(flow["senders"].values())
+        if flow["day"] is not None and watermark <= flow["day"]:
+            return None
+        flow["day"] = watermark
+        return watermark
+
+    def pop(self, flow_id: str):
+        self._flows.pop(flow_id, None)
+
+    def get_state(self) -> Dict[str, dict]:
+        return self._flows
+
+    def set_state(self, state: Dict[str, dict]):
+        self._flows = state
@@ -1,6 +1,7 @@
 import logging
+import os
 import signal
-from typing import Callable, Union
+from typing import Callable, Union, List
 
 import pika
 from pika.exceptions import ChannelWrongStateError, ChannelClosedByBroker
@@ -8,14 +9,19 @@ from pika.exceptions import ChannelWrongStateError, ChannelClosedByBroker
 from common.utils import append_signal
 from common.middleware.message_queue import MessageQueue
 
+PREFETCH_COUNT = int(os.environ.get("RABBIT_PREFETCH_COUNT", 1))
+DRAIN_BATCH_SIZE = int(os.environ.get("RABBIT_DRAIN_BATCH_SIZE", 1000))
+DRAIN_TIMEOUT = float(os.environ.get("RABBIT_DRAIN_TIMEOUT", 1))
+
 
 class Rabbit(MessageQueue):
 
-    def __init__(self, host: str):
+    def __init__(self, host: str, prefetch_count: int = PREFETCH_COUNT):
         self._connection_params = pika.ConnectionParameters(host=host, heartbeat=0)
         self.connection = pika.BlockingConnection(self._connection_params)
         self._channel = self.connection.channel()
-        self._channel.basic_qos(prefetch_count=1)
+        self._prefetch_count = prefetch_count
+        self._channel.basic_qos(prefetch_count=prefetch_count)
         self._channel.confirm_delivery()
         self._declared_exchanges = []
         self._declared_queues = []
@@ -35,7 +41,9 @@ class Rabbit(MessageQueue):
     def __set_up_signal_handler(self):
         def signal_handler(_sig, _frame):
             logging.info("action: rabbit_close | status: in_progress")
-            self.connection.add_callback_threadsafe(self.close)
+            # Connections closed earlier in the process can no longer take callbacks
+            if self.connection.is_open:
+                self.connection.add_callback_threadsafe(self.close)
 
         append_signal(signal.SIGTERM, signal_handler)
 
@@ -116,18 +124,41 @@ class Rabbit(MessageQueue):
         if cleanup:
             self._channel.cancel()
 
-    def consume_until_empty(self, queue: str, callback: Callable[[bytes], bool]):
+    def drain(self, queue: str, callback: Callable[[List[bytes]], bool], batch_size: int = DRAIN_BATCH_SIZE):
         """
-        Consumes messages from a queue until it is empty.
+        Consumes the messages present in a queue, handing them to the callback in batches.
+        Each batch is acked with a single 'multiple' ack if the callback returns True.
         """
-        self.declare_queue(queue)
-        while True:
-            q = self._channel.queue_declare(queue=queue, passive=True)
-            if q.method.message_count == 0:
+        q = self._channel.queue_declare(queue=queue, durable=True)
+        if queue not in self._declared_queues:
+            self._declared_queues.append(queue)
+        remaining = q.method.message_count
+        if remaining == 0:
+            return
+
+        self._channel.basic_qos(prefetch_count=batch_size)
+        batch = []
+        last_tag = None
+        for (method, _, msg) in self._channel.consume(queue=queue, auto_ack=False, inactivity_timeout=DRAIN_TIMEOUT):
+            if method is not None:
+                batch.append(msg)
+                last_tag = method.delivery_tag
+                remaining -= 1
+
+            done = method is None or remaining == 0
+            if len(batch) == batch_size or (done and len(batch) > 0):
+                if callback(batch):
+                    self._channel.basic_ack(delivery_tag=last_tag, multiple=True)
+                else:
+                    self._channel.basic_nack(delivery_tag=last_tag, multiple=True)
+                    done = True
+                batch = []
+
+            if done:
                 break
-            self.consume_one(queue, callback, False)
 
         self._channel.cancel()
+        self._channel.basic_qos(prefetch_count=self._prefetch_count)
 
     def produce(self, queue: str, message: bytes, confirm: bool = True):
         self.declare_queue(queue)
@@ -159,6 +190,12 @@ class Rabbit(MessageQueue):
             self._channel.exchange_declare(exchange=exchange, exchange_type=exchange_type)
             self._declared_exchanges.append(exchange)
 
+    def process_events(self, time_limit: float = 0):
+        """
+        Runs the callbacks of the consumers for up to `time_limit` seconds, without blocking if it is 0.
+        """
+        self.connection.process_data_events(time_limit=time_limit)
+
     def start(self):
         self._channel.start_consuming()
 
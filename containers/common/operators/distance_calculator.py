@@ -0,0 +1,74 @@
+from typing import Dict, List, Tuple
+
+import numpy as np
+from haversine import haversine
+
+from common.aggregates import MeanAggregate
+from common.basic_classes.basic_operator import BasicOperator
+from common.components.message_sender import OutgoingMessages
+from common.operators.distances import haversine_km
+from common.packets.dist_info import DistInfo
+from common.packets.distance_calc_in import DistanceCalcIn
+from common.packets.mean_partial import MeanPartial
+
+
+class DistanceCalculator(BasicOperator):
+    def handle_chunk(self, _flow_id, chunk: List[bytes]) -> OutgoingMessages:
+        end_station_names, distances = self.__calculate_chunk_distances(chunk)
+        queues = {name: self.router.route(name) for name in set(end_station_names)}
+
+        output = {}
+        for end_station_name, distance in zip(end_station_names, distances):
+            output.setdefault(queues[end_station_name], []).append(DistInfo(end_station_name, distance).encode())
+        return OutgoingMessages(output)
+
+    def combine_chunk(self, _flow_id, chunk: List[bytes]) -> OutgoingMessages:
+        end_station_names, distances = self.__calculate_chunk_distances(chunk)
+
+        aggregates: Dict[str, MeanAggregate] = {}
+        for end_station_name, distance in zip(end_station_names, distances):
+            aggregate = aggregates.get(end_station_name)
+            if aggregate is None:
+                aggregate = aggregates[end_station_name] = MeanAggregate()
+            aggregate.add(distance)
+
+        output = {}
+        for end_station_name, aggregate in aggregates.items():
+            output_queue = self.router.route(end_station_name)
+            output.setdefault(output_queue, []).append(MeanPartial(end_station_name, aggregate.to_state()).encode())
+        return OutgoingMessages(output)
+
+    @staticmethod
+    def __calculate_chunk_distances(chunk: List[bytes]) -> Tuple[List[str], List[float]]:
+        packets = [DistanceCalcIn.decode(message) for message in chunk]
+        if len(packets) == 0:
+            return [], []
+
+        coordinates = np.array([
+            (p.start_station_latitude, p.start_station_longitude, p.end_station_latitude, p.end_station_longitude)
+            for p in packets
+        ], dtype=np.float64)
+        distances = haversine_km(coordinates[:, 0], coordinates[:, 1], coordinates[:, 2], coordinates[:, 3])
+
+        return [p.end_station_name for p in packets], distances.tolist()
+
+    def handle_message(self, _flow_id, message: bytes) -> OutgoingMessages:
+        packet = DistanceCalcIn.decode(message)
+
+        output_queue = self.router.route(packet.end_station_name)
+        distance = self.__calculate_distance(packet.start_station_latitude,
+                                             packet.start_station_longitude,
+                                             packet.end_station_latitude,
+                                             packet.end_station_longitude)
+        return OutgoingMessages({
+            output_queue: [DistInfo(packet.end_station_name, distance).encode()]
+        })
+
+    @staticmethod
+    def __calculate_distance(start_station_latitude: float, start_station_longitude: float,
+                             end_station_latitude: float, end_station_longitude: float) -> float:
+        return haversine((start_station_latitude, start_station_longitude),
+                         (end_station_latitude, end_station_longitude))
+
+
+OPERATOR = DistanceCalculator
@@ -0,0 +1,17 @@
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0088  # Same mean radius used by the haversine package
+
+
+def haversine_km(start_latitudes: np.ndarray, start_longitudes: np.ndarray,
+                 end_latitudes: np.ndarray, end_longitudes: np.ndarray) -> np.ndarray:
+    """
+    Great circle distance in km between each pair of points, computed for whole arrays at once.
+    """
+    start_latitudes, start_longitudes, end_latitudes, end_longitudes = map(
+        np.radians, (start_latitudes, start_longitudes, end_latitudes, end_longitudes))
+
+    d = np.sin((end_latitudes - start_latitudes) / 2) ** 2 + \
+        np.cos(start_latitudes) * np.cos(end_latitudes) * np.sin((end_longitudes - start_longitudes) / 2) ** 2
+
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(d))
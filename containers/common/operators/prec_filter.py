@@ -0,0 +1,48 @@
+import os
+from typing import Dict, List
+
+from common.aggregates import MeanAggregate
+from common.basic_classes.basic_operator import BasicOperator, router_from_env
+from common.components.message_sender import OutgoingMessages
+from common.packets.mean_partial import MeanPartial
+from common.packets.prec_filter_in import PrecFilterIn
+from common.router import Router
+
+
+class PrecFilter(BasicOperator):
+    def __init__(self, router: Router, prec_limit: int):
+        self._prec_limit = prec_limit
+        super().__init__(router)
+
+    @classmethod
+    def from_env(cls, prefix: str = "") -> "PrecFilter":
+        return cls(router_from_env(prefix), int(os.environ[f"{prefix}PREC_LIMIT"]))
+
+    def combine_chunk(self, _flow_id, chunk: List[bytes]) -> OutgoingMessages:
+        aggregates: Dict[int, MeanAggregate] = {}
+        for message in chunk:
+            packet = PrecFilterIn.decode(message)
+            if packet.prectot > self._prec_limit:
+                aggregate = aggregates.get(packet.start_day)
+                if aggregate is None:
+                    aggregate = aggregates[packet.start_day] = MeanAggregate()
+                aggregate.add(packet.duration_sec)
+
+        output = {}
+        for start_day, aggregate in aggregates.items():
+            output_queue = self.router.route(start_day)
+            output.setdefault(output_queue, []).append(MeanPartial(start_day, aggregate.to_state()).encode())
+        return OutgoingMessages(output)
+
+    def handle_message(self, _flow_id, message: bytes) -> OutgoingMessages:
+        packet = PrecFilterIn.decode(message)
+
+        output = {}
+        if packet.prectot > self._prec_limit:
+            output_queue = self.router.route(packet.start_day)
+            output[output_queue] = [message]
+
+        return OutgoingMessages(output)
+
+
+OPERATOR = PrecFilter
@@ -0,0 +1,35 @@
+from typing import Dict, List, Tuple
+
+from common.basic_classes.basic_operator import BasicOperator
+from common.components.message_sender import OutgoingMessages
+from common.packets.trips_count_partial import TripsCountPartial
+from common.packets.year_filter_in import YearFilterIn
+
+
+class YearFilter(BasicOperator):
+    def combine_chunk(self, _flow_id, chunk: List[bytes]) -> OutgoingMessages:
+        counts: Dict[Tuple[str, int], int] = {}
+        for message in chunk:
+            packet = YearFilterIn.decode(message)
+            if packet.yearid in [2016, 2017]:
+                key = (packet.start_station_name, packet.yearid)
+                counts[key] = counts.get(key, 0) + 1
+
+        output = {}
+        for (start_station_name, yearid), count in counts.items():
+            output_queue = self.router.route(start_station_name)
+            output.setdefault(output_queue, []).append(
+                TripsCountPartial(start_station_name, yearid, count).encode())
+        return OutgoingMessages(output)
+
+    def handle_message(self, _flow_id, message: bytes) -> OutgoingMessages:
+        packet = YearFilterIn.decode(message)
+        output = {}
+        if packet.yearid in [2016, 2017]:
+            output_queue = self.router.route(packet.start_station_name)
+            output[output_queue] = [message]
+
+        return OutgoingMessages(output)
+
+
+OPERATOR = YearFilter
@@ -1,5 +1,5 @@
 from dataclasses import dataclass
-from typing import Union, Literal
+from typing import Union, Literal, Optional, Dict
 
 from common.packets.basic_packet import BasicPacket
 from common.packets.basic_packet import BasicPacket
@@ -7,9 +7,30 @@ from common.packets.basic_packet import BasicPacket
 
 @dataclass
 class RateLimitChangeRequest(BasicPacket):
+    # Packets per second
     new_rate: int
+    # Bytes per second, paces on the size of the packets instead of their amount if present
+    new_byte_rate: Optional[int] = None
+    # Messages waiting in the input queue of the gateway, clients send smaller packets if it is deep
+    queue_depth: Optional[int] = None
+
+
+@dataclass
+class UploadPosition(BasicPacket):
+    # Packets of the flow the gateway accepted in order, EOF included
+    packets: int
+    # Position of the last of them, as in ClientDataPacket
+    file: int
+    chunks: int
+
+
+@dataclass
+class ResumeResponse(BasicPacket):
+    request_id: str
+    # [city]: position of every city the gateway accepted packets of
+    positions: Dict[str, UploadPosition]
 
 
 @dataclass
 class ClientControlPacket(BasicPacket):
-    data: Union[str, RateLimitChangeRequest]
+    data: Union[str, RateLimitChangeRequest, ResumeResponse]
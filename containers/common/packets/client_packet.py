@@ -1,5 +1,5 @@
 from dataclasses import dataclass
-from typing import Union, List
+from typing import Union, List, Optional, Tuple
 
 from common.packets.basic_packet import BasicPacket
 from common.packets.eof import Eof
@@ -11,6 +11,8 @@ class ClientDataPacket(BasicPacket):
     city_name: str
     seq_number: int
     data: Union[List[bytes], Eof]
+    # (file, chunks of the file sent up to this packet), where an upload resumes after it
+    position: Optional[Tuple[int, int]] = None
 
     def is_eof(self):
         return isinstance(self.data, Eof)
@@ -25,6 +27,16 @@ class ClientDataPacket(BasicPacket):
         return f"{self.client_id}-{self.city_name}"
 
 
+@dataclass
+class ResumeRequest(BasicPacket):
+    """
+    Sent by a restarted client to the gateway of its session, answered on its control queue.
+    """
+    session_id: str
+    # Echoed in the response, so an answer to an earlier request is not taken for this one
+    request_id: str
+
+
 @dataclass
 class ClientPacket(BasicPacket):
-    data: Union[ClientDataPacket, str]
+    data: Union[ClientDataPacket, ResumeRequest, str]
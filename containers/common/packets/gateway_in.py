@@ -1,14 +1,18 @@
 from dataclasses import dataclass
+from typing import Optional
 
 from common.packets.basic_packet import BasicPacket
+from common.packets.joined_station import JoinedStation
 
 
 @dataclass
 class GatewayIn(BasicPacket):
-    start_datetime: str
+    start_day: int
     start_station_code: int
-    end_datetime: str
     end_station_code: int
     duration_sec: float
-    is_member: bool
     yearid: int
+    # Only set when stations are partitioned by code, see STATION_PARTITIONING
+    end_station: Optional[JoinedStation] = None
+    # Started before the watermark of its flow, the days it would count for may be finalized
+    late: bool = False
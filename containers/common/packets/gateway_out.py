@@ -1,14 +1,20 @@
 from dataclasses import dataclass
+from typing import Optional
 
 
 from common.packets.basic_packet import BasicPacket
+from common.packets.joined_station import JoinedStation
 
 
 @dataclass
 class GatewayOut(BasicPacket):
-    start_date: str
+    start_day: int
     start_station_code: int
     end_station_code: int
     duration_sec: float
     yearid: int
     prectot: float
+    # Only set when stations are partitioned by code, see STATION_PARTITIONING
+    end_station: Optional[JoinedStation] = None
+    # Started before the watermark of its flow, the days it would count for may be finalized
+    late: bool = False
@@ -3,6 +3,7 @@ from typing import Union, List
 
 from common.packets.basic_packet import BasicPacket
 from common.packets.eof import Eof
+from common.packets.watermark import Watermark
 
 
 @dataclass
@@ -12,7 +13,9 @@ class GenericPacket(BasicPacket):
     city_name: str
     seq_number: int
 
-    data: Union[List[bytes], Eof]
+    data: Union[List[bytes], Eof, Watermark]
+    # Membership epoch the flow is routed with, see common.components.membership
+    epoch: int = 0
 
     def is_eof(self) -> bool:
         return isinstance(self.data, Eof)
@@ -28,18 +31,20 @@ class GenericPacket(BasicPacket):
 
 
 class GenericPacketBuilder:
-    def __init__(self, sender_id: str, client_id: str, city_name: str):
+    def __init__(self, sender_id: str, client_id: str, city_name: str, epoch: int = 0):
         self._sender_id = sender_id
         self._client_id = client_id
         self._city_name = city_name
+        self._epoch = epoch
 
-    def build(self, seq_number: int, data: Union[List[bytes], Eof]) -> GenericPacket:
+    def build(self, seq_number: int, data: Union[List[bytes], Eof, Watermark]) -> GenericPacket:
         return GenericPacket(
             sender_id=self._sender_id,
             client_id=self._client_id,
             city_name=self._city_name,
             seq_number=seq_number,
-            data=data
+            data=data,
+            epoch=self._epoch
         )
 
     def get_id(self) -> str:
@@ -0,0 +1,11 @@
+from dataclasses import dataclass
+from typing import Union
+
+from common.packets.basic_packet import BasicPacket
+
+
+@dataclass
+class JoinedStation(BasicPacket):
+    station_name: str
+    latitude: Union[float, None]
+    longitude: Union[float, None]
@@ -0,0 +1,10 @@
+from dataclasses import dataclass
+from typing import List, Union
+
+from common.packets.basic_packet import BasicPacket
+
+
+@dataclass
+class MeanPartial(BasicPacket):
+    key: Union[str, int]
+    aggregate: List[Union[int, float]]
@@ -5,6 +5,6 @@ from common.packets.basic_packet import BasicPacket
 
 @dataclass
 class PrecFilterIn(BasicPacket):
-    start_date: str
+    start_day: int
     duration_sec: float
     prectot: float
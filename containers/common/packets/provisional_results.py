@@ -0,0 +1,12 @@
+from dataclasses import dataclass
+from typing import List
+
+from common.packets.basic_packet import BasicPacket
+
+
+@dataclass
+class ProvisionalResults(BasicPacket):
+    """
+    Snapshot of the results of a flow before its EOF, it replaces the previous snapshot of the same type.
+    """
+    results: List[bytes]
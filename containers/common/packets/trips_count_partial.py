@@ -0,0 +1,10 @@
+from dataclasses import dataclass
+
+from common.packets.basic_packet import BasicPacket
+
+
+@dataclass
+class TripsCountPartial(BasicPacket):
+    start_station_name: str
+    yearid: int
+    count: int
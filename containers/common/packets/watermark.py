@@ -0,0 +1,11 @@
+from dataclasses import dataclass
+
+from common.packets.basic_packet import BasicPacket
+
+
+@dataclass
+class Watermark(BasicPacket):
+    """
+    Event time of a flow: no trip starting before `day` will be sent after it.
+    """
+    day: int
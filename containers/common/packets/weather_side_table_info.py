@@ -5,5 +5,5 @@ from common.packets.basic_packet import BasicPacket
 
 @dataclass
 class WeatherSideTableInfo(BasicPacket):
-    date: str
+    day: int
     prectot: float
@@ -12,6 +12,7 @@ RABBIT_HTTP_PORT = os.environ.get("RABBIT_HTTP_PORT", 15672)
 class Rates:
     publish_per_second: float
     ack_per_second: float
+    messages: Optional[int] = None
 
 
 class RateChecker:
@@ -35,6 +36,6 @@ class RateChecker:
         try:
             publish_rate = api_response["message_stats"]["publish_details"]["rate"]
             ack_rate = api_response["message_stats"]["ack_details"]["rate"]
-            return Rates(publish_rate, ack_rate)
+            return Rates(publish_rate, ack_rate, api_response.get("messages"))
         except KeyError:
             return None
@@ -1,43 +1,92 @@
-from typing import Dict, Tuple, List, Union
+import os
+from typing import Dict, Tuple, List, Union, Optional
+
+from common.components.key_load import tracker_for_edge, KeyLoadTracker
+from common.components.membership import MEMBERSHIP
+
+# "modulo" or "jump", with jump hashing a scale out only moves the keys that go to the new replicas
+ROUTING_HASH = os.environ.get("ROUTING_HASH", "modulo")
+
+JUMP_HASH_MULTIPLIER = 2862933555777941757
+UINT64_MASK = (1 << 64) - 1
+
+
+def jump_hash(key: int, buckets: int) -> int:
+    # Lamping and Veach, "A Fast, Minimal Memory, Consistent Hash Algorithm"
+    key &= UINT64_MASK
+    bucket, next_bucket = -1, 0
+    while next_bucket < buckets:
+        bucket = next_bucket
+        key = (key * JUMP_HASH_MULTIPLIER + 1) & UINT64_MASK
+        next_bucket = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+
+def _queue_num(hashing_key, amount: int, key_load: Optional[KeyLoadTracker]) -> int:
+    if ROUTING_HASH == "jump":
+        queue_num = jump_hash(hash(hashing_key), amount)
+    else:
+        queue_num = hash(hashing_key) % amount
+    if key_load is not None:
+        queue_num = key_load.route(hashing_key, queue_num, amount)
+    return queue_num
 
 
 class Router:
-    def __init__(self, queue_name: str, amount: Union[int, None]):
+    def __init__(self, queue_name: str, amount: Union[int, None], hot_key_split: int = 1):
+        """
+        With hot_key_split > 1, hot keys are spread over that many replicas. Only edges whose
+        next stage merges the partial results of a key may split them.
+        The amount is the one of the deployment, the membership epoch of the flow may raise it.
+        """
         self.queue_name = queue_name
         self.amount = amount
+        self._key_load = tracker_for_edge(queue_name, amount, hot_key_split)
 
     def route(self, hashing_key: str = None) -> str:
-        if self.amount is None:
+        amount = MEMBERSHIP.amount(self.queue_name, self.amount)
+        if amount is None:
             return f"{self.queue_name}"
 
-        queue_num = hash(hashing_key) % self.amount
+        queue_num = _queue_num(hashing_key, amount, self._key_load)
         return f"{self.queue_name}_{queue_num}"
 
     def all_routes(self) -> List[str]:
-        if self.amount is None:
+        amount = MEMBERSHIP.amount(self.queue_name, self.amount)
+        if amount is None:
             return [f"{self.queue_name}"]
 
-        return [f"{self.queue_name}_{i}" for i in range(self.amount)]
+        return [f"{self.queue_name}_{i}" for i in range(amount)]
 
     def publish(self) -> str:
         return f"publish_{self.queue_name}"
 
 
 class MultiRouter:
-    def __init__(self, queues: Dict[str, Tuple[str, int]]):
+    def __init__(self, queues: Dict[str, Tuple[str, int]], hot_key_split: int = 1):
         self.queues = queues
+        self._key_loads = {
+            name: tracker_for_edge(queue, amount, hot_key_split) for name, (queue, amount) in queues.items()
+        }
 
     def route(self, queue: str, hashing_key: str) -> str:
+        key_load = self._key_loads.get(queue)
         (queue, amount) = self.queues.get(queue)
+        amount = MEMBERSHIP.amount(queue, amount)
 
-        queue_num = hash(hashing_key) % amount
+        queue_num = _queue_num(hashing_key, amount, key_load)
         return f"{queue}_{queue_num}"
 
     def all_routes(self, queue: str) -> List[str]:
         (queue, amount) = self.queues.get(queue)
+        amount = MEMBERSHIP.amount(queue, amount)
 
         return [f"{queue}_{i}" for i in range(amount)]
 
+    def publish_to(self, queue: str) -> str:
+        (queue, _) = self.queues.get(queue)
+        return f"publish_{queue}"
+
     def publish(self) -> List[str]:
         queues = []
         for (_, (queue, _)) in self.queues.items():
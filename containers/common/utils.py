@@ -2,7 +2,7 @@ import logging
 import os
 import json
 import signal
-from datetime import datetime, date
+from datetime import date
 from types import FrameType
 from typing import Union, Callable
 
@@ -102,12 +102,16 @@ def bold(text: str) -> str:
     return f"\033[1m{text}\033[0m"
 
 
-def parse_date(date_str: str) -> date:
-    return datetime.strptime(date_str, "%Y-%m-%d")
+def date_str_to_day(date_str: str) -> int:
+    """
+    Day number (proleptic Gregorian ordinal) of a "%Y-%m-%d" date, the time of a datetime is ignored.
+    """
+    year, month, day = date_str.split(" ", 1)[0].split("-")
+    return date(int(year), int(month), int(day)).toordinal()
 
 
-def datetime_str_to_date_str(datetime_str: str) -> str:
-    return datetime_str.split(" ")[0]
+def day_to_date_str(day: int) -> str:
+    return date.fromordinal(day).isoformat()
 
 
 def save_state(state: bytes, path: str = "/volumes/state"):
@@ -122,6 +126,15 @@ def save_state(state: bytes, path: str = "/volumes/state"):
     os.rename("/volumes/temp_state", path)
 
 
+def fsync_directory(path: str):
+    # Makes renames and newly created files inside the directory durable
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
 def load_state(path: str = "/volumes/state") -> Union[bytes, None]:
     if os.path.exists(path):
         with open(path, "rb") as f:
@@ -1,62 +1,81 @@
 #!/usr/bin/env python3
 import json
-from typing import Dict, List
+from typing import Dict, Iterator, List, Tuple
 
+from common.aggregates import MeanAggregate, merge_aggregates, MEAN_ENTRY_BYTES
 from common.basic_classes.basic_stateful_filter import BasicStatefulFilter
 from common.components.message_sender import OutgoingMessages
+from common.components.provisional import ProvisionalTrigger
+from common.components.spill import SpillBuffer
 from common.packets.dist_info import DistInfo
 from common.packets.eof import Eof
-from common.packets.station_dist_mean import StationDistMean
+from common.packets.mean_partial import MeanPartial
 from common.utils import initialize_log
 
 
 class DistMeanCalculator(BasicStatefulFilter):
     def __init__(self):
-        self._mean_buffer = {}
+        # [flow_id][end_station_name]: aggregate
+        self._mean_buffer = SpillBuffer("dist_mean_calculator", MeanAggregate, merge_aggregates,
+                                        MeanAggregate.to_state, MeanAggregate.from_state, MEAN_ENTRY_BYTES)
+        self._provisional = ProvisionalTrigger()
         super().__init__()
 
+    def __output(self, items: Iterator[Tuple[str, MeanAggregate]]) -> Dict[str, List[bytes]]:
+        # Hot stations may be split among calculators, the provider merges their aggregates.
+        # The same goes for aggregates flushed before the EOF
+        output = {}
+        for end_station_name, aggregate in items:
+            queue_name = self.router.route(end_station_name)
+            output.setdefault(queue_name, [])
+            output[queue_name].append(
+                MeanPartial(end_station_name, aggregate.to_state()).encode()
+            )
+        return output
+
     def handle_eof(self, flow_id, message: Eof) -> OutgoingMessages:
         eof_output_queue = self.router.publish()
         output = {}
-        self._mean_buffer.setdefault(flow_id, {})
+        if message.drop:
+            self._mean_buffer.discard(flow_id)
+        else:
+            output = self.__output(self._mean_buffer.pop(flow_id))
 
-        if not message.drop:
-            for end_station_name, data in self._mean_buffer[flow_id].items():
-                queue_name = self.router.route(end_station_name)
-                output.setdefault(queue_name, [])
-                output[queue_name].append(
-                    StationDistMean(end_station_name, data["mean"], data["count"]).encode()
-                )
-
-        self._mean_buffer.pop(flow_id)
+        self._provisional.pop(flow_id)
         output[eof_output_queue] = message
         return OutgoingMessages(output)
 
     def handle_message(self, flow_id, message: bytes) -> Dict[str, List[bytes]]:
         packet = DistInfo.decode(message)
 
-        self._mean_buffer.setdefault(flow_id, {})
-        self._mean_buffer[flow_id].setdefault(packet.end_station_name, {"mean": 0, "count": 0})
-
-        old_mean = self._mean_buffer[flow_id][packet.end_station_name]["mean"]
-        old_count = self._mean_buffer[flow_id][packet.end_station_name]["count"]
-
-        new_count = old_count + 1
-        new_mean = (old_mean * old_count + packet.distance_km) / new_count
-
-        self._mean_buffer[flow_id][packet.end_station_name]["mean"] = new_mean
-        self._mean_buffer[flow_id][packet.end_station_name]["count"] = new_count
-
+        # Combining filters send partial aggregates instead of every value
+        if isinstance(packet, MeanPartial):
+            key = packet.key
+        else:
+            key = packet.end_station_name
+
+        aggregate = self._mean_buffer.entry(flow_id, key)
+        if isinstance(packet, MeanPartial):
+            aggregate.merge(MeanAggregate.from_state(packet.aggregate))
+        else:
+            aggregate.add(packet.distance_km)
+
+        if self._provisional.tick(flow_id):
+            output = self.__output(self._mean_buffer.items(flow_id))
+            self._mean_buffer.discard(flow_id)
+            return output
         return {}
 
     def get_state(self) -> dict:
         return {
-            "mean_buffer": self._mean_buffer,
+            "mean_buffer": self._mean_buffer.get_state(),
+            "provisional": self._provisional.get_state(),
             "parent_state": super().get_state()
         }
 
     def set_state(self, state: dict):
-        self._mean_buffer = state["mean_buffer"]
+        self._mean_buffer.set_state(state["mean_buffer"])
+        self._provisional.set_state(state["provisional"])
         super().set_state(state["parent_state"])
 
 
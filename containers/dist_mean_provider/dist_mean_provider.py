@@ -1,9 +1,14 @@
 #!/usr/bin/env python3
 import os
-from typing import Dict, List
+from typing import Dict, List, Union
 
+from common.aggregates import MeanAggregate, AggregatesBuffer, buffer_to_state, buffer_from_state
 from common.basic_classes.basic_stateful_filter import BasicStatefulFilter
 from common.components.message_sender import OutgoingMessages
+from common.components.provisional import ProvisionalTrigger
+from common.packets.eof import Eof
+from common.packets.mean_partial import MeanPartial
+from common.packets.provisional_results import ProvisionalResults
 from common.packets.station_dist_mean import StationDistMean
 from common.utils import initialize_log
 
@@ -13,16 +18,55 @@ MEAN_THRESHOLD = os.environ["MEAN_THRESHOLD"]
 class DistMeanProvider(BasicStatefulFilter):
     def __init__(self, mean_threshold: float):
         self._mean_threshold = mean_threshold
+        self._mean_buffer: AggregatesBuffer = {}
+        self._provisional = ProvisionalTrigger()
         super().__init__()
 
-    def handle_message(self, _flow_id, message: bytes) -> OutgoingMessages:
-        packet = StationDistMean.decode(message)
+    def __results(self, flow_id) -> List[bytes]:
+        results = []
+        for end_station_name, aggregate in self._mean_buffer.get(flow_id, {}).items():
+            dist_mean = aggregate.mean()
+            if dist_mean >= self._mean_threshold:
+                results.append(StationDistMean(end_station_name, dist_mean, aggregate.count).encode())
+        return results
 
-        output = {}
-        if packet.dist_mean >= self._mean_threshold:
-            output[self.router.route()] = [message]
+    def handle_eof(self, flow_id, message: Eof) -> Dict[str, Union[List[bytes], Eof]]:
+        eof_output_queue = self.router.publish()
+        city_output = []
+        if not message.drop:
+            city_output = self.__results(flow_id)
+        self._mean_buffer.pop(flow_id, None)
+        self._provisional.pop(flow_id)
+        return {
+            self.router.route(): city_output,
+            eof_output_queue: message,
+        }
 
-        return OutgoingMessages(output)
+    def handle_message(self, flow_id, message: bytes) -> OutgoingMessages:
+        packet = MeanPartial.decode(message)
+
+        # A hot station may come split from several calculators
+        flow_buffer = self._mean_buffer.setdefault(flow_id, {})
+        aggregate = flow_buffer.get(packet.key)
+        if aggregate is None:
+            aggregate = flow_buffer[packet.key] = MeanAggregate()
+        aggregate.merge(MeanAggregate.from_state(packet.aggregate))
+
+        if self._provisional.tick(flow_id):
+            return OutgoingMessages({self.router.route(): [ProvisionalResults(self.__results(flow_id)).encode()]})
+        return OutgoingMessages({})
+
+    def get_state(self) -> dict:
+        return {
+            "mean_buffer": buffer_to_state(self._mean_buffer),
+            "provisional": self._provisional.get_state(),
+            "parent_state": super().get_state()
+        }
+
+    def set_state(self, state: dict):
+        self._mean_buffer = buffer_from_state(state["mean_buffer"])
+        self._provisional.set_state(state["provisional"])
+        super().set_state(state["parent_state"])
 
 
 def main():
@@ -1,56 +1,88 @@
 #!/usr/bin/env python3
 import json
-from typing import Dict, List, Union
+from typing import Dict, Iterator, List, Tuple, Union
 
+from common.aggregates import MeanAggregate, merge_aggregates, MEAN_ENTRY_BYTES
 from common.basic_classes.basic_stateful_filter import BasicStatefulFilter
+from common.components.message_sender import OutgoingMessages
+from common.components.provisional import ProvisionalTrigger
+from common.components.spill import SpillBuffer
 from common.packets.dur_avg_out import DurAvgOut
 from common.packets.eof import Eof
+from common.packets.mean_partial import MeanPartial
 from common.packets.prec_filter_in import PrecFilterIn
-from common.utils import initialize_log
+from common.packets.provisional_results import ProvisionalResults
+from common.packets.watermark import Watermark
+from common.utils import initialize_log, day_to_date_str
 
 
 class DurAvgProvider(BasicStatefulFilter):
     def __init__(self):
-        self._avg_buffer = {}
+        # [flow_id][start_day]: aggregate
+        self._avg_buffer = SpillBuffer("dur_avg_provider", MeanAggregate, merge_aggregates,
+                                       MeanAggregate.to_state, MeanAggregate.from_state, MEAN_ENTRY_BYTES)
+        self._provisional = ProvisionalTrigger()
         super().__init__()
 
+    @staticmethod
+    def __results(items: Iterator[Tuple[int, MeanAggregate]]) -> List[bytes]:
+        return [
+            DurAvgOut(day_to_date_str(start_day), aggregate.mean(), aggregate.count).encode()
+            for start_day, aggregate in items
+        ]
+
     def handle_eof(self, flow_id, message: Eof) -> Dict[str, Union[List[bytes], Eof]]:
         eof_output_queue = self.router.publish()
-        self._avg_buffer.setdefault(flow_id, {})
         city_output = []
-        if not message.drop:
-            for start_date in self._avg_buffer[flow_id]:
-                avg = self._avg_buffer[flow_id][start_date]["avg"]
-                amount = self._avg_buffer[flow_id][start_date]["count"]
-                city_output.append(DurAvgOut(start_date, avg, amount).encode())
-        self._avg_buffer.pop(flow_id)
+        if message.drop:
+            self._avg_buffer.discard(flow_id)
+        else:
+            city_output = self.__results(self._avg_buffer.pop(flow_id))
+        self._provisional.pop(flow_id)
         return {
             self.router.route(): city_output,
             eof_output_queue: message,
         }
 
+    def handle_watermark(self, flow_id: str, message: Watermark) -> OutgoingMessages:
+        # Days before the watermark can no longer change, so they are sent now and forgotten
+        self._avg_buffer.unspill(flow_id)
+        finished_days = sorted(day for day in self._avg_buffer.keys(flow_id) if day < message.day)
+        city_output = []
+        for start_day in finished_days:
+            aggregate = self._avg_buffer.remove(flow_id, start_day)
+            city_output.append(DurAvgOut(day_to_date_str(start_day), aggregate.mean(), aggregate.count).encode())
+        return OutgoingMessages({self.router.route(): city_output})
+
     def handle_message(self, flow_id, message: bytes) -> Dict[str, List[bytes]]:
         packet = PrecFilterIn.decode(message)
 
-        self._avg_buffer.setdefault(flow_id, {})
-        self._avg_buffer[flow_id].setdefault(packet.start_date, {"avg": 0, "count": 0})
-        old_avg = self._avg_buffer[flow_id][packet.start_date]["avg"]
-        old_count = self._avg_buffer[flow_id][packet.start_date]["count"]
-        new_count = old_count + 1
-        new_avg = (old_avg * old_count + packet.duration_sec) / new_count
-        self._avg_buffer[flow_id][packet.start_date]["avg"] = new_avg
-        self._avg_buffer[flow_id][packet.start_date]["count"] = new_count
+        # Combining filters send partial aggregates instead of every value
+        if isinstance(packet, MeanPartial):
+            key = packet.key
+        else:
+            key = packet.start_day
+
+        aggregate = self._avg_buffer.entry(flow_id, key)
+        if isinstance(packet, MeanPartial):
+            aggregate.merge(MeanAggregate.from_state(packet.aggregate))
+        else:
+            aggregate.add(packet.duration_sec)
 
+        if self._provisional.tick(flow_id):
+            return {self.router.route(): [ProvisionalResults(self.__results(self._avg_buffer.items(flow_id))).encode()]}
         return {}
 
     def get_state(self) -> dict:
         return {
-            "avg_buffer": self._avg_buffer,
+            "avg_buffer": self._avg_buffer.get_state(),
+            "provisional": self._provisional.get_state(),
             "parent_state": super().get_state()
         }
 
     def set_state(self, state: dict):
-        self._avg_buffer = state["avg_buffer"]
+        self._avg_buffer.set_state(state["avg_buffer"])
+        self._provisional.set_state(state["provisional"])
         super().set_state(state["parent_state"])
 
 
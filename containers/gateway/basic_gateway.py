@@ -8,16 +8,20 @@ from abc import ABC
 from typing import Dict, List
 
 from common import utils
+from common.components import key_load
 from common.components.heartbeater.heartbeater import HeartBeater
+from common.components.membership import MEMBERSHIP
 from common.components.message_sender import MessageSender, OutgoingMessages
 from common.components.readers import ClientIdResponsePacket
-from common.packets.client_control_packet import ClientControlPacket, RateLimitChangeRequest
-from common.packets.client_packet import ClientDataPacket, ClientPacket
+from common.packets.client_control_packet import ClientControlPacket, RateLimitChangeRequest, ResumeResponse, \
+    UploadPosition
+from common.packets.client_packet import ClientDataPacket, ClientPacket, ResumeRequest
 from common.rate_checker import RateChecker, Rates
 from common.router import Router
 from common.utils import save_state, load_state, min_hash, log_duplicate, trace
 from common.packets.eof import Eof
 from common.packets.generic_packet import GenericPacketBuilder
+from common.packets.watermark import Watermark
 from common.middleware.rabbit_middleware import Rabbit
 from client_healthcheck import ClientHealthChecker
 
@@ -28,11 +32,15 @@ EOF_ROUTING_KEY = os.environ["EOF_ROUTING_KEY"]
 
 NEXT = os.environ["NEXT"]
 NEXT_AMOUNT = int(os.environ["NEXT_AMOUNT"])
+# Rejected by the router, the weather aggregators do not merge partial results
+HOT_KEY_SPLIT = int(os.environ.get("HOT_KEY_SPLIT", "1"))
 
 RABBIT_HOST = os.environ.get("RABBIT_HOST", "rabbitmq")
 MAX_SEQ_NUMBER = 2 ** 10  # 2 packet ids would be enough, but we use more for traceability
 
 RATE_CHECK_INTERVAL = 5
+# "bytes" also sends clients a byte rate, so they pace on the size of their chunks and not on their amount
+RATE_LIMIT_UNIT = os.environ.get("RATE_LIMIT_UNIT", "bytes")
 
 
 class BasicGateway(ABC):
@@ -42,15 +50,25 @@ class BasicGateway(ABC):
         self._basic_gateway_container_id = container_id
         self._last_chunk_received = None
         self._last_eof_received = None
+        # [flow_id]: membership epoch the flow is pinned to
+        self._flow_epochs: Dict[str, int] = {}
+        # [client_id][city]: [packets accepted in order, file, chunks] of the last of them, sent back on resume
+        self._accepted: Dict[str, Dict[str, List[int]]] = {}
 
-        self.router = Router(NEXT, NEXT_AMOUNT)
+        self.router = Router(NEXT, NEXT_AMOUNT, HOT_KEY_SPLIT)
         self.heartbeater = HeartBeater()
         self._rate_checker = RateChecker()
+        # Size of the data received since the last rate check
+        self._received_bytes = 0
+        self._received_messages = 0
+        self._bytes_per_message = None
         self._message_sender = MessageSender(self._rabbit)
         self.health_checker = ClientHealthChecker(
-            self._rabbit, self.router, self._basic_gateway_container_id, self.save_state)
+            self._rabbit, self.router, self._basic_gateway_container_id, self.save_state,
+            on_evict=self.__forget_client)
 
         self.__setup_state()
+        MEMBERSHIP.mark_ready(container_id)
 
     def __setup_state(self):
         state = load_state()
@@ -66,12 +84,20 @@ class BasicGateway(ABC):
         self._rabbit.route(self._input_queue, "publish", eof_routing_key)
 
     def __handle_chunk(self, flow_id, chunk: List[bytes]) -> OutgoingMessages:
+        # A packet holds as many chunks as the client sized it for, and whatever they produce goes
+        # downstream as a single message per queue, so batches downstream follow the size of packets
         outgoing_messages = {}
+        watermarks = {}
         for message in chunk:
             responses = self.handle_message(flow_id, message)
             for (queue, messages) in responses.items():
+                if isinstance(messages, Watermark):
+                    watermarks[queue] = messages
+                    continue
                 outgoing_messages.setdefault(queue, [])
                 outgoing_messages[queue] += messages
+        # Watermarks go after every trip of the chunk
+        outgoing_messages.update(watermarks)
         return OutgoingMessages(outgoing_messages)
 
     def __on_stream_message_without_duplicates(self, decoded: ClientDataPacket) -> bool:
@@ -80,21 +106,65 @@ class BasicGateway(ABC):
 
         self.health_checker.ping(decoded.client_id, decoded.city_name, is_eof)
 
+        # Replicas added while the flow runs only get the next flows
+        epoch = self._flow_epochs.get(flow_id)
+        if epoch is None:
+            epoch = self._flow_epochs[flow_id] = MEMBERSHIP.latest()
+        MEMBERSHIP.enter(epoch)
+
         if is_eof:
-            outgoing_messages = self.handle_eof(decoded.data)
+            outgoing_messages = self.handle_eof(flow_id, decoded.data)
+            self._flow_epochs.pop(flow_id)
         elif decoded.is_chunk():
             outgoing_messages = self.__handle_chunk(flow_id, decoded.data)
         else:
             raise Exception(f"Unknown message type: {type(decoded.data)}")
 
-        builder = GenericPacketBuilder(self._basic_gateway_container_id, decoded.client_id, decoded.city_name)
+        builder = GenericPacketBuilder(self._basic_gateway_container_id, decoded.client_id, decoded.city_name,
+                                       epoch)
         self._message_sender.send(builder, outgoing_messages)
 
         return True
 
+    def __is_next(self, packet: ClientDataPacket) -> bool:
+        # Sequence numbers of a city go from 1 to MAX_SEQ_NUMBER, and then start again from 0
+        accepted = self._accepted.get(packet.client_id, {}).get(packet.city_name, [0])[0]
+        return packet.seq_number == (accepted + 1) % (MAX_SEQ_NUMBER + 1)
+
+    def __accept(self, packet: ClientDataPacket):
+        accepted = self._accepted.setdefault(packet.client_id, {}).setdefault(packet.city_name, [0, 0, 0])
+        accepted[0] += 1
+        if packet.position is not None:
+            accepted[1], accepted[2] = packet.position
+
+    def __forget_client(self, client_id: str):
+        self._accepted.pop(client_id, None)
+
+    def __handle_resume(self, request: ResumeRequest):
+        session_id = request.session_id
+        control_queue = utils.build_control_queue_name(session_id)
+        if not self.health_checker.is_client(session_id):
+            # Its flows were already dropped downstream, it has to start again with a new session
+            logging.info(f"action: resume | result: expired | session_id: {session_id}")
+            self._rabbit.produce(control_queue, ClientControlPacket("SessionExpired").encode())
+            return
+
+        self.health_checker.touch(session_id)
+        positions = {
+            city: UploadPosition(*accepted) for city, accepted in self._accepted.get(session_id, {}).items()
+        }
+        logging.info(f"action: resume | result: success | session_id: {session_id} | positions: {positions}")
+        response = ResumeResponse(request.request_id, positions)
+        self._rabbit.produce(control_queue, ClientControlPacket(response).encode())
+
     def __update_last_received(self, packet: ClientDataPacket) -> bool:
         packet_id = packet.get_id()
 
+        # Packets a client sent again after resuming, or left in the queue by its previous run
+        if not self.__is_next(packet):
+            log_duplicate(f"Received out of order packet {packet_id}-{min_hash(packet.data)} - ignoring")
+            return False
+
         if packet.is_eof():
             if packet_id == self._last_eof_received:
                 log_duplicate(
@@ -129,6 +199,10 @@ class BasicGateway(ABC):
 
     def __on_stream_message_callback(self, msg: bytes) -> bool:
         decoded = ClientPacket.decode(msg)
+        if isinstance(decoded.data, ResumeRequest):
+            # Every packet its previous run left in the queue was handled before this
+            self.__handle_resume(decoded.data)
+            return True
         if not isinstance(decoded.data, ClientDataPacket):
             self.__generate_and_send_client_id()
             return True
@@ -139,12 +213,16 @@ class BasicGateway(ABC):
             logging.warning(f"Received data from dead client {decoded.data.client_id}")
             return True
 
+        self._received_bytes += len(msg)
+        self._received_messages += 1
+
         if not self.__update_last_received(decoded.data):
             return True
 
         if not self.__on_stream_message_without_duplicates(decoded.data):
             return False
 
+        self.__accept(decoded.data)
         self.save_state()
         return True
 
@@ -152,7 +230,7 @@ class BasicGateway(ABC):
     def handle_message(self, flow_id, message: bytes) -> Dict[str, List[bytes]]:
         pass
 
-    def handle_eof(self, message: Eof) -> Dict[str, Eof]:
+    def handle_eof(self, flow_id, message: Eof) -> Dict[str, Eof]:
         eof_output_queue = self.router.publish()
 
         message.timestamp = time.time_ns()
@@ -161,6 +239,22 @@ class BasicGateway(ABC):
             eof_output_queue: message
         }
 
+    def get_flows_state(self) -> dict:
+        """
+        State of the flows kept by the gateway, saved along with the state of the basic gateway.
+        """
+        return {}
+
+    def set_flows_state(self, state: dict):
+        pass
+
+    def __update_bytes_per_message(self):
+        # Kept from the previous check if no data arrived since
+        if self._received_messages > 0:
+            self._bytes_per_message = self._received_bytes / self._received_messages
+        self._received_bytes = 0
+        self._received_messages = 0
+
     def __change_rates_if_needed(self, rates: Rates):
         users_amount = len(self.health_checker.get_clients())
         trace("rates: %d ack/s %d pub*s | users_amount: %d | difference %d",
@@ -176,7 +270,12 @@ class BasicGateway(ABC):
             # Decrease rate
             new_rate = math.ceil((rates.ack_per_second + 1) / users_amount)
 
-        trace(f"action: change_rate | new_rate: {new_rate}")
+        # The rate in packets is what the pipeline acks, in bytes it is shared among chunks of any size
+        new_byte_rate = None
+        if RATE_LIMIT_UNIT == "bytes" and self._bytes_per_message is not None:
+            new_byte_rate = math.ceil(new_rate * self._bytes_per_message)
+
+        trace(f"action: change_rate | new_rate: {new_rate} | new_byte_rate: {new_byte_rate}")
 
         if new_rate == 0:
             trace("Rate not changed because it would be 0")
@@ -184,13 +283,14 @@ class BasicGateway(ABC):
 
         for user in self.health_checker.get_clients():
             client_control_queue = f"control_{user}"
-            packet = RateLimitChangeRequest(new_rate)
+            packet = RateLimitChangeRequest(new_rate, new_byte_rate, rates.messages)
 
             self._rabbit.produce(client_control_queue, ClientControlPacket(packet).encode())
 
         self.health_checker.set_expected_client_rate(new_rate)
 
     def __check_rates(self):
+        self.__update_bytes_per_message()
         rates = self._rate_checker.get_rates(self._input_queue)
         if rates is None:
             logging.debug("action: check_rate | result: no data")
@@ -211,6 +311,10 @@ class BasicGateway(ABC):
             "last_chunk_received": self._last_chunk_received,
             "last_eof_received": self._last_eof_received,
             "health_checker": self.health_checker.get_state(),
+            "key_load": key_load.get_state(),
+            "flow_epochs": self._flow_epochs,
+            "accepted": self._accepted,
+            "flows": self.get_flows_state(),
         }
         return pickle.dumps(state)
 
@@ -220,6 +324,10 @@ class BasicGateway(ABC):
         self.health_checker.set_state(state["health_checker"])
         self._last_chunk_received = state["last_chunk_received"]
         self._last_eof_received = state["last_eof_received"]
+        key_load.set_state(state.get("key_load", {}))
+        self._flow_epochs = state.get("flow_epochs", {})
+        self._accepted = state.get("accepted", {})
+        self.set_flows_state(state.get("flows", {}))
 
     def save_state(self):
         save_state(self.get_state())
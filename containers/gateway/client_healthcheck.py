@@ -6,6 +6,7 @@ from common import utils
 from common.router import Router
 from common.packets.eof import Eof
 from common.middleware.rabbit_middleware import Rabbit
+from common.components.membership import MEMBERSHIP
 from common.components.message_sender import MessageSender, OutgoingMessages
 from common.packets.generic_packet import GenericPacketBuilder
 from common.packets.client_control_packet import ClientControlPacket
@@ -29,7 +30,8 @@ class ClientHealthChecker:
                  lapse: int = HEALTHCHECK_LAPSE,
                  initial_client_timeout: float = INITIAL_CLIENT_TIMEOUT,
                  client_timeout_to_lapse_ratio: int = CLIENT_TIMEOUT_TO_LAPSE_RATIO,
-                 eviction_time: int = EVICTION_TIME
+                 eviction_time: int = EVICTION_TIME,
+                 on_evict: Optional[Callable[[str], None]] = None
                  ) -> None:
 
         self._rabbit = _rabbit
@@ -42,8 +44,10 @@ class ClientHealthChecker:
         self._client_timeout = initial_client_timeout
         self._client_timeout_to_lapse_ratio = client_timeout_to_lapse_ratio
         self._eviction_time = eviction_time
+        self._on_evict = on_evict
 
         self._clients = {}  # [client_id]: (last_city, last_time, finished)
+        self._open_cities = {}  # [client_id]: cities with data and no EOF yet, a client may upload several at once
         self._evicting = set()  # [client_id]
 
         self._message_sender = MessageSender(self._rabbit)
@@ -53,14 +57,19 @@ class ClientHealthChecker:
         control_queue = utils.build_control_queue_name(client_id)
         self._rabbit.produce(control_queue, ClientControlPacket("SessionExpired").encode())
 
-        # Send EOF to the next replica with eviction time
-        builder = GenericPacketBuilder(self._container_id, client_id, last_city)
-        eof = Eof(drop, self._eviction_time)
-        outgoing_messages = {self._output_queue: eof}
-
-        self._message_sender.send(builder, OutgoingMessages(outgoing_messages))
+        # Send EOF to the next replica with eviction time, for every city the client left unfinished
+        # Any epoch since the flow started works for its EOF, every replica that got its data is a member
+        open_cities = self._open_cities.pop(client_id, set())
+        flows = {city: True for city in sorted(open_cities)} if len(open_cities) > 0 else {last_city: drop}
+        for city, drop_city in flows.items():
+            builder = GenericPacketBuilder(self._container_id, client_id, city, MEMBERSHIP.latest())
+            eof = Eof(drop_city, self._eviction_time)
+            outgoing_messages = {self._output_queue: eof}
+            self._message_sender.send(builder, OutgoingMessages(outgoing_messages))
         if client_id in self._clients:
             del self._clients[client_id]
+        if self._on_evict is not None:
+            self._on_evict(client_id)
 
         log_evict(f"Evicting client {client_id} | Drop: {drop}")
 
@@ -92,6 +101,19 @@ class ClientHealthChecker:
 
     def ping(self, client_id: str, city: Optional[str], finished: bool = False):
         self._clients[client_id] = (city, time.time(), finished)
+        if city is None:
+            return
+        if finished:
+            self._open_cities.get(client_id, set()).discard(city)
+        else:
+            self._open_cities.setdefault(client_id, set()).add(city)
+
+    def touch(self, client_id: str):
+        """
+        Keeps the client alive without a packet of a city, as when it resumes its upload.
+        """
+        last_city, _, finished = self._clients[client_id]
+        self._clients[client_id] = (last_city, time.time(), finished)
 
     def set_expected_client_rate(self, rate: float):
         expected_lapse = 1 / rate
@@ -122,10 +144,12 @@ class ClientHealthChecker:
         return {
             "clients": self._clients,
             "evicting": list(self._evicting),
+            "open_cities": {client_id: sorted(cities) for client_id, cities in self._open_cities.items()},
             "message_sender": self._message_sender.get_state()
         }
 
     def set_state(self, state: dict):
         self._clients = state["clients"]
         self._evicting = set(state["evicting"])
+        self._open_cities = {client_id: set(cities) for client_id, cities in state.get("open_cities", {}).items()}
         self._message_sender.set_state(state["message_sender"])
@@ -1,27 +1,85 @@
 import os
-from typing import Dict, List, Union
+import pickle
+from typing import Dict, List, Union, Tuple
 
 from basic_gateway import BasicGateway
 from common.components.message_sender import OutgoingMessages
+from common.components.watermarks import EventTimeClock
 from common.packets.gateway_in_or_weather import GatewayInOrWeather
 from common.packets.gateway_out_or_station import GatewayOutOrStation
 from common.packets.station_side_table_info import StationSideTableInfo
 from common.packets.gateway_in import GatewayIn
+from common.packets.eof import Eof
+from common.packets.joined_station import JoinedStation
+from common.packets.watermark import Watermark
 from common.packets.weather_side_table_info import WeatherSideTableInfo
 from common.components.readers import ClientGatewayPacket, StationInfo, WeatherInfo, TripInfo
-from common.utils import initialize_log
+from common.router import Router
+from common.utils import initialize_log, date_str_to_day, save_state, load_state
 
 WEATHER_SIDE_TABLE_QUEUE_NAME = os.environ["WEATHER_SIDE_TABLE_QUEUE_NAME"]
 STATION_SIDE_TABLE_QUEUE_NAME = os.environ["STATION_SIDE_TABLE_QUEUE_NAME"]
+# "broadcast" publishes every station to all the station aggregators, "code" routes each one to its owner
+STATION_PARTITIONING = os.environ.get("STATION_PARTITIONING", "broadcast")
+STATION_AGGREGATOR_QUEUE = os.environ.get("STATION_AGGREGATOR_QUEUE")
+NEXT_AMOUNT_STATION_AGGREGATOR = os.environ.get("NEXT_AMOUNT_STATION_AGGREGATOR")
+END_STATIONS_STATE_PATH = "/volumes/end_stations"
 
 
 class Gateway(BasicGateway):
-    def __init__(self, weather_side_table_queue_name: str, station_side_table_queue_name: str):
+    def __init__(self, weather_side_table_queue_name: str, station_side_table_queue_name: str,
+                 station_router: Union[Router, None] = None):
         self._weather_side_table_queue_name = weather_side_table_queue_name
         self._station_side_table_queue_name = station_side_table_queue_name
+        # With stations partitioned by code, trips carry their end station joined here,
+        # so each station aggregator only needs the start stations it owns
+        self._station_router = station_router
+        # [flow_id][(code, yearid)]: end station
+        self._end_stations: Dict[str, Dict[Tuple[int, int], JoinedStation]] = {}
+        self._clock = EventTimeClock()
 
         super().__init__()
 
+        if self._station_router is not None:
+            self.__load_end_stations()
+
+    def __load_end_stations(self):
+        state = load_state(END_STATIONS_STATE_PATH)
+        if state is not None:
+            self._end_stations = pickle.loads(state)
+
+    def __save_end_stations(self):
+        # Kept apart from the gateway state, which is saved after every chunk
+        save_state(pickle.dumps(self._end_stations), END_STATIONS_STATE_PATH)
+
+    def __handle_stations(self, flow_id, packet: List[StationInfo]) -> OutgoingMessages:
+        if self._station_router is None:
+            return OutgoingMessages({
+                self._station_side_table_queue_name: [self.__encode_station(s) for s in packet]
+            })
+
+        end_stations = self._end_stations.setdefault(flow_id, {})
+        outgoing_messages = {}
+        for station_info in packet:
+            end_stations[(station_info.code, station_info.yearid)] = JoinedStation(
+                station_info.name, station_info.latitude, station_info.longitude
+            )
+            queue_name = self._station_router.route(str(station_info.code))
+            outgoing_messages.setdefault(queue_name, []).append(self.__encode_station(station_info))
+        self.__save_end_stations()
+        return OutgoingMessages(outgoing_messages)
+
+    @staticmethod
+    def __encode_station(station_info: StationInfo) -> bytes:
+        return GatewayOutOrStation(
+            StationSideTableInfo(
+                station_info.code,
+                station_info.yearid,
+                station_info.name, station_info.latitude,
+                station_info.longitude
+            )
+        ).encode()
+
     def __handle_list(self, flow_id, packet: List[Union[WeatherInfo, StationInfo, TripInfo]]) -> OutgoingMessages:
         if len(packet) == 0:
             return OutgoingMessages({})
@@ -31,44 +89,57 @@ class Gateway(BasicGateway):
             for weather_info in packet:
                 packets_to_send.append(
                     GatewayInOrWeather(
-                        WeatherSideTableInfo(weather_info.date, weather_info.prectot)).encode())
+                        WeatherSideTableInfo(date_str_to_day(weather_info.date), weather_info.prectot)).encode())
             return OutgoingMessages({
                 self._weather_side_table_queue_name: packets_to_send
             })
         elif element_type == StationInfo:
-            packets_to_send = []
-            for station_info in packet:
-                packets_to_send.append(
-                    GatewayOutOrStation(
-                        StationSideTableInfo(
-                            station_info.code,
-                            station_info.yearid,
-                            station_info.name, station_info.latitude,
-                            station_info.longitude
-                        )
-                    ).encode()
-                )
-            return OutgoingMessages({
-                self._station_side_table_queue_name: packets_to_send
-            })
+            return self.__handle_stations(flow_id, packet)
         elif element_type == TripInfo:
-            queue_name = self.router.route(packet[0].start_datetime)
+            # Dates are parsed once here, the rest of the pipeline works with day numbers
+            start_days = [date_str_to_day(t.start_datetime) for t in packet]
+            queue_name = self.router.route(start_days[0])
+            end_stations = self._end_stations.get(flow_id, {}) if self._station_router is not None else None
             packets_to_send = []
-            for t in packet:
+            watermark = None
+            for t, start_day in zip(packet, start_days):
+                late = False
+                if self._clock.enabled():
+                    # Days before the watermark may already be finalized downstream, only that branch drops them
+                    late = self._clock.is_late(flow_id, start_day)
+                    advanced = self._clock.advance(flow_id, start_day)
+                    if advanced is not None:
+                        watermark = advanced
                 gateway_in = GatewayIn(
-                    t.start_datetime,
-                    t.start_station_code, t.end_datetime,
-                    t.end_station_code, t.duration_sec, t.is_member,
+                    start_day,
+                    t.start_station_code,
+                    t.end_station_code, t.duration_sec,
                     t.yearid
                 )
+                gateway_in.late = late
+                if end_stations is not None:
+                    gateway_in.end_station = end_stations.get((t.end_station_code, t.yearid))
                 packets_to_send.append(GatewayInOrWeather(gateway_in).encode())
 
-            return OutgoingMessages({
-                queue_name: packets_to_send
-            })
+            outgoing_messages = {queue_name: packets_to_send}
+            if watermark is not None:
+                outgoing_messages[self.router.publish()] = Watermark(watermark)
+            return OutgoingMessages(outgoing_messages)
         else:
             raise ValueError(f"Unknown packet type: {element_type}")
 
+    def handle_eof(self, flow_id, message: Eof) -> Dict[str, Eof]:
+        if self._end_stations.pop(flow_id, None) is not None:
+            self.__save_end_stations()
+        self._clock.pop(flow_id)
+        return super().handle_eof(flow_id, message)
+
+    def get_flows_state(self) -> dict:
+        return {"clock": self._clock.get_state()}
+
+    def set_flows_state(self, state: dict):
+        self._clock.set_state(state.get("clock", {}))
+
     def handle_message(self, flow_id, message: bytes) -> Dict[str, List[bytes]]:
         packet = ClientGatewayPacket.decode(message)
 
@@ -80,8 +151,12 @@ class Gateway(BasicGateway):
 
 def main():
     initialize_log(15)
+    station_router = None
+    if STATION_PARTITIONING == "code":
+        station_router = Router(STATION_AGGREGATOR_QUEUE, int(NEXT_AMOUNT_STATION_AGGREGATOR))
     gateway = Gateway(WEATHER_SIDE_TABLE_QUEUE_NAME,
-                      STATION_SIDE_TABLE_QUEUE_NAME)
+                      STATION_SIDE_TABLE_QUEUE_NAME,
+                      station_router)
     gateway.start()
 
 
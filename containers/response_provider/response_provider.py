@@ -3,15 +3,16 @@ import os
 import signal
 import pickle
 
-from typing import Dict
+from typing import Dict, List
 
 from common import utils
 from common.components.heartbeater.heartbeater import HeartBeater
+from common.components.last_received import MultiLastReceivedManager
 from common.packets.generic_packet import GenericPacket
 from common.packets.eof import Eof
 from common.packets.client_response_packets import GenericResponsePacket
 from common.middleware.rabbit_middleware import Rabbit
-from common.utils import initialize_log, save_state, load_state, min_hash, log_duplicate, log_evict, trace, \
+from common.utils import initialize_log, save_state, load_state, log_evict, trace, \
     RESULTS_ROUTING_KEY, PUBLISH_ROUTING_KEY
 
 SELF_QUEUE = f"sent_responses"
@@ -25,7 +26,7 @@ DUR_AVG_AMOUNT = int(os.environ["DUR_AVG_AMOUNT"])
 
 class ResponseProvider:
     def __init__(self):
-        self._last_received = {}
+        self._last_received = MultiLastReceivedManager()
         self._eofs_received = {}
         self._evicting_received = {}
         self._evicting: Dict[str, int] = {}
@@ -52,31 +53,6 @@ class ResponseProvider:
 
         self._sig_hand_prev = signal.signal(signal.SIGTERM, signal_handler)
 
-    def __update_last_received(self, packet_type: str, packet: GenericPacket):
-        sender_id = (packet_type, packet.sender_id)
-
-        current_id = packet.get_id()
-        self._last_received.setdefault(sender_id, [None, None])
-        last_chunk_id, last_eof_id = self._last_received[sender_id]
-
-        if packet.is_eof():
-            if current_id == last_eof_id:
-                log_duplicate(
-                    f"Received duplicate EOF {sender_id}-{current_id}-{min_hash(packet.data)} - ignoring")
-                return False
-            self._last_received[sender_id][1] = current_id
-        elif packet.is_chunk():
-            if current_id == last_chunk_id:
-                log_duplicate(
-                    f"Received duplicate chunk {sender_id}-{current_id}-{min_hash(packet.data)} - ignoring")
-                return False
-            self._last_received[sender_id][0] = current_id
-
-        logging.debug(
-            f"Received {sender_id}-{current_id}-{min_hash(packet.data)}")
-
-        return True
-
     def __send_response(self, destination: str, message: bytes):
 
         result_queue = utils.build_results_queue_name(destination)
@@ -144,7 +120,7 @@ class ResponseProvider:
 
         packet = GenericPacket.decode(message)
 
-        if not self.__update_last_received(packet_type, packet):
+        if not self._last_received.update(packet):
             return True
 
         if isinstance(packet.data, Eof):
@@ -173,7 +149,7 @@ class ResponseProvider:
 
     def __save_state(self):
         state = {
-            "_last_received": self._last_received,
+            "_last_received": self._last_received.get_state(),
             "_eofs_received": self._eofs_received,
             "_evicting_received": self._evicting_received,
             "_evicting": self._evicting,
@@ -187,25 +163,22 @@ class ResponseProvider:
 
         state = pickle.loads(state_bytes)
         if state is not None:
-            self._last_received = state["_last_received"]
+            self._last_received.set_state(state["_last_received"])
             self._eofs_received = state["_eofs_received"]
             self._evicting_received = state["_evicting_received"]
             self._evicting = state["_evicting"]
 
     def __load_last_sent(self):
-        self._rabbit.consume_until_empty(SELF_QUEUE, self.__handle_last_sent)
-
-    def __handle_last_sent(self, message: bytes) -> bool:
-        packet = GenericResponsePacket.decode(message)
-        sender_id = (packet.type, packet.sender_id)
+        self._rabbit.drain(SELF_QUEUE, self.__handle_last_sent)
 
-        self._last_received[sender_id].setdefault(packet.client_id, [None, None])
-        if packet.is_eof():
-            self._last_received[sender_id][1] = packet.get_id()
-        else:
-            self._last_received[sender_id][0] = packet.get_id()
+    def __handle_last_sent(self, messages: List[bytes]) -> bool:
+        for message in messages:
+            packet = GenericResponsePacket.decode(message)
+            self._last_received.mark_received(packet.sender_id, packet.seq_number)
 
+        # Persisted once per batch, the batch is acked only after this
         self.__save_state()
+        logging.info(f"action: load_last_sent | result: success | amount: {len(messages)}")
 
         return True
 
@@ -227,7 +200,8 @@ class ResponseProvider:
         self._rabbit.route(trip_count_queue, PUBLISH_ROUTING_KEY, trip_count_queue)
         self._rabbit.route(avg_queue, PUBLISH_ROUTING_KEY, avg_queue)
 
-        # Returns True every time, as this is already saved to disk if reading at runtime
+        # Returns True every time, as this is already saved to disk if reading at runtime.
+        # This keeps sent_responses compacted, only what was sent right before a crash remains on startup
         self._rabbit.consume(SELF_QUEUE, lambda _message: True)
 
         self._heartbeater.start()
@@ -1,18 +1,26 @@
 #!/usr/bin/env python3
+import base64
+import logging
+import math
 import os
-import json
-import typing
-from typing import Dict, List, Union, Tuple
+from array import array
+from typing import Dict, List, Tuple, Optional
+
+from haversine import haversine
 
 from common.basic_classes.basic_aggregator import BasicAggregator
+from common.components.message_sender import OutgoingMessages
+from common.components.side_table_image import SharedSideTables, SideTableImage
+from common.packets.dist_info import DistInfo
 from common.packets.distance_calc_in import DistanceCalcIn
 from common.packets.eof import Eof
 from common.packets.gateway_out import GatewayOut
 from common.packets.gateway_out_or_station import GatewayOutOrStation
 from common.packets.prec_filter_in import PrecFilterIn
 from common.packets.station_side_table_info import StationSideTableInfo
+from common.packets.watermark import Watermark
 from common.packets.year_filter_in import YearFilterIn
-from common.router import MultiRouter
+from common.router import MultiRouter, Router
 from common.utils import initialize_log, log_missing
 
 PREC_FILTER_QUEUE = os.environ["PREC_FILTER_QUEUE"]
@@ -21,124 +29,339 @@ YEAR_FILTER_QUEUE = os.environ["YEAR_FILTER_QUEUE"]
 NEXT_AMOUNT_YEAR_FILTER = int(os.environ["NEXT_AMOUNT_YEAR_FILTER"])
 DISTANCE_CALCULATOR_QUEUE = os.environ["DISTANCE_CALCULATOR_QUEUE"]
 NEXT_AMOUNT_DISTANCE_CALCULATOR = int(os.environ["NEXT_AMOUNT_DISTANCE_CALCULATOR"])
+# Sends DistInfo straight to the dist_mean_calculator, EOFs keep going through the distance_calculator
+SKIP_DISTANCE_CALCULATOR = os.environ.get("SKIP_DISTANCE_CALCULATOR", "false").lower() == "true"
+DIST_MEAN_CALCULATOR_QUEUE = os.environ.get("DIST_MEAN_CALCULATOR_QUEUE")
+NEXT_AMOUNT_DIST_MEAN_CALCULATOR = os.environ.get("NEXT_AMOUNT_DIST_MEAN_CALCULATOR")
+# Only used for the dist_mean_calculator shortcut, the filters are routed by start station
+HOT_KEY_SPLIT = int(os.environ.get("HOT_KEY_SPLIT", "1"))
 
-PacketLists = typing.NewType("PacketLists", Tuple[List[bytes], List[bytes], List[bytes]])
+# With "code", each replica only receives the stations it owns and trips carry their end station
+STATION_PARTITIONING = os.environ.get("STATION_PARTITIONING", "broadcast")
 
-StationData = typing.NewType("StationData", Dict[str, Union[str, float, None]])
-StationsData = typing.NewType("StationsData", Dict[str, StationData])
+# Packs (code, yearid) in a single int, codes are assumed to fit in 32 bits
+STATION_KEY_SHIFT = 32
+NO_ROW = -1
 
+# (row or code, name, latitude, longitude) of the end station of a trip
+EndStation = Tuple[int, str, float, float]
 
-class StationAggregator(BasicAggregator):
-    def __init__(self, router: MultiRouter):
-        self._stations: StationsData = StationsData({})
-        super().__init__(router)
 
-    def handle_eof(self, flow_id, message: Eof) -> Dict[str, Eof]:
-        self._stations.pop(flow_id, None)
-        return super().handle_eof(flow_id, message)
+class StationIndex:
+    """
+    Stations of a flow stored as a struct of arrays, one row per (code, yearid).
+    Names are interned, every row holds the id of its name.
+
+    Once trips arrive the stations are complete, and the index can be sealed into an image
+    shared with the other replicas of the host.
+    """
+
+    def __init__(self):
+        self._shared_side_tables: Optional[SharedSideTables] = None
+        self._image: Optional[SideTableImage] = None
+        self._rows: Dict[int, int] = {}
+        self._keys = array("q")
+        self._name_ids = array("i")
+        self._latitudes = array("d")
+        self._longitudes = array("d")
+        self._names: List[str] = []
+        self._name_to_id: Dict[str, int] = {}
 
     @staticmethod
-    def __build_dict_key(station_code: int, yearid: int) -> str:
-        return f"{station_code}-{yearid}"
+    def key(station_code: int, yearid: int) -> int:
+        return (yearid << STATION_KEY_SHIFT) + station_code
 
-    def __handle_side_table_message(self, flow_id: str, packet: StationSideTableInfo):
-        station_code, yearid = packet.station_code, packet.yearid
+    def __intern(self, name: str) -> int:
+        name_id = self._name_to_id.get(name)
+        if name_id is None:
+            name_id = self._name_to_id[name] = len(self._names)
+            self._names.append(name)
+        return name_id
+
+    def set(self, station_code: int, yearid: int, name: str,
+            latitude: Optional[float], longitude: Optional[float]):
+        if self._image is not None:
+            self.__unseal()
+
+        key = self.key(station_code, yearid)
+        name_id = self.__intern(name)
+        # Missing coordinates are kept as NaN
+        latitude = math.nan if latitude is None else latitude
+        longitude = math.nan if longitude is None else longitude
+
+        row = self._rows.get(key)
+        if row is None:
+            self._rows[key] = len(self._keys)
+            self._keys.append(key)
+            self._name_ids.append(name_id)
+            self._latitudes.append(latitude)
+            self._longitudes.append(longitude)
+        else:
+            self._name_ids[row] = name_id
+            self._latitudes[row] = latitude
+            self._longitudes[row] = longitude
+
+    def find_rows(self, keys: List[int]) -> List[int]:
+        rows = self._rows
+        return [rows.get(key, NO_ROW) for key in keys]
+
+    def name(self, row: int) -> str:
+        return self._names[self._name_ids[row]]
 
-        self._stations.setdefault(flow_id, {})
-        dict_key = self.__build_dict_key(station_code, yearid)
+    def latitude(self, row: int) -> float:
+        return self._latitudes[row]
 
-        self._stations[flow_id][dict_key] = {
-            "station_name": packet.station_name,
-            "latitude": packet.latitude,
-            "longitude": packet.longitude,
+    def longitude(self, row: int) -> float:
+        return self._longitudes[row]
+
+    def is_sealed(self) -> bool:
+        return self._image is not None
+
+    def seal(self, shared_side_tables: SharedSideTables, flow_id: str):
+        image = shared_side_tables.publish(flow_id, "stations", {
+            "keys": self._keys,
+            "name_ids": self._name_ids,
+            "latitudes": self._latitudes,
+            "longitudes": self._longitudes,
+        }, {"names": self._names})
+        self.__attach(shared_side_tables, image)
+
+    def __unseal(self):
+        # Stations arriving after the trips get a private copy again
+        self._keys = array("q", self._keys)
+        self._name_ids = array("i", self._name_ids)
+        self._latitudes = array("d", self._latitudes)
+        self._longitudes = array("d", self._longitudes)
+        self._names = list(self._names)
+        self.close()
+
+    def __attach(self, shared_side_tables: SharedSideTables, image: SideTableImage):
+        self._shared_side_tables = shared_side_tables
+        self._image = image
+        self._names = image.meta["names"]
+        self._name_to_id = {name: name_id for name_id, name in enumerate(self._names)}
+        self._keys = image.column("keys")
+        self._name_ids = image.column("name_ids")
+        self._latitudes = image.column("latitudes")
+        self._longitudes = image.column("longitudes")
+        self._rows = {key: row for row, key in enumerate(self._keys)}
+
+    def close(self):
+        if self._image is not None:
+            self._shared_side_tables.release(self._image)
+            self._image = None
+
+    def get_state(self) -> dict:
+        if self._image is not None:
+            return {"image": self._image.path}
+        return {
+            "names": self._names,
+            "keys": self.__encode_array(self._keys),
+            "name_ids": self.__encode_array(self._name_ids),
+            "latitudes": self.__encode_array(self._latitudes),
+            "longitudes": self.__encode_array(self._longitudes),
         }
 
-    def __search_station(self, flow_id, station_code: int, yearid: int) -> Union[dict, None]:
-        dict_key = self.__build_dict_key(station_code, yearid)
-        if flow_id not in self._stations:
-            return None
-        return self._stations[flow_id].get(dict_key, None)
-
-    def __search_stations(self, flow_id, packet) -> Union[Tuple[dict, dict], None]:
-
-        start_station = self.__search_station(flow_id,
-                                              packet.start_station_code,
-                                              packet.yearid)
-        if not start_station:
-            return None
-        end_station = self.__search_station(flow_id,
-                                            packet.end_station_code,
-                                            packet.yearid)
-        if not end_station:
-            return None
-        return start_station, end_station
+    @staticmethod
+    def from_state(state: dict, shared_side_tables: Optional[SharedSideTables]) -> "StationIndex":
+        index = StationIndex()
+        if "image" in state:
+            index.__attach(shared_side_tables, shared_side_tables.attach(state["image"]))
+            return index
+
+        index._names = state["names"]
+        index._name_to_id = {name: name_id for name_id, name in enumerate(index._names)}
+        index._keys = StationIndex.__decode_array("q", state["keys"])
+        index._name_ids = StationIndex.__decode_array("i", state["name_ids"])
+        index._latitudes = StationIndex.__decode_array("d", state["latitudes"])
+        index._longitudes = StationIndex.__decode_array("d", state["longitudes"])
+        index._rows = {key: row for row, key in enumerate(index._keys)}
+        return index
 
     @staticmethod
-    def __build_packet_lists(packet: GatewayOut, stations: Tuple[dict, dict]) -> PacketLists:
-        start_station_info = stations[0]
-        end_station_info = stations[1]
+    def __encode_array(values: array) -> str:
+        return base64.b64encode(values.tobytes()).decode()
+
+    @staticmethod
+    def __decode_array(typecode: str, encoded: str) -> array:
+        values = array(typecode)
+        values.frombytes(base64.b64decode(encoded))
+        return values
 
-        prec_filter_in_packet = PrecFilterIn(
-            packet.start_date, packet.duration_sec, packet.prectot
-        )
 
-        year_filter_in_packet = YearFilterIn(
-            start_station_info["station_name"], packet.yearid
+class StationAggregator(BasicAggregator):
+    def __init__(self, router: MultiRouter, dist_mean_router: Optional[Router] = None,
+                 co_partitioned: bool = False):
+        self._stations: Dict[str, StationIndex] = {}
+        # [flow_id][(start_row << 32) + end row or code]: km, derived from the stations so it is not persisted
+        self._distances: Dict[str, Dict[int, float]] = {}
+        # [flow_id]: late trips left out of the durations
+        self._late_trips: Dict[str, int] = {}
+        self._dist_mean_router = dist_mean_router
+        self._co_partitioned = co_partitioned
+        super().__init__(router)
+
+    def handle_eof(self, flow_id, message: Eof) -> Dict[str, Eof]:
+        stations = self._stations.pop(flow_id, None)
+        if stations is not None:
+            stations.close()
+        self._distances.pop(flow_id, None)
+        late_trips = self._late_trips.pop(flow_id, 0)
+        if late_trips > 0:
+            logging.warning(f"action: drop_late_trips | flow_id: {flow_id} | amount: {late_trips}")
+        return super().handle_eof(flow_id, message)
+
+    def handle_watermark(self, flow_id, message: Watermark) -> Dict[str, Watermark]:
+        # Only the durations are aggregated by day, the other branches need the whole flow anyway
+        return {self.router.publish_to("prec_filter"): message}
+
+    def __handle_side_table_message(self, flow_id: str, packet: StationSideTableInfo):
+        self._stations.setdefault(flow_id, StationIndex())
+        self._distances.pop(flow_id, None)
+        self._stations[flow_id].set(packet.station_code, packet.yearid, packet.station_name,
+                                    packet.latitude, packet.longitude)
+
+    def __get_distance(self, flow_id, start: Tuple[float, float], end: Tuple[float, float],
+                       key: int) -> float:
+        distances = self._distances.setdefault(flow_id, {})
+        distance = distances.get(key)
+        if distance is None:
+            distance = haversine(start, end)
+            distances[key] = distance
+        return distance
+
+    def __build_distance_output(self, flow_id, packet: GatewayOut, stations: StationIndex,
+                                start_row: int, end: EndStation) -> Tuple[str, Optional[bytes]]:
+        end_key, end_station_name, end_latitude, end_longitude = end
+        start_coordinates = (stations.latitude(start_row), stations.longitude(start_row))
+        missing_coordinates = any(math.isnan(c) for c in (*start_coordinates, end_latitude, end_longitude))
+        distance_key = (start_row << STATION_KEY_SHIFT) + end_key
+
+        if self._dist_mean_router is not None:
+            queue = self._dist_mean_router.route(end_station_name)
+            if missing_coordinates:
+                return queue, None
+            distance = self.__get_distance(flow_id, start_coordinates, (end_latitude, end_longitude), distance_key)
+            return queue, DistInfo(end_station_name, distance).encode()
+
+        queue = self.router.route("distance_calculator", str(packet.start_station_code))
+        if missing_coordinates:
+            return queue, None
+        distance_calc_in_packet = DistanceCalcIn(
+            stations.name(start_row),
+            start_coordinates[0],
+            start_coordinates[1],
+            end_station_name,
+            end_latitude,
+            end_longitude,
         )
+        return queue, distance_calc_in_packet.encode()
 
-        if start_station_info["latitude"] is not None:
-            distance_calc_in_packet = DistanceCalcIn(
-                start_station_info["station_name"],
-                start_station_info["latitude"],
-                start_station_info["longitude"],
-                end_station_info["station_name"],
-                end_station_info["latitude"],
-                end_station_info["longitude"],
-            )
-            distance_calc_in_packets_list = [distance_calc_in_packet.encode()]
-        else:
-            distance_calc_in_packets_list = []
+    def __find_end_stations(self, stations: StationIndex, packets: List[GatewayOut]) -> List[Optional[EndStation]]:
+        if self._co_partitioned:
+            # The end station was joined by the gateway, it is keyed by code since the start row fixes the yearid
+            ends = []
+            for packet in packets:
+                end_station = packet.end_station
+                if end_station is None:
+                    ends.append(None)
+                    continue
+                latitude = math.nan if end_station.latitude is None else end_station.latitude
+                longitude = math.nan if end_station.longitude is None else end_station.longitude
+                ends.append((packet.end_station_code, end_station.station_name, latitude, longitude))
+            return ends
 
-        return PacketLists(
-            ([prec_filter_in_packet.encode()], [year_filter_in_packet.encode()], distance_calc_in_packets_list))
+        end_rows = stations.find_rows([StationIndex.key(p.end_station_code, p.yearid) for p in packets])
+        return [
+            None if row == NO_ROW else (row, stations.name(row), stations.latitude(row), stations.longitude(row))
+            for row in end_rows
+        ]
 
-    def __handle_gateway_out(self, flow_id, packet: GatewayOut) -> Dict[str, List[bytes]]:
-        stations = self.__search_stations(flow_id, packet)
-        if not stations:
-            log_missing(f"Could not find stations for packet: {packet}")
+    def __handle_gateway_outs(self, flow_id, packets: List[GatewayOut]) -> Dict[str, List[bytes]]:
+        stations = self._stations.get(flow_id)
+        if stations is None:
+            for packet in packets:
+                log_missing(f"Could not find stations for packet: {packet}")
             return {}
 
-        prec_filter_queue = self.router.route("prec_filter", str(packet.start_station_code))
-        year_filter_queue = self.router.route("year_filter", str(packet.start_station_code))
-        distance_calc_queue = self.router.route("distance_calculator", str(packet.start_station_code))
+        if self._shared_side_tables is not None and not stations.is_sealed():
+            stations.seal(self._shared_side_tables, flow_id)
 
-        output_packets_lists = self.__build_packet_lists(packet, stations)
+        # Both ends of every trip are looked up at once
+        start_rows = stations.find_rows([StationIndex.key(p.start_station_code, p.yearid) for p in packets])
+        ends = self.__find_end_stations(stations, packets)
 
-        output = {
-            prec_filter_queue: output_packets_lists[0],
-            year_filter_queue: output_packets_lists[1],
-            distance_calc_queue: output_packets_lists[2],
-        }
+        output = {}
+        for packet, start_row, end in zip(packets, start_rows, ends):
+            if start_row == NO_ROW or end is None:
+                log_missing(f"Could not find stations for packet: {packet}")
+                continue
+
+            prec_filter_queue = self.router.route("prec_filter", str(packet.start_station_code))
+            year_filter_queue = self.router.route("year_filter", str(packet.start_station_code))
+
+            # The day of a late trip may already be finalized, the other branches wait for the EOF
+            if packet.late:
+                self._late_trips[flow_id] = self._late_trips.get(flow_id, 0) + 1
+            else:
+                prec_filter_in_packet = PrecFilterIn(
+                    packet.start_day, packet.duration_sec, packet.prectot
+                )
+                output.setdefault(prec_filter_queue, []).append(prec_filter_in_packet.encode())
+            year_filter_in_packet = YearFilterIn(
+                stations.name(start_row), packet.yearid
+            )
+            distance_queue, distance_packet = self.__build_distance_output(flow_id, packet, stations,
+                                                                           start_row, end)
+
+            output.setdefault(year_filter_queue, []).append(year_filter_in_packet.encode())
+            distance_messages = output.setdefault(distance_queue, [])
+            if distance_packet is not None:
+                distance_messages.append(distance_packet)
         return output
 
+    def handle_chunk(self, flow_id, chunk: List[bytes]) -> OutgoingMessages:
+        output = {}
+        gateway_outs = []
+        for message in chunk:
+            packet = GatewayOutOrStation.decode(message)
+            if isinstance(packet.data, GatewayOut):
+                gateway_outs.append(packet.data)
+            elif isinstance(packet.data, StationSideTableInfo):
+                # Trips received before a station must not see it
+                if len(gateway_outs) > 0:
+                    self.__add_output(output, self.__handle_gateway_outs(flow_id, gateway_outs))
+                    gateway_outs = []
+                self.__handle_side_table_message(flow_id, packet.data)
+            else:
+                raise ValueError(f"Unknown packet type: {type(packet.data)}")
+
+        if len(gateway_outs) > 0:
+            self.__add_output(output, self.__handle_gateway_outs(flow_id, gateway_outs))
+        return OutgoingMessages(output)
+
+    @staticmethod
+    def __add_output(output: Dict[str, List[bytes]], new_output: Dict[str, List[bytes]]):
+        for queue, messages in new_output.items():
+            output.setdefault(queue, [])
+            output[queue] += messages
+
     def handle_message(self, flow_id, message: bytes) -> Dict[str, List[bytes]]:
-        packet = GatewayOutOrStation.decode(message)
-        if isinstance(packet.data, GatewayOut):
-            return self.__handle_gateway_out(flow_id, packet.data)
-        elif isinstance(packet.data, StationSideTableInfo):
-            self.__handle_side_table_message(flow_id, packet.data)
-            return {}
-        else:
-            raise ValueError(f"Unknown packet type: {type(packet.data)}")
+        return self.handle_chunk(flow_id, [message])
 
     def get_state(self) -> dict:
         return {
-            "stations": self._stations,
+            "stations": {flow_id: stations.get_state() for flow_id, stations in self._stations.items()},
+            "late_trips": self._late_trips,
             "parent_state": super().get_state(),
         }
 
     def set_state(self, state: dict):
-        self._stations = state["stations"]
+        self._stations = {
+            flow_id: StationIndex.from_state(stations, self._shared_side_tables)
+            for flow_id, stations in state["stations"].items()
+        }
+        self._late_trips = state.get("late_trips", {})
         super().set_state(state["parent_state"])
 
 
@@ -149,7 +372,11 @@ def main():
         "year_filter": (YEAR_FILTER_QUEUE, NEXT_AMOUNT_YEAR_FILTER),
         "distance_calculator": (DISTANCE_CALCULATOR_QUEUE, NEXT_AMOUNT_DISTANCE_CALCULATOR),
     })
-    aggregator = StationAggregator(router)
+    dist_mean_router = None
+    if SKIP_DISTANCE_CALCULATOR:
+        dist_mean_router = Router(DIST_MEAN_CALCULATOR_QUEUE, int(NEXT_AMOUNT_DIST_MEAN_CALCULATOR),
+                                  HOT_KEY_SPLIT)
+    aggregator = StationAggregator(router, dist_mean_router, STATION_PARTITIONING == "code")
     aggregator.start()
 
 
@@ -1,8 +1,11 @@
 #!/usr/bin/env python3
 import os
-from typing import Dict, List
+from typing import Dict, List, Union
 
 from common.basic_classes.basic_stateful_filter import BasicStatefulFilter
+from common.components.provisional import ProvisionalTrigger
+from common.packets.eof import Eof
+from common.packets.provisional_results import ProvisionalResults
 from common.packets.trips_count_by_year_joined import TripsCountByYearJoined
 from common.utils import initialize_log
 
@@ -12,17 +15,56 @@ MULT_THRESHOLD = os.environ["MULT_THRESHOLD"]
 class TripCountProvider(BasicStatefulFilter):
     def __init__(self, mult_threshold: float):
         self._mult_threshold = mult_threshold
+        # [flow_id][start_station_name]: [trips_16, trips_17]
+        self._count_buffer: Dict[str, Dict[str, List[int]]] = {}
+        self._provisional = ProvisionalTrigger()
         super().__init__()
 
-    def handle_message(self, _flow_id, message: bytes) -> Dict[str, List[bytes]]:
+    def __results(self, flow_id) -> List[bytes]:
+        results = []
+        for start_station_name, (trips_16, trips_17) in self._count_buffer.get(flow_id, {}).items():
+            if trips_16 == 0:
+                continue
+            if trips_17 >= self._mult_threshold * trips_16:
+                results.append(TripsCountByYearJoined(start_station_name, trips_16, trips_17).encode())
+        return results
+
+    def handle_eof(self, flow_id, message: Eof) -> Dict[str, Union[List[bytes], Eof]]:
+        eof_output_queue = self.router.publish()
+        city_output = []
+        if not message.drop:
+            city_output = self.__results(flow_id)
+        self._count_buffer.pop(flow_id, None)
+        self._provisional.pop(flow_id)
+        return {
+            self.router.route(): city_output,
+            eof_output_queue: message,
+        }
+
+    def handle_message(self, flow_id, message: bytes) -> Dict[str, List[bytes]]:
         packet = TripsCountByYearJoined.decode(message)
 
-        output = {}
-        if packet.trips_17 >= self._mult_threshold * packet.trips_16:
-            output_queue = self.router.route()
-            output[output_queue] = [message]
+        # A hot station may come split from several counters
+        flow_buffer = self._count_buffer.setdefault(flow_id, {})
+        counts = flow_buffer.setdefault(packet.start_station_name, [0, 0])
+        counts[0] += packet.trips_16
+        counts[1] += packet.trips_17
+
+        if self._provisional.tick(flow_id):
+            return {self.router.route(): [ProvisionalResults(self.__results(flow_id)).encode()]}
+        return {}
+
+    def get_state(self) -> dict:
+        return {
+            "count_buffer": self._count_buffer,
+            "provisional": self._provisional.get_state(),
+            "parent_state": super().get_state()
+        }
 
-        return output
+    def set_state(self, state: dict):
+        self._count_buffer = state["count_buffer"]
+        self._provisional.set_state(state["provisional"])
+        super().set_state(state["parent_state"])
 
 
 def main():
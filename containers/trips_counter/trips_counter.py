@@ -1,38 +1,62 @@
 #!/usr/bin/env python3
 import json
-from typing import Dict, List
+from typing import Dict, Iterator, List, Tuple
 
 from common.basic_classes.basic_stateful_filter import BasicStatefulFilter
 from common.components.message_sender import OutgoingMessages
+from common.components.provisional import ProvisionalTrigger
+from common.components.spill import SpillBuffer
 from common.packets.eof import Eof
 from common.packets.trips_count_by_year_joined import TripsCountByYearJoined
+from common.packets.trips_count_partial import TripsCountPartial
 from common.packets.year_filter_in import YearFilterIn
 from common.utils import initialize_log
 
+# Estimated memory of a station in the buffer: its name, its counts and the slot in the flow dict
+COUNT_ENTRY_BYTES = 400
+
+
+def new_counts() -> Dict[str, int]:
+    return {"2016": 0, "2017": 0}
+
+
+def merge_counts(counts: Dict[str, int], other: Dict[str, int]):
+    counts["2016"] += other["2016"]
+    counts["2017"] += other["2017"]
+
 
 class TripsCounter(BasicStatefulFilter):
     def __init__(self):
-        self._count_buffer = {}
+        # [flow_id][start_station_name]: {"2016": trips, "2017": trips}
+        self._count_buffer = SpillBuffer("trips_counter", new_counts, merge_counts,
+                                         dict, dict, COUNT_ENTRY_BYTES)
+        self._provisional = ProvisionalTrigger()
         super().__init__()
 
+    def __output(self, items: Iterator[Tuple[str, Dict[str, int]]]) -> Dict[str, List[bytes]]:
+        # Hot stations may be split among counters, so every count is sent and the provider filters.
+        # Counts are added up by the provider, so they can also be flushed before the EOF as deltas
+        output = {}
+        for start_station_name, data in items:
+            queue_name = self.router.route(start_station_name)
+            output.setdefault(queue_name, [])
+            output[queue_name].append(
+                TripsCountByYearJoined(
+                    start_station_name,
+                    data["2016"],
+                    data["2017"]
+                ).encode()
+            )
+        return output
+
     def handle_eof(self, flow_id, message: Eof) -> OutgoingMessages:
         output = {}
-        self._count_buffer.setdefault(flow_id, {})
-        if not message.drop:
-            for start_station_name, data in self._count_buffer[flow_id].items():
-                if data["2016"] == 0:
-                    continue
-                queue_name = self.router.route(start_station_name)
-                output.setdefault(queue_name, [])
-                output[queue_name].append(
-                    TripsCountByYearJoined(
-                        start_station_name,
-                        data["2016"],
-                        data["2017"]
-                    ).encode()
-                )
-
-        self._count_buffer.pop(flow_id)
+        if message.drop:
+            self._count_buffer.discard(flow_id)
+        else:
+            output = self.__output(self._count_buffer.pop(flow_id))
+
+        self._provisional.pop(flow_id)
         eof_output_queue = self.router.publish()
         output[eof_output_queue] = message
         return OutgoingMessages(output)
@@ -40,22 +64,29 @@ class TripsCounter(BasicStatefulFilter):
     def handle_message(self, flow_id, message: bytes) -> Dict[str, List[bytes]]:
         packet = YearFilterIn.decode(message)
 
+        # Combining year filters send partial counts instead of every trip
+        count = packet.count if isinstance(packet, TripsCountPartial) else 1
+
         start_station_name = packet.start_station_name
         yearid = str(packet.yearid)
-        self._count_buffer.setdefault(flow_id, {})
-        self._count_buffer[flow_id].setdefault(start_station_name, {"2016": 0, "2017": 0})
-        self._count_buffer[flow_id][start_station_name][yearid] += 1
+        self._count_buffer.entry(flow_id, start_station_name)[yearid] += count
 
+        if self._provisional.tick(flow_id):
+            output = self.__output(self._count_buffer.items(flow_id))
+            self._count_buffer.discard(flow_id)
+            return output
         return {}
 
     def get_state(self) -> dict:
         return {
-            "count_buffer": self._count_buffer,
+            "count_buffer": self._count_buffer.get_state(),
+            "provisional": self._provisional.get_state(),
             "parent_state": super().get_state()
         }
 
     def set_state(self, state: dict):
-        self._count_buffer = state["count_buffer"]
+        self._count_buffer.set_state(state["count_buffer"])
+        self._provisional.set_state(state["provisional"])
         super().set_state(state["parent_state"])
 
 
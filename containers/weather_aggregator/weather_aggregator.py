@@ -1,11 +1,13 @@
 #!/usr/bin/env python3
+import base64
+import math
 import os
-import json
-from datetime import timedelta
-from typing import List, Dict, Union
+from array import array
+from typing import List, Dict, Union, Optional
 
 from common.basic_classes.basic_aggregator import BasicAggregator
 from common.components.message_sender import OutgoingMessages
+from common.components.side_table_image import SharedSideTables, SideTableImage
 from common.packets.eof import Eof
 from common.packets.gateway_in import GatewayIn
 from common.packets.gateway_in_or_weather import GatewayInOrWeather
@@ -13,49 +15,141 @@ from common.packets.gateway_out import GatewayOut
 from common.packets.gateway_out_or_station import GatewayOutOrStation
 from common.packets.weather_side_table_info import WeatherSideTableInfo
 from common.router import MultiRouter
-from common.utils import initialize_log, parse_date, datetime_str_to_date_str, log_missing
+from common.utils import initialize_log, log_missing, day_to_date_str
 
 NEXT = os.environ["NEXT"]
 NEXT_AMOUNT = int(os.environ["NEXT_AMOUNT"])
+# With "code", trips go to the station aggregator that owns their start station
+STATION_PARTITIONING = os.environ.get("STATION_PARTITIONING", "broadcast")
+
+
+class WeatherIndex:
+    """
+    Precipitation of a flow indexed by day number, kept in an array that covers every day
+    between the first and the last one received. Missing days are NaN.
+
+    Once trips arrive the weather is complete, and the index can be sealed into an image
+    shared with the other replicas of the host.
+    """
+
+    def __init__(self):
+        self._shared_side_tables: Optional[SharedSideTables] = None
+        self._image: Optional[SideTableImage] = None
+        self._first_day = 0
+        self._prectots = array("d")
+
+    def set(self, day: int, prectot: float):
+        if self._image is not None:
+            self.__unseal()
+
+        if len(self._prectots) == 0:
+            self._first_day = day
+        elif day < self._first_day:
+            self._prectots[:0] = array("d", [math.nan]) * (self._first_day - day)
+            self._first_day = day
+
+        i = day - self._first_day
+        if i >= len(self._prectots):
+            self._prectots.extend(array("d", [math.nan]) * (i - len(self._prectots) + 1))
+        self._prectots[i] = prectot
+
+    def get(self, day: int) -> Optional[float]:
+        i = day - self._first_day
+        if 0 <= i < len(self._prectots):
+            prectot = self._prectots[i]
+            if not math.isnan(prectot):
+                return prectot
+        return None
+
+    def is_sealed(self) -> bool:
+        return self._image is not None
+
+    def seal(self, shared_side_tables: SharedSideTables, flow_id: str):
+        image = shared_side_tables.publish(flow_id, "weather", {"prectots": self._prectots},
+                                           {"first_day": self._first_day})
+        self.__attach(shared_side_tables, image)
+
+    def __unseal(self):
+        # Weather arriving after the trips gets a private copy again
+        self._prectots = array("d", self._prectots)
+        self.close()
+
+    def __attach(self, shared_side_tables: SharedSideTables, image: SideTableImage):
+        self._shared_side_tables = shared_side_tables
+        self._image = image
+        self._first_day = image.meta["first_day"]
+        self._prectots = image.column("prectots")
+
+    def close(self):
+        if self._image is not None:
+            self._shared_side_tables.release(self._image)
+            self._image = None
+
+    def get_state(self) -> dict:
+        if self._image is not None:
+            return {"image": self._image.path}
+        return {
+            "first_day": self._first_day,
+            "prectots": base64.b64encode(self._prectots.tobytes()).decode(),
+        }
+
+    @staticmethod
+    def from_state(state: dict, shared_side_tables: Optional[SharedSideTables]) -> "WeatherIndex":
+        index = WeatherIndex()
+        if "image" in state:
+            index.__attach(shared_side_tables, shared_side_tables.attach(state["image"]))
+            return index
+
+        index._first_day = state["first_day"]
+        index._prectots.frombytes(base64.b64decode(state["prectots"]))
+        return index
 
 
 class WeatherAggregator(BasicAggregator):
-    def __init__(self, router: MultiRouter):
-        self._weather = {}
+    def __init__(self, router: MultiRouter, route_by_station: bool = False):
+        self._weather: Dict[str, WeatherIndex] = {}
+        self._route_by_station = route_by_station
         super().__init__(router)
 
     def handle_eof(self, flow_id, message: Eof) -> Dict[str, Eof]:
-        self._weather.pop(flow_id, None)
+        weather = self._weather.pop(flow_id, None)
+        if weather is not None:
+            weather.close()
         return super().handle_eof(flow_id, message)
 
     def __handle_side_table_message(self, flow_id: str, packet: WeatherSideTableInfo):
-        date = parse_date(packet.date)
-        yesterday = (date - timedelta(days=1)).date()
-        yesterday = yesterday.strftime("%Y-%m-%d")
-        self._weather.setdefault(flow_id, {})
-        self._weather[flow_id][yesterday] = packet.prectot
-
-    def __search_prec_for_date(self, flow_id: str, date: str) -> Union[int, None]:
-        if flow_id not in self._weather:
+        # Trips use the precipitation reported the day after they start
+        yesterday = packet.day - 1
+        self._weather.setdefault(flow_id, WeatherIndex())
+        self._weather[flow_id].set(yesterday, packet.prectot)
+
+    def __search_prec_for_day(self, flow_id: str, day: int) -> Union[float, None]:
+        weather = self._weather.get(flow_id)
+        if weather is None:
             return None
-        return self._weather[flow_id].get(date, None)
+        if self._shared_side_tables is not None and not weather.is_sealed():
+            weather.seal(self._shared_side_tables, flow_id)
+        return weather.get(day)
 
     def __handle_gateway_in(self, flow_id: str, packet: GatewayIn) -> OutgoingMessages:
-        start_date = datetime_str_to_date_str(packet.start_datetime)
+        start_day = packet.start_day
 
-        prectot = self.__search_prec_for_date(flow_id, start_date)
+        prectot = self.__search_prec_for_day(flow_id, start_day)
         if prectot is None:
-            log_missing(f"Could not find weather for city {flow_id} and date {start_date}.")
+            log_missing(f"Could not find weather for city {flow_id} and date {day_to_date_str(start_day)}.")
             return OutgoingMessages({})
 
         output_packet = GatewayOutOrStation(
             GatewayOut(
-                start_date, packet.start_station_code, packet.end_station_code,
-                packet.duration_sec, packet.yearid, prectot
+                start_day, packet.start_station_code, packet.end_station_code,
+                packet.duration_sec, packet.yearid, prectot, packet.end_station, packet.late
             )
         )
 
-        output_queue = self.router.route("next", start_date)
+        if self._route_by_station:
+            output_queue = self.router.route("next", str(packet.start_station_code))
+        else:
+            output_queue = self.router.route("next", start_day)
         return OutgoingMessages({
             output_queue: [output_packet.encode()]
         })
@@ -76,20 +170,23 @@ class WeatherAggregator(BasicAggregator):
 
     def get_state(self) -> dict:
         state = {
-            "weather": self._weather,
+            "weather": {flow_id: index.get_state() for flow_id, index in self._weather.items()},
             "parent_state": super().get_state()
         }
         return state
 
     def set_state(self, state: dict):
-        self._weather = state["weather"]
+        self._weather = {
+            flow_id: WeatherIndex.from_state(index, self._shared_side_tables)
+            for flow_id, index in state["weather"].items()
+        }
         super().set_state(state["parent_state"])
 
 
 def main():
     initialize_log()
     router = MultiRouter({"next": (NEXT, NEXT_AMOUNT)})
-    aggregator = WeatherAggregator(router)
+    aggregator = WeatherAggregator(router, STATION_PARTITIONING == "code")
     aggregator.start()
 
 
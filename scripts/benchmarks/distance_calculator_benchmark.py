@@ -0,0 +1,63 @@
+"""
+Compares the rows per second of DistanceCalculator when handling a chunk message by message
+(one haversine call per row) against the vectorized chunk path.
+
+Usage: python3 scripts/benchmarks/distance_calculator_benchmark.py [chunk_size] [chunks]
+"""
+import os
+import random
+import sys
+import time
+
+CONTAINERS_PATH = os.path.join(os.path.dirname(__file__), "..", "..", "containers")
+sys.path.append(CONTAINERS_PATH)
+
+from common.operators.distance_calculator import DistanceCalculator
+from common.packets.distance_calc_in import DistanceCalcIn
+from common.router import Router
+
+STATIONS = 600
+
+
+def build_chunk(chunk_size: int) -> list:
+    stations = [(f"station {i}", random.uniform(45.4, 45.6), random.uniform(-73.7, -73.5)) for i in range(STATIONS)]
+    chunk = []
+    for _ in range(chunk_size):
+        start, end = random.choice(stations), random.choice(stations)
+        chunk.append(DistanceCalcIn(start[0], start[1], start[2], end[0], end[1], end[2]).encode())
+    return chunk
+
+
+def per_message(calculator: DistanceCalculator, chunk: list):
+    output = {}
+    for message in chunk:
+        for queue, messages in calculator.handle_message("flow", message).items():
+            output.setdefault(queue, [])
+            output[queue] += messages
+    return output
+
+
+def measure(name: str, handler, calculator: DistanceCalculator, chunks: list) -> float:
+    start = time.perf_counter()
+    for chunk in chunks:
+        handler(calculator, chunk)
+    elapsed = time.perf_counter() - start
+    rows = sum(len(chunk) for chunk in chunks)
+    print(f"{name:>12}: {rows / elapsed:>12.0f} rows/s ({elapsed:.3f} s for {rows} rows)")
+    return elapsed
+
+
+def main():
+    chunk_size = int(sys.argv[1]) if len(sys.argv) > 1 else 4096
+    chunks_amount = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+
+    calculator = DistanceCalculator(Router("dist_mean_calculator", 2))
+    chunks = [build_chunk(chunk_size) for _ in range(chunks_amount)]
+
+    per_message_time = measure("per message", per_message, calculator, chunks)
+    chunk_time = measure("chunk", lambda c, chunk: c.handle_chunk("flow", chunk), calculator, chunks)
+    print(f"{'speedup':>12}: {per_message_time / chunk_time:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
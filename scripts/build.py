@@ -14,8 +14,25 @@ def increase_prev_amount(container_name, amount):
     data["containers"][container_name]["prev_amount"] += amount
 
 
+# Fused steps run inside the containers of their previous step, so they get no containers of their own
+fused_into = {}
+for name, container_data in data["containers"].items():
+    for fused_name in container_data.get("fused", []):
+        next = container_data["next"]
+        if fused_name != next and fused_name not in next:
+            raise ValueError(f"{name} can only fuse one of its next steps, not {fused_name}")
+        fused_into[fused_name] = name
+
+# Stages with a max_amount can scale out up to it, so every container follows the membership epochs
+elastic = any("max_amount" in container_data for container_data in data["containers"].values())
+# [stage]: stage whose containers send its EOFs
+prev_stage = {}
+
 for name, container_data in data["containers"].items():
     next = container_data["next"]
+    # EOFs of a fused step are sent by every container of the step it is fused into
+    senders = fused_into.get(name, name)
+    senders_amount = data["containers"][senders]["amount"]
 
     if isinstance(next, str):
         if next not in data["containers"]:
@@ -25,18 +42,28 @@ for name, container_data in data["containers"].items():
         if name == "gateway":
             increase_prev_amount(next, 1)
         else:
-            increase_prev_amount(next, container_data["amount"])
+            increase_prev_amount(next, senders_amount)
+            prev_stage[next] = senders
     else:
         next_amount = {}
         for container_name in next:
             next_amount[container_name] = data["containers"][container_name]["amount"]
-            increase_prev_amount(container_name, container_data["amount"])
+            increase_prev_amount(container_name, senders_amount)
+            prev_stage[container_name] = senders
 
     container_data["next_amount"] = next_amount
 
+    # Shortcuts let a container send data past its next step, EOFs still follow "next"
+    if "shortcuts" in container_data:
+        container_data["shortcuts_amount"] = {
+            shortcut: data["containers"][shortcut]["amount"] for shortcut in container_data["shortcuts"]
+        }
+
 # Health Check
 _health_check_containers = []
 for name, container_name in data["containers"].items():
+    if name in fused_into:
+        continue
     for i in range(container_name["amount"]):
         _health_check_containers.append(f"{name}_{i}")
 _health_check_containers.append("response_provider")
@@ -85,19 +112,39 @@ def add_container(name, container, n):
   {name}_{n}:
     build:
       context: ./containers
-      dockerfile: {name}/Dockerfile
+      dockerfile: {name}/Dockerfile'''
+
+    # Replicas past the deployment amount are only started by scripts/scale.py
+    if n >= container["amount"]:
+        output += '''
+    profiles:
+      - elastic'''
+
+    output += f'''
     depends_on:
       rabbitmq:
         condition: service_healthy
     entrypoint: python3 /opt/app/{name}.py
     volumes:
-      - .volumes/{name}_{n}:/volumes
+      - .volumes/{name}_{n}:/volumes'''
+
+    if elastic:
+        output += '''
+      - .volumes/membership:/membership'''
+
+    # Replicas on the same host share the side tables they build
+    if container.get("shared_side_tables", False):
+        output += f'''
+      - .volumes/shared/{name}:/shared'''
+
+    output += '''
     environment:'''
 
     env = data["common_env"].copy()
     env["INPUT_QUEUE"] = f"{name}_{n}"
     env["EOF_ROUTING_KEY"] = name
-    env["HEALTH_CHECKER"] = containers_health_checkers[f"{name}_{n}"]
+    # Spare replicas are not supervised, the health checker would start them
+    env["HEALTH_CHECKER"] = containers_health_checkers.get(f"{name}_{n}", containers_health_checkers[f"{name}_0"])
     env["CONTAINER_ID"] = f"{name}_{n}"
 
     if "prev_amount" in container:
@@ -114,22 +161,49 @@ def add_container(name, container, n):
         else:
             env["NEXT_AMOUNT"] = container["next_amount"]
 
+    if "shortcuts_amount" in container:
+        for container_name, amount in container["shortcuts_amount"].items():
+            env[f"{container_name.upper()}_QUEUE"] = container_name
+            env[f"NEXT_AMOUNT_{container_name.upper()}"] = amount
+
+    if container.get("shared_side_tables", False):
+        env["SHARED_SIDE_TABLES_DIRECTORY"] = "/shared"
+
+    if elastic:
+        env["MEMBERSHIP_DIRECTORY"] = "/membership"
+        env["AMOUNT"] = container["amount"]
+        if name in prev_stage:
+            env["PREV"] = prev_stage[name]
+
     if "env" in container:
         env.update(container["env"])
 
+    if "fused" in container:
+        env["FUSED"] = ",".join(container["fused"])
+        for fused_name in container["fused"]:
+            fused_container = data["containers"][fused_name]
+            prefix = fused_name.upper()
+            env[f"{prefix}_NEXT"] = fused_container["next"]
+            if "next_amount" in fused_container:
+                env[f"{prefix}_NEXT_AMOUNT"] = fused_container["next_amount"]
+            for key, value in fused_container.get("env", {}).items():
+                env[f"{prefix}_{key}"] = value
+
     for key, value in env.items():
         output += f'''
       - {key}={value}'''
 
 
 for name, container in data["containers"].items():
+    if name in fused_into:
+        continue
 
     if "amount" not in container:
         amount = 1
     else:
         amount = container["amount"]
 
-    for i in range(amount):
+    for i in range(container.get("max_amount", amount)):
         add_container(name, container, i)
 
 
@@ -235,6 +309,7 @@ def add_client(name, cities, data_path):
     env["ID_REQ_QUEUE"] = "client_id_queue"
     env["GATEWAY"] = "gateway"
     env["GATEWAY_AMOUNT"] = data["containers"]["gateway"]["amount"]
+    env.update(data["clients"].get("env", {}))
 
     for key, value in env.items():
         output += f'''
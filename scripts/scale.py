@@ -0,0 +1,86 @@
+import json
+import os
+import subprocess
+import sys
+import time
+
+# Usage: python3 scripts/scale.py <stage> <amount>
+# Starts the spare replicas of the stage and publishes the next membership epoch once they consume.
+# Flows that start after it are spread over the new amount, running flows finish on the old replicas.
+
+MEMBERSHIP_DIRECTORY = ".volumes/membership"
+READY_TIMEOUT = 120
+READY_CHECK_INTERVAL = 1
+
+
+def epoch_path(epoch):
+    return os.path.join(MEMBERSHIP_DIRECTORY, f"epoch_{epoch}.json")
+
+
+def latest_epoch():
+    epoch = 0
+    while os.path.exists(epoch_path(epoch + 1)):
+        epoch += 1
+    return epoch
+
+
+def current_amounts(epoch):
+    if epoch == 0:
+        return {}
+    with open(epoch_path(epoch), "r") as file:
+        return json.load(file)["amounts"]
+
+
+def wait_until_ready(containers):
+    deadline = time.time() + READY_TIMEOUT
+    pending = set(containers)
+    while len(pending) > 0:
+        if time.time() > deadline:
+            raise TimeoutError(f"Containers not ready: {sorted(pending)}")
+        pending = {c for c in pending if not os.path.exists(os.path.join(MEMBERSHIP_DIRECTORY, "ready", c))}
+        time.sleep(READY_CHECK_INTERVAL)
+
+
+def write_epoch(epoch, amounts):
+    # Containers may read the epoch at any moment, so it is renamed into place once complete
+    temp_path = os.path.join(MEMBERSHIP_DIRECTORY, f".epoch_{epoch}.json")
+    with open(temp_path, "w") as file:
+        json.dump({"epoch": epoch, "amounts": amounts}, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.rename(temp_path, epoch_path(epoch))
+
+
+def main():
+    stage, amount = sys.argv[1], int(sys.argv[2])
+
+    with open('deployment.json', 'r') as json_file:
+        data = json.load(json_file)
+
+    container = data["containers"][stage]
+    if amount > container.get("max_amount", container["amount"]):
+        raise ValueError(f"{stage} can not have more than {container.get('max_amount', container['amount'])} replicas")
+
+    epoch = latest_epoch()
+    amounts = current_amounts(epoch)
+    current_amount = amounts.get(stage, container["amount"])
+    if amount <= current_amount:
+        raise ValueError(f"{stage} already has {current_amount} replicas, only scaling out is supported")
+
+    new_containers = [f"{stage}_{i}" for i in range(current_amount, amount)]
+    for new_container in new_containers:
+        # A marker left by an earlier run does not mean the container is consuming now
+        marker = os.path.join(MEMBERSHIP_DIRECTORY, "ready", new_container)
+        if os.path.exists(marker):
+            os.remove(marker)
+    subprocess.run(["docker", "compose", "-f", "docker-compose-dev.yaml", "--profile", "elastic",
+                    "up", "-d", "--no-deps"] + new_containers, check=True)
+    wait_until_ready(new_containers)
+
+    amounts[stage] = amount
+    write_epoch(epoch + 1, amounts)
+    print(f"Epoch {epoch + 1}: {amounts}")
+
+
+if __name__ == "__main__":
+    main()